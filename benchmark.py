@@ -0,0 +1,246 @@
+"""
+Benchmark throughput of the preprocessing and topic model stages on a synthetic corpus (see synthetic_data.py).
+
+Each stage is timed separately and written as one JSON record per line, e.g.
+    {"run_id": "...", "stage": "remove_special_chars", "status": "ok", "seconds": 0.8, "items": 18000,
+     "items_per_sec": 22500.0, ...}
+Records are appended to the output file, so results of different runs (e.g. before and after a change) can be
+compared with --compare_to. Everything runs offline: stages whose resources (e.g. NLTK data or the spaCy model) aren't
+installed are recorded with status 'error' and the remaining stages still run.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import synthetic_data
+from instrumentation import peak_rss_mb
+from text_utils import remove_special_chars, set_offline
+
+STAGES = ["remove_special_chars", "process_single_post_text", "filter_posts", "make_corpus", "vocab_doc2bow",
+          "topic_inference_gibbs", "topic_inference_vb", "comment_aggregation"]
+
+
+class BenchmarkContext:
+    """
+    Data shared between stages (e.g. the docs made by make_corpus are used by vocab_doc2bow).
+    """
+    def __init__(self, data_dir, generator, max_process_texts):
+        self.data_dir = data_dir
+        self.generator = generator
+        self.max_process_texts = max_process_texts
+        self.posts_df = pd.concat([pd.read_csv(os.path.join(data_dir, subreddit, "posts.csv"), index_col=0)
+                                   for subreddit in synthetic_data.SUBREDDITS])
+        self.comments_df = pd.concat([pd.read_csv(os.path.join(data_dir, subreddit, "comments.csv"), index_col=0)
+                                      for subreddit in synthetic_data.SUBREDDITS])
+        self.texts = list(self.posts_df["title"] + " " + self.posts_df["selftext"]) + list(self.comments_df["body"])
+        self.csv_files = []
+        self.docs = None
+        self.vocab_dict = None
+        self.bows = None
+
+
+def bench_remove_special_chars(ctx):
+    for text in ctx.texts:
+        remove_special_chars(text)
+    return len(ctx.texts), None
+
+
+def bench_process_single_post_text(ctx):
+    from text_utils import process_single_post_text
+    texts = ctx.texts[:ctx.max_process_texts]
+    num_tokens = sum(len(sent) for text in texts for sent in process_single_post_text(text))
+    return len(texts), num_tokens
+
+
+def bench_filter_posts(ctx):
+    from data_processor import CommentProcessor, PostProcessor
+    moderators_path = os.path.join(ctx.data_dir, "moderators.txt")
+    for subreddit in synthetic_data.SUBREDDITS:
+        for name, processor_class in [("posts", PostProcessor), ("comments", CommentProcessor)]:
+            data_path = os.path.join(ctx.data_dir, subreddit, "{}.csv".format(name))
+            output_path = os.path.join(ctx.data_dir, subreddit, "filtered_{}.csv".format(name))
+            processor_class(data_path, moderators_path, stream=True).stream_filter(output_path)
+            ctx.csv_files.append(output_path)
+    return len(ctx.posts_df) + len(ctx.comments_df), None
+
+
+def bench_make_corpus(ctx):
+    from topic_model_corpus import Corpus
+    csv_files = ctx.csv_files or [os.path.join(ctx.data_dir, subreddit, "{}.csv".format(name))
+                                  for subreddit in synthetic_data.SUBREDDITS for name in ["posts", "comments"]]
+    corpus = Corpus(csv_files, downsample=False)
+    corpus.make_corpus()
+    ctx.docs = list(corpus.data_df["text"])
+    ctx.vocab_dict = corpus.vocab_dict
+    return len(corpus.data_df), sum(len(doc) for doc in ctx.docs)
+
+
+def bench_vocab_doc2bow(ctx):
+    from gensim.utils import simple_preprocess
+    from text_utils import build_vocab_dict, doc2bow_matrix
+    docs = ctx.docs
+    if docs is None:
+        # make_corpus didn't run (e.g. NLTK/spaCy resources missing), so tokenize the cleaned text directly
+        docs = [simple_preprocess(remove_special_chars(text), deacc=True) for text in ctx.texts]
+    vocab_dict = build_vocab_dict(docs, no_below=5, no_above=.5)
+    ctx.bows = doc2bow_matrix(docs, vocab_dict)
+    ctx.vocab_dict = vocab_dict
+    return len(docs), sum(len(doc) for doc in docs)
+
+
+def _inferencer(ctx):
+    from lda_inference import MalletInferencer
+    # topic-word counts from the generator's true topics, in vocab order
+    word_index = {word: i for i, word in enumerate(ctx.generator.vocab)}
+    counts = np.ones((ctx.generator.num_topics, len(ctx.vocab_dict)))
+    for token, token_id in ctx.vocab_dict.token2id.items():
+        if token in word_index:
+            counts[:, token_id] += ctx.generator.topic_word[:, word_index[token]] * 100000
+    return MalletInferencer(counts, np.full(ctx.generator.num_topics, 5.0 / ctx.generator.num_topics))
+
+
+def bench_topic_inference_gibbs(ctx):
+    assert ctx.bows is not None, "requires vocab_doc2bow stage"
+    _inferencer(ctx).infer(ctx.bows, method="gibbs", seed=0)
+    return ctx.bows.shape[0], int(ctx.bows.sum())
+
+
+def bench_topic_inference_vb(ctx):
+    assert ctx.bows is not None, "requires vocab_doc2bow stage"
+    _inferencer(ctx).infer(ctx.bows, method="vb")
+    return ctx.bows.shape[0], int(ctx.bows.sum())
+
+
+def bench_comment_aggregation(ctx):
+    from get_comment_topic_dists_for_posts import aggregate_comment_topics, get_thread_post_ids
+    rng = np.random.default_rng(0)
+    comments_df = ctx.comments_df.reset_index(drop=True)
+    topic_dists = rng.dirichlet(np.full(ctx.generator.num_topics, 0.2), size=len(comments_df))
+    aggregate_comment_topics(ctx.posts_df["id"].to_numpy(), get_thread_post_ids(comments_df), topic_dists, rng=rng)
+    return len(comments_df), None
+
+
+def run_benchmarks(ctx, stages, run_info):
+    """
+    Run and time stages.
+    :return: list of record dicts (one per stage)
+    """
+    records = []
+    for stage in stages:
+        record = dict(run_info, stage=stage)
+        start = time.perf_counter()
+        try:
+            num_items, num_tokens = globals()["bench_{}".format(stage)](ctx)
+            status = "ok"
+        except Exception as e:
+            num_items, num_tokens = None, None
+            status = "error: {}: {}".format(type(e).__name__, e)
+        seconds = time.perf_counter() - start
+        record.update(status=status, seconds=round(seconds, 6), items=num_items, tokens=num_tokens,
+                      items_per_sec=round(num_items / seconds, 3) if num_items else None,
+                      tokens_per_sec=round(num_tokens / seconds, 3) if num_tokens else None,
+                      peak_rss_mb=peak_rss_mb())
+        print("{}: {} ({:.3f}s, {} items/s)".format(stage, status, seconds, record["items_per_sec"]))
+        records.append(record)
+    return records
+
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare_records(records, previous_records, threshold=0.2):
+    """
+    Print change in items/s of each stage relative to the last run in previous_records.
+    :param threshold: relative slowdown above which a stage is flagged as a regression
+    :return: list of stages that regressed
+    """
+    if not previous_records:
+        print("no previous runs to compare with")
+        return []
+    last_run = previous_records[-1]["run_id"]
+    previous = {r["stage"]: r for r in previous_records if r["run_id"] == last_run}
+    regressions = []
+    print("comparison with run {}:".format(last_run))
+    for record in records:
+        prev = previous.get(record["stage"])
+        if not prev or not prev.get("items_per_sec") or not record.get("items_per_sec"):
+            continue
+        ratio = record["items_per_sec"] / prev["items_per_sec"]
+        flag = ""
+        if ratio < 1 - threshold:
+            flag = "  <-- REGRESSION"
+            regressions.append(record["stage"])
+        print("  {}: {:.1f} -> {:.1f} items/s ({:.2f}x){}".format(record["stage"], prev["items_per_sec"],
+                                                                  record["items_per_sec"], ratio, flag))
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_posts", type=int, default=1000, help="Number of synthetic posts per subreddit.")
+    parser.add_argument("--mean_comments", type=float, default=8, help="Mean number of comments per post.")
+    parser.add_argument("--max_process_texts", type=int, default=2000,
+                        help="Maximum number of texts to run process_single_post_text on.")
+    parser.add_argument("--stages", type=str, nargs="+", default=STAGES, choices=STAGES, help="Stages to run.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for synthetic data.")
+    parser.add_argument("--data_dir", type=str, default=None,
+                        help="Directory to write synthetic data to (a temporary directory if not given).")
+    parser.add_argument("--output_path", type=str, default="benchmark_results.jsonl",
+                        help="Path to JSON-lines file to append results to.")
+    parser.add_argument("--compare_to", type=str, default=None,
+                        help="JSON-lines results file to compare with (defaults to output_path if it exists).")
+    parser.add_argument("--regression_threshold", type=float, default=0.2,
+                        help="Relative slowdown (in items/s) above which a stage is flagged as a regression.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = _parse_args()
+    set_offline()
+    compare_path = args.compare_to or args.output_path
+    previous_records = read_records(compare_path) if os.path.exists(compare_path) else []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        start = time.perf_counter()
+        generator = synthetic_data.write_dataset(data_dir, num_posts=args.num_posts,
+                                                 mean_comments=args.mean_comments, seed=args.seed)
+        print("generated synthetic data in time {}".format(time.perf_counter() - start))
+        ctx = BenchmarkContext(data_dir, generator, args.max_process_texts)
+        run_info = {
+            "run_id": datetime.datetime.now().strftime("%Y%m%dT%H%M%S"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "num_posts": args.num_posts,
+            "mean_comments": args.mean_comments,
+            "seed": args.seed,
+        }
+        records = run_benchmarks(ctx, args.stages, run_info)
+    with open(args.output_path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    compare_records(records, previous_records, threshold=args.regression_threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark text_utils.remove_special_chars / remove_special_chars_batch against the original sequence of re.sub calls,
+and check that all three give the same output on Reddit-style text.
+"""
+import argparse
+import random
+import re
+import time
+
+from synthetic_data import MARKUP, WORDS
+from text_utils import remove_special_chars, remove_special_chars_batch
+
+
+def reference_remove_special_chars(text):
+    """
+    Original (one re.sub call per step) version of remove_special_chars, kept as reference for equivalence checks.
+    """
+    text = re.sub(r'\n+', ' ', text)
+    text = text.strip()
+    text = re.sub(r'\s\s+', ' ', text)
+    text = re.sub(r'\S*@\S*\s?', '', text)
+    text = re.sub(r'\"?\\?&?gt;?', '', text)
+    text = re.sub(r'\*', '', text)
+    text = re.sub('&amp;#x200B;', '', text)
+    text = re.sub(r'\[.*?\]\(.*?\)', '', text)
+    text = re.sub(r'https?:\/\/.*[\r\n]*', '', text)
+    text = re.sub('~', '', text)
+    text = re.sub('&lt;', '', text)
+    text = re.sub(r'!(.*?)!', r'\1', text)
+    text = re.sub('`', '', text)
+    text = re.sub(r'\^\((.*?)\)', r'\1', text)
+    text = re.sub(r'\|', ' ', text)
+    text = re.sub(':-', '', text)
+    text = re.sub('#', '', text)
+    return text
+
+
+def make_texts(num_texts, seed=0):
+    """
+    Generate random Reddit-style posts with markup.
+    """
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(num_texts):
+        pieces = []
+        for _ in range(rng.randint(1, 40)):
+            words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+            if rng.random() < 0.3:
+                template = rng.choice(MARKUP)
+                words = template.format(*([words] * template.count("{}")))
+            pieces.append(words)
+        texts.append(rng.choice([" ", "\n", ". ", "\n\n"]).join(pieces))
+    return texts
+
+
+def check_equivalence(texts):
+    """
+    Check that the cleaners give the same output as the reference implementation.
+    :return: number of texts where outputs differ
+    """
+    expected = [reference_remove_special_chars(text) for text in texts]
+    single = [remove_special_chars(text) for text in texts]
+    batch = remove_special_chars_batch(texts, batch_size=97)
+    return sum(1 for e, s, b in zip(expected, single, batch) if not e == s == b)
+
+
+def _time(fn, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_texts", type=int, default=20000, help="Number of synthetic posts to clean.")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timing repeats (best time is reported).")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for generating posts.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = _parse_args()
+    texts = make_texts(args.num_texts, args.seed)
+    num_diff = check_equivalence(texts)
+    print("outputs differ from reference for {} of {} texts".format(num_diff, len(texts)))
+    timings = [
+        ("reference", lambda: [reference_remove_special_chars(text) for text in texts]),
+        ("remove_special_chars", lambda: [remove_special_chars(text) for text in texts]),
+        ("remove_special_chars_batch", lambda: remove_special_chars_batch(texts)),
+    ]
+    for name, fn in timings:
+        seconds = _time(fn, args.repeats)
+        print("{}: {:.3f}s ({:.0f} texts/s)".format(name, seconds, len(texts) / seconds))
+    if num_diff:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""
+Tokenize pre-processed posts for the DistilBERT models once, and batch them with dynamic padding.
+
+Posts are split into overlapping chunks of 200 words starting every 150 words (as in the BERT notebooks), all chunks
+are tokenized in a single batched pass and the token ids are saved to a token store, a directory containing:
+* token_ids.npy: token ids of all chunks, concatenated (uint16 if the tokenizer's vocab fits, otherwise int32)
+* chunk_indptr.npy: token ids of chunk i are token_ids[chunk_indptr[i]:chunk_indptr[i + 1]]
+* post_indptr.npy: chunks of post j are chunks post_indptr[j] to post_indptr[j + 1] - 1
+* ids.txt: id of each post, one per line
+* info.json: tokenizer name, chunking parameters, counts and format version
+
+Arrays are saved as .npy files, so they can be memory-mapped. For training and inference, BucketBatchSampler groups
+chunks of similar length into batches and PadCollator pads each batch only to the length of its longest chunk, rather
+than padding every chunk to 512 tokens.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+
+FORMAT_VERSION = 1
+CHUNK_WORDS = 200
+CHUNK_STRIDE = 150
+# characters of the list representation of processed text (e.g. "[['a', 'b'], ['c']]") removed before splitting
+_LIST_CHARS = str.maketrans({"[": None, "]": None, "'": None, ",": " "})
+
+
+def post_words(processed_title, processed_text):
+    """
+    Words of each post (title followed by text), from the list representations saved in processed_posts.csv.
+    :param processed_title: pandas Series of processed titles
+    :param processed_text: pandas Series of processed texts
+    :return: list with a list of words for each post
+    """
+    return list((processed_title.fillna("") + "," + processed_text.fillna("")).str.translate(_LIST_CHARS).str.split())
+
+
+def chunk_words(words, chunk_words=CHUNK_WORDS, stride=CHUNK_STRIDE):
+    """
+    Split words into chunks of chunk_words words starting every stride words. As in the notebooks, there are
+    max(1, len(words) // stride) chunks, so words after the last chunk are left out.
+    :return: list of chunks (strs of space-separated words)
+    """
+    num_chunks = max(1, len(words) // stride)
+    return [" ".join(words[i * stride:i * stride + chunk_words]) for i in range(num_chunks)]
+
+
+def build_token_store(store_dir, ids, words, tokenizer, tokenizer_name, max_length=512, chunk_size=CHUNK_WORDS,
+                      stride=CHUNK_STRIDE, batch_size=1000):
+    """
+    Chunk and tokenize posts and save the token ids to store_dir.
+    :param ids: id of each post
+    :param words: list of words of each post (see post_words)
+    :param tokenizer: Hugging Face tokenizer (a fast tokenizer, e.g. DistilBertTokenizerFast, is much quicker)
+    :param tokenizer_name: name/path the tokenizer was loaded from (saved so the store can be checked against it)
+    :param max_length: maximum number of tokens per chunk (including special tokens); longer chunks are truncated
+    :param batch_size: number of chunks passed to the tokenizer at a time
+    :return: TokenStore
+    """
+    chunks, num_chunks = [], []
+    for post in words:
+        post_chunks = chunk_words(post, chunk_size, stride)
+        chunks.extend(post_chunks)
+        num_chunks.append(len(post_chunks))
+    token_ids, lens = [], []
+    for start in range(0, len(chunks), batch_size):
+        # input ids only (the attention mask follows from the length of each chunk)
+        encoded = tokenizer(chunks[start:start + batch_size], add_special_tokens=True, truncation=True,
+                            max_length=max_length, return_attention_mask=False)["input_ids"]
+        for chunk_ids in encoded:
+            token_ids.extend(chunk_ids)
+            lens.append(len(chunk_ids))
+    dtype = np.uint16 if len(tokenizer) <= np.iinfo(np.uint16).max + 1 else np.int32
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    np.save(os.path.join(store_dir, "token_ids.npy"), np.array(token_ids, dtype=dtype))
+    np.save(os.path.join(store_dir, "chunk_indptr.npy"), _lens_to_indptr(lens))
+    np.save(os.path.join(store_dir, "post_indptr.npy"), _lens_to_indptr(num_chunks))
+    with open(os.path.join(store_dir, "ids.txt"), "w", encoding="utf-8") as f:
+        f.write("".join("{}\n".format(post_id) for post_id in ids))
+    info = {"format_version": FORMAT_VERSION, "tokenizer": tokenizer_name, "max_length": max_length,
+            "chunk_words": chunk_size, "stride": stride, "pad_token_id": tokenizer.pad_token_id,
+            "num_posts": len(num_chunks), "num_chunks": len(lens), "num_tokens": len(token_ids)}
+    # info is written last, so a store that was only partially written can't be loaded
+    with open(os.path.join(store_dir, "info.json"), "w") as f:
+        json.dump(info, f)
+    return TokenStore.load(store_dir)
+
+
+class TokenStore:
+    """
+    Token ids of post chunks (see module docstring for the layout).
+    """
+    def __init__(self, info, ids, token_ids, chunk_indptr, post_indptr):
+        self.info = info
+        self.ids = ids
+        self.token_ids = token_ids
+        self.chunk_indptr = chunk_indptr
+        self.post_indptr = post_indptr
+        self.pad_token_id = info["pad_token_id"]
+
+    @classmethod
+    def load(cls, store_dir, mmap=True):
+        """
+        :param mmap: if True, memory-map the token ids instead of reading them into memory
+        """
+        with open(os.path.join(store_dir, "info.json")) as f:
+            info = json.load(f)
+        assert info["format_version"] == FORMAT_VERSION, "unsupported token store format version"
+        with open(os.path.join(store_dir, "ids.txt"), encoding="utf-8") as f:
+            ids = f.read().splitlines()
+        return cls(info, ids, np.load(os.path.join(store_dir, "token_ids.npy"), mmap_mode="r" if mmap else None),
+                   np.load(os.path.join(store_dir, "chunk_indptr.npy")),
+                   np.load(os.path.join(store_dir, "post_indptr.npy")))
+
+    @property
+    def num_chunks(self):
+        return len(self.chunk_indptr) - 1
+
+    @property
+    def chunk_lengths(self):
+        """
+        Number of tokens of each chunk.
+        """
+        return np.diff(self.chunk_indptr)
+
+    @property
+    def chunk_posts(self):
+        """
+        Index of the post each chunk belongs to.
+        """
+        return np.repeat(np.arange(len(self.ids)), np.diff(self.post_indptr))
+
+    def chunk(self, idx):
+        """
+        Token ids of chunk idx (as int64).
+        """
+        return np.asarray(self.token_ids[self.chunk_indptr[idx]:self.chunk_indptr[idx + 1]], dtype=np.int64)
+
+    def matches(self, tokenizer_name, max_length, chunk_size=CHUNK_WORDS, stride=CHUNK_STRIDE):
+        """
+        Whether the store was built with these settings (if not, it should be rebuilt).
+        """
+        return (self.info["tokenizer"], self.info["max_length"], self.info["chunk_words"], self.info["stride"]) == \
+            (tokenizer_name, max_length, chunk_size, stride)
+
+
+def load_or_build_token_store(store_dir, ids, words, tokenizer, tokenizer_name, max_length=512,
+                              chunk_size=CHUNK_WORDS, stride=CHUNK_STRIDE, batch_size=1000):
+    """
+    Load token store from store_dir if it was built for the same posts and settings, and otherwise build it.
+    :param batch_size: number of chunks passed to the tokenizer at a time when building the store
+    """
+    if os.path.exists(os.path.join(store_dir, "info.json")):
+        store = TokenStore.load(store_dir)
+        if store.matches(tokenizer_name, max_length, chunk_size=chunk_size, stride=stride) and \
+                store.ids == [str(post_id) for post_id in ids]:
+            return store
+        print("token store at {} is out of date. rebuilding.".format(store_dir))
+    return build_token_store(store_dir, ids, words, tokenizer, tokenizer_name, max_length=max_length,
+                             chunk_size=chunk_size, stride=stride, batch_size=batch_size)
+
+
+class ChunkDataset(torch.utils.data.Dataset):
+    """
+    Dataset of the chunks of a token store. Items are dicts with the chunk's 'input_ids', its index ('chunk'), the
+    index of its post ('post') and, if labels are given, the post's 'label'.
+    """
+    def __init__(self, store, labels=None, chunks=None):
+        """
+        :param store: TokenStore
+        :param labels: array with label of each post of store
+        :param chunks: indices of chunks to include (e.g. the chunks of the training posts); default is all chunks
+        """
+        self.store = store
+        self.labels = labels
+        self.chunks = np.arange(store.num_chunks) if chunks is None else np.asarray(chunks)
+        self.posts = store.chunk_posts[self.chunks]
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __getitem__(self, idx):
+        item = {"input_ids": self.store.chunk(self.chunks[idx]), "chunk": int(self.chunks[idx]),
+                "post": int(self.posts[idx])}
+        if self.labels is not None:
+            item["label"] = self.labels[self.posts[idx]]
+        return item
+
+    @property
+    def lengths(self):
+        return self.store.chunk_lengths[self.chunks]
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler that puts items of similar length in the same batch, so little padding is needed.
+    With shuffle=True, items are shuffled, split into pools of batch_size * pool_batches items, and each pool is sorted
+    by length and cut into batches (then the order of the batches is shuffled). With shuffle=False, all items are
+    sorted by length (for inference).
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, pool_batches=50, drop_last=False, seed=None):
+        """
+        :param lengths: length of each item (e.g. ChunkDataset.lengths)
+        """
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_batches = pool_batches
+        self.drop_last = drop_last
+        self.rng = np.random.default_rng(seed)
+
+    def __iter__(self):
+        if self.shuffle:
+            order = self.rng.permutation(len(self.lengths))
+            pool_size = self.batch_size * self.pool_batches
+            pools = [order[start:start + pool_size] for start in range(0, len(order), pool_size)]
+            order = np.concatenate([pool[np.argsort(self.lengths[pool], kind="stable")] for pool in pools]) \
+                if pools else order
+        else:
+            order = np.argsort(self.lengths, kind="stable")
+        batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class PadCollator:
+    """
+    collate_fn that pads the input ids of a batch to the length of its longest item.
+    :return: dict with 'input_ids' and 'attention_mask' LongTensors of shape (batch size, max length), 'chunk' and
+    'post' LongTensors and (if items have labels) 'label'
+    """
+    def __init__(self, pad_token_id=0):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, items):
+        lens = np.array([len(item["input_ids"]) for item in items])
+        input_ids = np.full((len(items), lens.max(initial=0)), self.pad_token_id, dtype=np.int64)
+        for row, item in enumerate(items):
+            input_ids[row, :lens[row]] = item["input_ids"]
+        batch = {
+            "input_ids": torch.from_numpy(input_ids),
+            "attention_mask": torch.from_numpy((np.arange(input_ids.shape[1]) < lens[:, None]).astype(np.int64)),
+            "chunk": torch.tensor([item["chunk"] for item in items]),
+            "post": torch.tensor([item["post"] for item in items]),
+        }
+        if "label" in items[0]:
+            batch["label"] = torch.tensor([item["label"] for item in items])
+        return batch
+
+
+def make_loader(dataset, batch_size=16, shuffle=True, seed=None, num_workers=0):
+    """
+    DataLoader over dataset with length-bucketed batches and dynamic padding.
+    """
+    return torch.utils.data.DataLoader(dataset, batch_sampler=BucketBatchSampler(dataset.lengths, batch_size,
+                                                                                  shuffle=shuffle, seed=seed),
+                                       collate_fn=PadCollator(dataset.store.pad_token_id), num_workers=num_workers)
+
+
+def read_processed_posts(data_paths, min_text_chars=10):
+    """
+    Read processed_posts.csv files (see data_processor.TextProcessor).
+    :param min_text_chars: leave out posts whose processed text is shorter than this (as in the notebooks)
+    """
+    data_df = pd.concat([pd.read_csv(data_path, index_col=0, dtype={"id": str}) for data_path in data_paths])
+    return data_df[data_df["processed_text"].str.len() > min_text_chars].reset_index(drop=True)
+
+
+def _lens_to_indptr(lens):
+    indptr = np.zeros(len(lens) + 1, dtype=np.int64)
+    np.cumsum(lens, out=indptr[1:])
+    return indptr
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_paths", type=str, nargs="+", help="Paths to processed_posts.csv files.")
+    parser.add_argument("--store_dir", type=str, help="Path to directory to save token store to.")
+    parser.add_argument("--tokenizer", type=str, default="distilbert-base-uncased",
+                        help="Name or path of Hugging Face tokenizer.")
+    parser.add_argument("--max_length", type=int, default=512, help="Maximum number of tokens per chunk.")
+    parser.add_argument("--batch_size", type=int, default=1000, help="Number of chunks tokenized at a time.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    from transformers import AutoTokenizer
+    args = _parse_args()
+    data_df = read_processed_posts(args.data_paths)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, use_fast=True)
+    words = post_words(data_df["processed_title"], data_df["processed_text"])
+    store = load_or_build_token_store(args.store_dir, data_df["id"], words, tokenizer, args.tokenizer,
+                                      max_length=args.max_length, batch_size=args.batch_size)
+    lengths = store.chunk_lengths
+    print("tokenized {} posts into {} chunks (mean {:.1f} tokens, max {})".format(
+        len(store.ids), store.num_chunks, lengths.mean() if len(lengths) else 0, lengths.max(initial=0)))
+
+
+if __name__ == "__main__":
+    main()
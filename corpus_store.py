@@ -0,0 +1,214 @@
+"""
+Compact binary on-disk format for corpora created with topic_model_corpus.Corpus.
+
+A corpus is saved to a directory containing:
+* tf_indptr.npy, tf_ids.npy, tf_counts.npy: CSR-style term-frequency arrays. The (term id, tf) pairs of document i
+  are tf_ids[tf_indptr[i]:tf_indptr[i + 1]] and tf_counts[tf_indptr[i]:tf_indptr[i + 1]].
+* token_indptr.npy, token_ids.npy: the (pre-processed) token list of each document, stored as ids into tokens.txt
+  with the same offset scheme. Unlike the term ids, these cover every token (including those left out of the vocab).
+* tokens.txt: token types, one per line
+* meta.csv: 'id', 'subreddit' and 'type' of each document
+* info.json: number of documents/terms and format version
+
+The arrays are saved as .npy files, so they can be memory-mapped rather than read into RAM.
+"""
+import ast
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+META_COLUMNS = ['id', 'subreddit', 'type']
+_ARRAY_NAMES = ['tf_indptr', 'tf_ids', 'tf_counts', 'token_indptr', 'token_ids']
+
+
+def corpus_store_path(corpus_dir, corpus_name):
+    """
+    Path of the binary corpus directory for corpus_name (the binary counterpart of <corpus_name>_corpus.csv)
+    """
+    return os.path.join(corpus_dir, "{}_corpus".format(corpus_name))
+
+
+def save_corpus_store(store_dir, meta_df, docs, doc_tf_list, num_terms=None):
+    """
+    Save corpus in binary format.
+    :param store_dir: directory to save corpus to (created if it doesn't exist)
+    :param meta_df: pandas DataFrame with 'id', 'subreddit' and 'type' columns (one row per document)
+    :param docs: list of documents, where each document is a list of words (strs)
+    :param doc_tf_list: list of document term-frequency lists, where each tf-list is a list of (term id, tf) tuples,
+                        or scipy.sparse.csr_matrix of term frequencies with one row per document
+    :param num_terms: size of the vocab the term ids refer to. If None, inferred from the largest term id.
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    token_lens = [len(doc) for doc in docs]
+    # token types are numbered in order of first occurrence
+    token_ids, token_types = pd.factorize(np.array([word for doc in docs for word in doc], dtype=object))
+    if hasattr(doc_tf_list, 'indptr'):
+        tf_indptr = doc_tf_list.indptr.astype(np.int64)
+        tf_ids, tf_counts = doc_tf_list.indices, doc_tf_list.data
+    else:
+        tf_indptr = _lens_to_indptr([len(doc_tf) for doc_tf in doc_tf_list])
+        tf_ids = [term_id for doc_tf in doc_tf_list for term_id, _ in doc_tf]
+        tf_counts = [count for doc_tf in doc_tf_list for _, count in doc_tf]
+    assert len(token_lens) == len(tf_indptr) - 1 == len(meta_df), \
+        "docs, tf-lists and metadata must have the same length"
+    arrays = {
+        'tf_indptr': tf_indptr,
+        'tf_ids': np.asarray(tf_ids, dtype=np.int32),
+        'tf_counts': np.asarray(tf_counts, dtype=np.int32),
+        'token_indptr': _lens_to_indptr(token_lens),
+        'token_ids': token_ids.astype(np.int32),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(store_dir, "{}.npy".format(name)), array)
+    with open(os.path.join(store_dir, "tokens.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(token_types))
+    meta_df[META_COLUMNS].to_csv(os.path.join(store_dir, "meta.csv"), index=False)
+    if num_terms is None:
+        num_terms = int(arrays['tf_ids'].max()) + 1 if len(arrays['tf_ids']) else 0
+    info = {'format_version': FORMAT_VERSION, 'num_docs': len(meta_df), 'num_terms': num_terms,
+            'num_tokens': len(token_ids)}
+    with open(os.path.join(store_dir, "info.json"), "w") as f:
+        json.dump(info, f)
+
+
+def load_corpus(corpus_dir, corpus_name, mmap=True):
+    """
+    Load corpus saved by Corpus.save_corpus.
+    Uses the binary format if it exists, and otherwise falls back to parsing <corpus_name>_corpus.csv.
+    :param corpus_dir: directory corpus was saved to
+    :param corpus_name: name of corpus used in naming saved files
+    :param mmap: if True, memory-map the arrays of the binary format instead of reading them into memory
+    :return: CorpusStore
+    """
+    store_dir = corpus_store_path(corpus_dir, corpus_name)
+    if os.path.exists(os.path.join(store_dir, "info.json")):
+        return CorpusStore.load(store_dir, mmap=mmap)
+    return CorpusStore.from_csv(os.path.join(corpus_dir, "{}_corpus.csv".format(corpus_name)))
+
+
+class CorpusStore:
+    """
+    Read-only corpus of documents stored as flat arrays (see module docstring for the layout).
+    """
+    def __init__(self, meta_df, tokens, tf_indptr, tf_ids, tf_counts, token_indptr, token_ids, num_terms):
+        """
+        :param meta_df: pandas DataFrame with 'id', 'subreddit' and 'type' of each document
+        :param tokens: list of token types that token_ids refer to
+        :param num_terms: size of vocab that tf_ids refer to
+        """
+        self.meta_df = meta_df
+        self.tokens = tokens
+        self.tf_indptr = tf_indptr
+        self.tf_ids = tf_ids
+        self.tf_counts = tf_counts
+        self.token_indptr = token_indptr
+        self.token_ids = token_ids
+        self.num_terms = num_terms
+
+    @classmethod
+    def load(cls, store_dir, mmap=True):
+        """
+        Load corpus saved with save_corpus_store.
+        :param mmap: if True, memory-map arrays instead of reading them into memory
+        """
+        with open(os.path.join(store_dir, "info.json")) as f:
+            info = json.load(f)
+        assert info['format_version'] == FORMAT_VERSION, "unsupported corpus format version"
+        mmap_mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(store_dir, "{}.npy".format(name)), mmap_mode=mmap_mode)
+                  for name in _ARRAY_NAMES}
+        with open(os.path.join(store_dir, "tokens.txt"), "r", encoding="utf-8") as f:
+            tokens = f.read().split("\n") if info['num_tokens'] else []
+        # keep_default_na=False --> otherwise ids such as 'nan' get read in as floats
+        meta_df = pd.read_csv(os.path.join(store_dir, "meta.csv"), dtype=str, keep_default_na=False)
+        return cls(meta_df, tokens, num_terms=info['num_terms'], **arrays)
+
+    @classmethod
+    def from_csv(cls, corpus_path):
+        """
+        Build corpus (in memory) from a <corpus_name>_corpus.csv file written by Corpus.save_corpus.
+        """
+        corpus_df = pd.read_csv(corpus_path, index_col=0)
+        # convert from strings to literal form
+        docs = [ast.literal_eval(x) for x in corpus_df["text"]]
+        doc_tf_list = [ast.literal_eval(x) for x in corpus_df["tf"]]
+        token2id = {}
+        token_ids = [token2id.setdefault(word, len(token2id)) for doc in docs for word in doc]
+        tf_ids = [term_id for doc_tf in doc_tf_list for term_id, _ in doc_tf]
+        tf_counts = [count for doc_tf in doc_tf_list for _, count in doc_tf]
+        tf_ids = np.array(tf_ids, dtype=np.int32)
+        return cls(corpus_df[META_COLUMNS].reset_index(drop=True), list(token2id),
+                   tf_indptr=_lens_to_indptr([len(doc_tf) for doc_tf in doc_tf_list]),
+                   tf_ids=tf_ids,
+                   tf_counts=np.array(tf_counts, dtype=np.int32),
+                   token_indptr=_lens_to_indptr([len(doc) for doc in docs]),
+                   token_ids=np.array(token_ids, dtype=np.int32),
+                   num_terms=int(tf_ids.max()) + 1 if len(tf_ids) else 0)
+
+    def __len__(self):
+        return len(self.tf_indptr) - 1
+
+    def doc_tf(self, idx):
+        """
+        Term-frequency list of document idx, as a list of (term id, tf) tuples (same format as Dictionary.doc2bow).
+        """
+        start, end = self.tf_indptr[idx], self.tf_indptr[idx + 1]
+        return list(zip(self.tf_ids[start:end].tolist(), self.tf_counts[start:end].tolist()))
+
+    def doc_tokens(self, idx):
+        """
+        Pre-processed text of document idx, as a list of words.
+        """
+        start, end = self.token_indptr[idx], self.token_indptr[idx + 1]
+        return [self.tokens[token_id] for token_id in self.token_ids[start:end].tolist()]
+
+    def bow_corpus(self):
+        """
+        Streamed term-frequency corpus that can be passed to gensim models in place of a list of tf-lists.
+        """
+        return BowCorpus(self)
+
+    def docs(self):
+        """
+        Pre-processed text of every document, as a list of lists of words.
+        """
+        tokens = np.array(self.tokens, dtype=object)
+        words = tokens[np.asarray(self.token_ids)] if len(tokens) else np.array([], dtype=object)
+        indptr = np.asarray(self.token_indptr)
+        return [words[indptr[i]:indptr[i + 1]].tolist() for i in range(len(self))]
+
+    def tf_matrix(self):
+        """
+        Term-frequency matrix as a scipy.sparse.csr_matrix of shape (# docs, # terms).
+        """
+        import scipy.sparse
+        return scipy.sparse.csr_matrix((self.tf_counts, self.tf_ids, self.tf_indptr),
+                                       shape=(len(self), self.num_terms))
+
+
+class BowCorpus:
+    """
+    Iterable over the term-frequency lists of a CorpusStore that doesn't hold them all in memory at once.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __iter__(self):
+        for idx in range(len(self.store)):
+            yield self.store.doc_tf(idx)
+
+    def __getitem__(self, idx):
+        return self.store.doc_tf(idx)
+
+
+def _lens_to_indptr(lens):
+    indptr = np.zeros(len(lens) + 1, dtype=np.int64)
+    np.cumsum(lens, out=indptr[1:])
+    return indptr
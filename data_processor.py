@@ -2,135 +2,212 @@
 Preprocess Reddit post data
 """
 
+import os
+
 import numpy as np
 import pandas as pd
 
-from text_utils import process_single_post_text
+from instrumentation import stage
+from text_utils import LemmaTable, process_texts
+
+
+DEL_LIST = ['[removed]', '[deleted]']
 
 
-class PostProcessor:
+class _RedditProcessor:
     """
-    Class to read and process Reddit post data.
+    Shared reading and filtering of Reddit posts/comments. Subclasses set:
+    * keep_columns: columns to keep
+    * dtypes: compact dtypes of (non-string) columns, used when reading in streaming mode
+    * text_column: column with text content
     """
-    def __init__(self, data_path, moderators_path):
+    keep_columns = []
+    dtypes = {}
+    text_column = None
+
+    def __init__(self, data_path, moderators_path, stream=False):
         """
         :param data_path: path to CSV file with dataset
         :param moderators_path: path to text file with list of moderators
-
-        This class contains functions to (1) filter posts according to the steps described below and
-        (2) randomly assign posts to a train/test/val split.
-
-        Current post filtering steps are:
-        * remove posts made by moderators
-        * remove posts that have been removed by moderators or deleted (including those without authors)
-        * remove posts without any 'selftext'/post text
+        :param stream: if True, don't read dataset into memory (use stream_filter to filter it chunk by chunk)
         """
-        self.data_df = pd.read_csv(data_path, index_col=0)
+        self.data_path = data_path
+        self.data_df = None if stream else pd.read_csv(data_path, index_col=0)
         self.moderators_path = moderators_path
         with open(self.moderators_path, 'r') as f:
             self.moderators = set(f.read().splitlines())
 
     def filter(self):
-        keep_columns = [
-            # id and other metadata
-            'id',
-            'created_utc',
-            'author',
-            'author_fullname',
-            'author_flair_text',
-            'url',
-            # text
-            'title',
-            'selftext',
-            # measures of post feedback (what we want to predict)
-            'upvote_ratio',
-            'score',
-            'num_comments'
-        ]
-        self.data_df = self.data_df[keep_columns]
+        with stage("filter_{}".format(self.text_column), docs=len(self.data_df)) as stats:
+            self.data_df = self._filter_df(self.data_df[self.keep_columns])
+            stats.info["kept"] = len(self.data_df)
 
+    def _filter_df(self, data_df):
         # exclude posts from moderators
-        self.data_df = self.data_df[~self.data_df["author"].isin(self.moderators)]
+        data_df = data_df[~data_df["author"].isin(self.moderators)]
 
         # exclude deleted/removed posts
-        del_list = ['[removed]', '[deleted]']
-        self.data_df = self.data_df[~self.data_df["selftext"].isin(del_list)]
+        data_df = data_df[~data_df[self.text_column].isin(DEL_LIST)]
 
         # exclude posts without an author (this means they have been removed/deleted) and those without any text
-        self.data_df = self.data_df[self.data_df["selftext"].notnull()]
-        self.data_df = self.data_df[self.data_df["author"].notnull()]
+        data_df = data_df[data_df[self.text_column].notnull()]
+        data_df = data_df[data_df["author"].notnull()]
+        return data_df
 
-    def assign_datasplit(self, train_frac=.6, val_frac=.2, test_frac=.2):
-        assert train_frac + val_frac + test_frac == 1, "invalid data split fractions specified; must sum to 1"
-        data_len = len(self.data_df)
-        train_count = int(data_len * train_frac)
-        val_count = int(data_len * val_frac)
-        test_count = data_len - train_count - val_count
-        assignments = ["train"] * train_count + ["val"] * val_count + ["test"] * test_count
-        np.random.shuffle(assignments)
-        self.data_df["data_split"] = assignments
+    def read_chunks(self, chunksize=100000):
+        """
+        Read dataset in chunks of chunksize rows, keeping only the index column and keep_columns.
+        :return: iterator over pandas DataFrames
+        """
+        index_column = pd.read_csv(self.data_path, nrows=0).columns[0]
+        # str for text/id columns; otherwise strings such as 'nan' would be read as floats
+        dtypes = {column: self.dtypes.get(column, str) for column in self.keep_columns}
+        return pd.read_csv(self.data_path, index_col=0, usecols=[index_column] + self.keep_columns, dtype=dtypes,
+                           chunksize=chunksize)
+
+    def stream_filter(self, output_path, chunksize=100000):
+        """
+        Filter dataset chunk by chunk and write the rows that are kept to output_path, so memory use is bounded by
+        chunksize rather than the size of the dataset. Gives the same rows as filter() followed by
+        data_df.to_csv(output_path).
+        :return: number of rows kept
+        """
+        num_kept = 0
+        with stage("stream_filter_{}".format(self.text_column), docs=0) as stats:
+            for i, chunk in enumerate(self.read_chunks(chunksize)):
+                stats.docs += len(chunk)
+                chunk = self._filter_df(chunk[self.keep_columns])
+                chunk.to_csv(output_path, mode='w' if i == 0 else 'a', header=i == 0)
+                num_kept += len(chunk)
+            stats.info["kept"] = num_kept
+        return num_kept
+
+
+class PostProcessor(_RedditProcessor):
+    """
+    Class to read and process Reddit post data.
+    """
+    keep_columns = [
+        # id and other metadata
+        'id',
+        'created_utc',
+        'author',
+        'author_fullname',
+        'author_flair_text',
+        'url',
+        # text
+        'title',
+        'selftext',
+        # measures of post feedback (what we want to predict)
+        'upvote_ratio',
+        'score',
+        'num_comments'
+    ]
+    dtypes = {'created_utc': 'Int64', 'upvote_ratio': 'float32', 'score': 'Int32', 'num_comments': 'Int32'}
+    text_column = 'selftext'
+
+    def __init__(self, data_path, moderators_path, stream=False):
+        """
+        :param data_path: path to CSV file with dataset
+        :param moderators_path: path to text file with list of moderators
+        :param stream: if True, don't read dataset into memory (use stream_filter to filter it chunk by chunk)
+
+        This class contains functions to (1) filter posts according to the steps described below and
+        (2) randomly assign posts to a train/test/val split.
+
+        Current post filtering steps are:
+        * remove posts made by moderators
+        * remove posts that have been removed by moderators or deleted (including those without authors)
+        * remove posts without any 'selftext'/post text
+        """
+        super().__init__(data_path, moderators_path, stream=stream)
 
+    def assign_datasplit(self, train_frac=.6, val_frac=.2, test_frac=.2):
+        self.data_df["data_split"] = _datasplit_assignments(len(self.data_df), train_frac, val_frac, test_frac)
 
-class CommentProcessor:
+    def stream_filter(self, output_path, chunksize=100000, assign_datasplit=False, train_frac=.6, val_frac=.2,
+                      test_frac=.2):
+        """
+        Same as _RedditProcessor.stream_filter, but can also assign the posts that are kept to a train/test/val split
+        (this takes a second pass over the filtered posts, as the split depends on how many posts are kept).
+        """
+        num_kept = super().stream_filter(output_path, chunksize=chunksize)
+        if assign_datasplit:
+            assignments = _datasplit_assignments(num_kept, train_frac, val_frac, test_frac)
+            tmp_path = "{}.tmp".format(output_path)
+            offset = 0
+            for i, chunk in enumerate(pd.read_csv(output_path, index_col=0, dtype=str, keep_default_na=False,
+                                                  chunksize=chunksize)):
+                chunk["data_split"] = assignments[offset:offset + len(chunk)]
+                offset += len(chunk)
+                chunk.to_csv(tmp_path, mode='w' if i == 0 else 'a', header=i == 0)
+            os.replace(tmp_path, output_path)
+        return num_kept
+
+
+class CommentProcessor(_RedditProcessor):
     """
     Class to read and process Reddit comment.
     """
-    def __init__(self, data_path, moderators_path):
+    keep_columns = [
+        # id and other metadata
+        'id',
+        'parent_id',
+        'created_utc',
+        'author',
+        'author_fullname',
+        'author_flair_text',
+        'permalink',
+        # text
+        'body',
+        # measures of comment feedback
+        'score',
+        'ups',
+        'downs',
+        'controversiality'
+    ]
+    dtypes = {'created_utc': 'Int64', 'score': 'Int32', 'ups': 'Int32', 'downs': 'Int32', 'controversiality': 'Int8'}
+    text_column = 'body'
+
+    def __init__(self, data_path, moderators_path, stream=False):
         """
         :param data_path: path to CSV file with dataset
         :param moderators_path: path to text file with list of moderators
+        :param stream: if True, don't read dataset into memory (use stream_filter to filter it chunk by chunk)
 
         Function to apply the following filtering steps:
         * remove posts made by moderators
         * remove posts that have been removed by moderators or deleted (including those without authors)
         * remove posts without any 'body' (i.e. text content of comment)
         """
-        self.data_df = pd.read_csv(data_path, index_col=0)
-        self.moderators_path = moderators_path
-        with open(self.moderators_path, 'r') as f:
-            self.moderators = set(f.read().splitlines())
+        super().__init__(data_path, moderators_path, stream=stream)
 
-    def filter(self):
-        keep_columns = [
-            # id and other metadata
-            'id',
-            'parent_id',
-            'created_utc',
-            'author',
-            'author_fullname',
-            'author_flair_text',
-            'permalink',
-            # text
-            'body',
-            # measures of comment feedback
-            'score',
-            'ups',
-            'downs',
-            'controversiality'
-        ]
-        self.data_df = self.data_df[keep_columns]
-
-        # exclude posts from moderators
-        self.data_df = self.data_df[~self.data_df["author"].isin(self.moderators)]
 
-        # exclude deleted/removed posts
-        del_list = ['[removed]', '[deleted]']
-        self.data_df = self.data_df[~self.data_df["body"].isin(del_list)]
-
-        # exclude posts without an author (this means they have been removed/deleted) and those without any text
-        self.data_df = self.data_df[self.data_df["body"].notnull()]
-        self.data_df = self.data_df[self.data_df["author"].notnull()]
+def _datasplit_assignments(data_len, train_frac=.6, val_frac=.2, test_frac=.2):
+    assert train_frac + val_frac + test_frac == 1, "invalid data split fractions specified; must sum to 1"
+    train_count = int(data_len * train_frac)
+    val_count = int(data_len * val_frac)
+    test_count = data_len - train_count - val_count
+    assignments = ["train"] * train_count + ["val"] * val_count + ["test"] * test_count
+    np.random.shuffle(assignments)
+    return assignments
 
 
 class TextProcessor:
     """
     Class to read and process Reddit text
     """
-    def __init__(self, data_path, lemmatize=True, remove_stops=True):
+    def __init__(self, data_path, lemmatize=True, remove_stops=True, n_process=1, batch_size=1000,
+                 lemma_table_path=None, lemma_table_by_tag=False):
         """
         :param data_path: path to CSV file with dataset
         :param lemmatize: if True, apply lemmatization when pre-processing text
+        :param lemma_table_path: optional path to text_utils.LemmaTable file to look lemmas up in (created if it doesn't
+                                 exist, and saved with any new words)
+        :param lemma_table_by_tag: if True, the lemma table also records lemmas by part-of-speech tag
         :param remove_stops: if True, remove stopwords
+        :param n_process: number of worker processes to use when pre-processing text
+        :param batch_size: number of posts/sentences handled per batch when pre-processing text
 
         Current text pre-processing steps
         * Remove special characters and punctuation
@@ -149,17 +226,25 @@ class TextProcessor:
         self.data_df = pd.read_csv(data_path, index_col=0)
         self.lemmatize = lemmatize
         self.remove_stops = remove_stops
+        self.n_process = n_process
+        self.batch_size = batch_size
+        self.lemma_table_path = lemma_table_path
+        self.lemma_table_by_tag = lemma_table_by_tag
 
     def process_text(self):
         # process text for each title and post
-        process_text_list = []
-        process_title_list = []
-        for idx, row in self.data_df.iterrows():
-            process_text_list.append(process_single_post_text(row['selftext'],
-                                                              do_lemmatize=self.lemmatize,
-                                                              remove_stops=self.remove_stops))
-            process_title_list.append(process_single_post_text(row['title'],
-                                                               do_lemmatize=self.lemmatize,
-                                                               remove_stops=self.remove_stops))
-        self.data_df["processed_text"] = process_text_list
-        self.data_df["processed_title"] = process_title_list
+        with stage("process_post_text", docs=len(self.data_df), n_process=self.n_process) as stats:
+            lemma_table = None
+            if self.lemmatize and self.lemma_table_path:
+                lemma_table = LemmaTable.load_or_create(self.lemma_table_path, by_tag=self.lemma_table_by_tag)
+            self.data_df["processed_text"] = process_texts(self.data_df['selftext'], do_lemmatize=self.lemmatize,
+                                                           remove_stops=self.remove_stops, n_process=self.n_process,
+                                                           batch_size=self.batch_size, lemma_table=lemma_table)
+            self.data_df["processed_title"] = process_texts(self.data_df['title'], do_lemmatize=self.lemmatize,
+                                                            remove_stops=self.remove_stops, n_process=self.n_process,
+                                                            batch_size=self.batch_size, lemma_table=lemma_table)
+            if lemma_table is not None:
+                lemma_table.save(self.lemma_table_path)
+                stats.info["lemma_hit_rate"] = round(lemma_table.hit_rate, 4)
+            stats.tokens = sum(len(sent) for column in ["processed_text", "processed_title"]
+                               for doc in self.data_df[column] for sent in doc)
@@ -0,0 +1,198 @@
+"""
+Cluster post/comment embeddings and summarize the clusters.
+
+Clustering uses mini-batch k-means fit on blocks of the embedding matrix, so it can be run over a memory-mapped
+embedding store (see embedding_store.py) that doesn't fit in memory. Cluster statistics, exemplars and breakdowns are
+computed for all clusters at once with grouped operations.
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+from embedding_store import EmbeddingStore
+
+
+def fit_clusters(embeddings, n_clusters=10, block_size=8192, n_epochs=3, seed=None):
+    """
+    Fit mini-batch k-means to embeddings, one block of rows at a time.
+    Rows are often grouped (e.g. by subreddit), so centers are initialized with k-means++ on a random sample of rows
+    from the whole matrix, and each block is a random sample of rows rather than a contiguous range.
+    :param embeddings: array of shape (# rows, dim), e.g. EmbeddingStore.embeddings
+    :param n_clusters: number of clusters
+    :param block_size: number of rows read (and passed to partial_fit) at a time
+    :param n_epochs: number of passes over embeddings
+    :param seed: random seed for the initialization sample, block contents and center initialization
+    :return: fitted sklearn MiniBatchKMeans
+    """
+    rng = np.random.default_rng(seed)
+    num_rows = len(embeddings)
+    # blocks (and the initialization sample) must have at least n_clusters rows
+    block_size = max(block_size, n_clusters)
+    init_rows = np.sort(rng.choice(num_rows, size=min(num_rows, max(block_size, 10 * n_clusters)), replace=False))
+    init_centers = KMeans(n_clusters=n_clusters, init="k-means++", n_init=3, random_state=seed).fit(
+        np.asarray(embeddings[init_rows], dtype=np.float32)).cluster_centers_
+    k_means = MiniBatchKMeans(n_clusters=n_clusters, init=init_centers, batch_size=block_size, random_state=seed,
+                              n_init=1)
+    bounds = np.arange(0, num_rows, block_size).tolist() + [num_rows]
+    if len(bounds) > 2 and bounds[-1] - bounds[-2] < n_clusters:
+        # merge short last block into the previous one
+        del bounds[-2]
+    for _ in range(n_epochs):
+        order = rng.permutation(num_rows)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            # sorted, so that rows are read from a memory-mapped file in order
+            k_means.partial_fit(np.asarray(embeddings[np.sort(order[start:end])], dtype=np.float32))
+    return k_means
+
+
+def assign_clusters(k_means, embeddings, block_size=65536):
+    """
+    Get the cluster of each row and its (euclidean) distance to the cluster center.
+    :return: labels: array of cluster indices, distances: array of distances to own cluster center
+    """
+    centers = k_means.cluster_centers_.astype(np.float32)
+    center_sq_norms = (centers ** 2).sum(axis=1)
+    labels, distances = [], []
+    for start in range(0, len(embeddings), block_size):
+        block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+        # squared distances to all centers: |x|^2 - 2 x.c + |c|^2
+        sq_dists = (block ** 2).sum(axis=1)[:, None] - 2 * block @ centers.T + center_sq_norms
+        block_labels = np.argmin(sq_dists, axis=1)
+        labels.append(block_labels)
+        distances.append(np.sqrt(np.maximum(np.take_along_axis(sq_dists, block_labels[:, None], axis=1)[:, 0], 0)))
+    if not labels:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    return np.concatenate(labels), np.concatenate(distances)
+
+
+def cluster_stats(labels, values_df, n_clusters):
+    """
+    Mean, standard deviation (ddof=0, as np.std) and median of each column of values_df within each cluster.
+    :param labels: array with cluster of each row
+    :param values_df: pandas DataFrame with numeric columns (one row per embedding row)
+    :param n_clusters: number of clusters (clusters without rows get NaN stats)
+    :return: pandas DataFrame with one row per cluster and (stat, column) columns, plus a 'size' column
+    """
+    grouped = values_df.reset_index(drop=True).groupby(labels)
+    stats_df = pd.concat({"mean": grouped.mean(), "std": grouped.std(ddof=0), "median": grouped.median()}, axis=1)
+    stats_df = stats_df.reindex(range(n_clusters))
+    stats_df.insert(0, "size", np.bincount(labels, minlength=n_clusters))
+    stats_df.index.name = "cluster"
+    return stats_df
+
+
+def cluster_exemplars(labels, distances, n_per_cluster=3):
+    """
+    Rows closest to the center of each cluster.
+    :return: pandas DataFrame with 'cluster', 'rank', 'row' and 'distance' columns
+    """
+    order = np.lexsort((distances, labels))
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]]) if len(order) else np.zeros(0, int)
+    counts = np.diff(np.r_[starts, len(order)])
+    ranks = np.arange(len(order)) - np.repeat(starts, counts)
+    keep = ranks < n_per_cluster
+    return pd.DataFrame({
+        "cluster": sorted_labels[keep],
+        "rank": ranks[keep] + 1,
+        "row": order[keep],
+        "distance": distances[order][keep],
+    })
+
+
+def cluster_breakdown(labels, categories, n_clusters, normalize=True):
+    """
+    Share (or count) of each category (e.g. subreddit or max topic) within each cluster.
+    :return: pandas DataFrame with one row per cluster and one column per category
+    """
+    breakdown_df = pd.crosstab(pd.Categorical(labels, categories=range(n_clusters)), np.asarray(categories),
+                               normalize="index" if normalize else False, dropna=False)
+    breakdown_df.index.name = "cluster"
+    return breakdown_df
+
+
+def cluster_topic_profile(labels, topic_dists, n_clusters):
+    """
+    Mean topic distribution of the rows in each cluster.
+    :param labels: array with cluster of each row
+    :param topic_dists: array of shape (# rows, # topics)
+    :param n_clusters: number of clusters (clusters without rows get NaN)
+    :return: array of shape (n_clusters, # topics)
+    """
+    topic_dists = np.asarray(topic_dists, dtype=np.float64)
+    sums = np.zeros((n_clusters, topic_dists.shape[1]))
+    np.add.at(sums, labels, topic_dists)
+    counts = np.bincount(labels, minlength=n_clusters)
+    return sums / np.where(counts > 0, counts, np.nan)[:, None]
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store_dir", type=str, help="Path to embedding store (see embedding_store.py).")
+    parser.add_argument("--data_path", type=str, default=None,
+                        help="Optional CSV file with more per-post data (e.g. output of "
+                             "get_comment_topic_dists_for_posts.py), merged with the store metadata on 'id'.")
+    parser.add_argument("--output_dir", type=str, help="Path to directory to save cluster assignments and stats to.")
+    parser.add_argument("--n_clusters", type=int, default=10, help="Number of clusters.")
+    parser.add_argument("--n_epochs", type=int, default=3, help="Number of passes over embeddings when fitting.")
+    parser.add_argument("--stat_columns", type=str, nargs="+", default=["num_comments", "prediction"],
+                        help="Numeric columns to compute per-cluster stats for.")
+    parser.add_argument("--breakdown_columns", type=str, nargs="+", default=["subreddit", "max_mean_topic"],
+                        help="Categorical columns to compute per-cluster breakdowns for.")
+    parser.add_argument("--topic_column", type=str, default="mean_topic_dist",
+                        help="Column with a topic distribution per post (e.g. from --data_path), to compute the mean "
+                             "topic distribution of each cluster from.")
+    parser.add_argument("--num_exemplars", type=int, default=3, help="Number of exemplars to save per cluster.")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """
+    Cluster the embeddings in an embedding store and save cluster assignments, stats, exemplars, breakdowns and
+    topic profiles.
+    """
+    args = _parse_args()
+    store = EmbeddingStore(args.store_dir)
+    meta_df = store.metadata
+    if args.data_path:
+        data_df = pd.read_csv(args.data_path, index_col=0, dtype={"id": str})
+        data_df = data_df.drop(columns=[c for c in data_df.columns if c in meta_df.columns and c != "id"])
+        meta_df = meta_df.merge(data_df.drop_duplicates(subset="id"), how="left", on="id")
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    k_means = fit_clusters(store.embeddings, n_clusters=args.n_clusters, n_epochs=args.n_epochs, seed=args.seed)
+    labels, distances = assign_clusters(k_means, store.embeddings)
+    pd.DataFrame({"id": store.ids, "cluster": labels, "distance": distances}).to_csv(
+        os.path.join(args.output_dir, "cluster_assignments.csv"), index=False)
+
+    stat_columns = [c for c in args.stat_columns if c in meta_df.columns]
+    cluster_stats(labels, meta_df[stat_columns], args.n_clusters).to_csv(
+        os.path.join(args.output_dir, "cluster_stats.csv"))
+    exemplars_df = cluster_exemplars(labels, distances, args.num_exemplars)
+    exemplars_df.insert(3, "id", np.array(store.ids, dtype=object)[exemplars_df["row"].to_numpy()])
+    exemplars_df.to_csv(os.path.join(args.output_dir, "cluster_exemplars.csv"), index=False)
+    for column in args.breakdown_columns:
+        if column in meta_df.columns:
+            cluster_breakdown(labels, meta_df[column].to_numpy(), args.n_clusters).to_csv(
+                os.path.join(args.output_dir, "cluster_{}_breakdown.csv".format(column)))
+    if args.topic_column in meta_df.columns:
+        # distributions are saved as strings like '[0.1 0.2 ...]' (empty for posts without them)
+        topic_strs = meta_df[args.topic_column].to_numpy()
+        has_topics = np.array([isinstance(x, str) and len(x) > 2 for x in topic_strs], dtype=bool)
+        if has_topics.any():
+            topic_dists = np.stack([np.fromstring(x[1:-1], sep=" ") for x in topic_strs[has_topics]])
+            profile_df = pd.DataFrame(cluster_topic_profile(labels[has_topics], topic_dists, args.n_clusters),
+                                      columns=["topic_{}".format(i) for i in range(topic_dists.shape[1])])
+            profile_df.insert(0, "num_posts", np.bincount(labels[has_topics], minlength=args.n_clusters))
+            profile_df.index.name = "cluster"
+            profile_df.to_csv(os.path.join(args.output_dir, "cluster_topic_profile.csv"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+On-disk store for post/comment embeddings.
+
+A store is a directory containing:
+* embeddings.f32: float32 matrix of shape (# rows, dim), stored as raw row-major bytes so that it can be memory-mapped
+* ids.txt: id of each row, one per line
+* metadata.csv: other per-row data (e.g. predictions and outcomes), with an 'id' column
+* info.json: number of rows, dim, format version and the size of each file
+
+Rows are added in shards with EmbeddingStore.append. info.json is written last, so a shard that was only partially
+written (e.g. because of a crash) is ignored when the store is opened, and overwritten by the next append.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+_EMBEDDINGS_FILE = "embeddings.f32"
+_IDS_FILE = "ids.txt"
+_METADATA_FILE = "metadata.csv"
+_INFO_FILE = "info.json"
+
+
+class EmbeddingStore:
+    """
+    Memory-mapped float32 embedding matrix with an id index and metadata.
+    Slicing (e.g. store[start:end] or store.embeddings) returns views of the memory-mapped file rather than copies.
+    """
+    def __init__(self, store_dir):
+        """
+        :param store_dir: directory of existing store (see EmbeddingStore.create to make a new one)
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, _INFO_FILE)) as f:
+            info = json.load(f)
+        assert info['format_version'] == FORMAT_VERSION, "unsupported embedding store format version"
+        self.dim = info['dim']
+        self.num_rows = info['num_rows']
+        # sizes of the files as of the last complete shard
+        self._file_sizes = info['file_sizes']
+        self._ids = None
+        self._id_index = None
+        self._metadata = None
+        self._embeddings = None
+
+    @classmethod
+    def create(cls, store_dir, dim):
+        """
+        Create empty store for embeddings of size dim.
+        """
+        if os.path.exists(os.path.join(store_dir, _INFO_FILE)):
+            raise ValueError("embedding store already exists at {}".format(store_dir))
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        for name in [_EMBEDDINGS_FILE, _IDS_FILE, _METADATA_FILE]:
+            open(os.path.join(store_dir, name), "w").close()
+        _write_info(store_dir, dim, 0, {name: 0 for name in [_EMBEDDINGS_FILE, _IDS_FILE, _METADATA_FILE]})
+        return cls(store_dir)
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, idx):
+        return self.embeddings[idx]
+
+    @property
+    def embeddings(self):
+        """
+        Read-only memory-mapped matrix of shape (# rows, dim).
+        """
+        if self._embeddings is None:
+            if self.num_rows == 0:
+                self._embeddings = np.zeros((0, self.dim), dtype=np.float32)
+            else:
+                self._embeddings = np.memmap(os.path.join(self.store_dir, _EMBEDDINGS_FILE), dtype=np.float32,
+                                             mode="r", shape=(self.num_rows, self.dim))
+        return self._embeddings
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            with open(os.path.join(self.store_dir, _IDS_FILE), "r", encoding="utf-8") as f:
+                self._ids = f.read().split("\n")[:self.num_rows]
+        return self._ids
+
+    @property
+    def metadata(self):
+        """
+        pandas DataFrame with metadata of each row (in row order).
+        """
+        if self._metadata is None:
+            if self.num_rows == 0:
+                self._metadata = pd.DataFrame({"id": []})
+            else:
+                self._metadata = pd.read_csv(os.path.join(self.store_dir, _METADATA_FILE), nrows=self.num_rows)
+                # use ids from ids.txt --> otherwise ids such as 'nan' get read in as floats
+                self._metadata["id"] = self.ids
+        return self._metadata
+
+    def index_of(self, ids):
+        """
+        Get row positions of ids.
+        :param ids: list of ids
+        :return: numpy array of row positions
+        """
+        if self._id_index is None:
+            self._id_index = pd.Index(self.ids)
+        positions = self._id_index.get_indexer(ids)
+        if (positions < 0).any():
+            missing = [post_id for post_id, pos in zip(ids, positions) if pos < 0]
+            raise KeyError("ids not found in embedding store: {}".format(missing[:10]))
+        return positions
+
+    def get(self, ids):
+        """
+        Get embeddings of ids, as an array of shape (len(ids), dim).
+        """
+        return np.asarray(self.embeddings[self.index_of(ids)])
+
+    def append(self, embeddings, ids, metadata_df=None):
+        """
+        Add shard of embeddings to store.
+        :param embeddings: array of shape (# new rows, dim)
+        :param ids: list of ids of new rows (ids must be unique across the store)
+        :param metadata_df: optional pandas DataFrame with metadata of new rows (same order as ids). Should have the
+                            same columns for every shard.
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        ids = [str(post_id) for post_id in ids]
+        if embeddings.ndim != 2 or embeddings.shape[1] != self.dim:
+            raise ValueError("expected embeddings of shape (# rows, {}), got {}".format(self.dim, embeddings.shape))
+        if len(ids) != len(embeddings):
+            raise ValueError("got {} ids for {} embeddings".format(len(ids), len(embeddings)))
+        if len(set(ids)) != len(ids) or pd.Index(self.ids).isin(ids).any():
+            raise ValueError("ids must be unique across the embedding store")
+        if metadata_df is None:
+            metadata_df = pd.DataFrame(index=range(len(ids)))
+        else:
+            metadata_df = metadata_df.drop(columns=["id"], errors="ignore").reset_index(drop=True)
+        metadata_df.insert(0, "id", ids)
+        # drop anything past the end of the last complete shard (left over from a partially written one)
+        shard_data = [
+            (_EMBEDDINGS_FILE, embeddings.tobytes()),
+            (_IDS_FILE, "".join("{}\n".format(post_id) for post_id in ids).encode("utf-8")),
+            (_METADATA_FILE, metadata_df.to_csv(header=self.num_rows == 0, index=False).encode("utf-8")),
+        ]
+        sizes = {}
+        for name, data in shard_data:
+            path = os.path.join(self.store_dir, name)
+            with open(path, "r+b") as f:
+                f.truncate(self._file_sizes[name])
+                f.seek(0, os.SEEK_END)
+                f.write(data)
+                sizes[name] = f.tell()
+        _write_info(self.store_dir, self.dim, self.num_rows + len(ids), sizes)
+        self.num_rows += len(ids)
+        self._file_sizes = sizes
+        self._ids = self._id_index = self._metadata = self._embeddings = None
+
+
+def _write_info(store_dir, dim, num_rows, file_sizes):
+    info = {'format_version': FORMAT_VERSION, 'dim': dim, 'num_rows': num_rows, 'dtype': 'float32',
+            'file_sizes': file_sizes}
+    tmp_path = os.path.join(store_dir, "{}.tmp".format(_INFO_FILE))
+    with open(tmp_path, "w") as f:
+        json.dump(info, f)
+    os.replace(tmp_path, os.path.join(store_dir, _INFO_FILE))
+
+
+def parse_embedding(in_str):
+    """
+    Parse an embedding saved as a string in a CSV file, either as a list (e.g. '[0.1, 0.2]') or a 1-D numpy array
+    (e.g. '[0.1 0.2]').
+    Raises ValueError for numpy arrays that were printed in summarized form (with '...'), since values are missing.
+    """
+    if "..." in in_str:
+        raise ValueError("embedding was saved in summarized form ('...'), so some of its values are missing; "
+                         "embeddings need to be re-exported as lists or written directly to an embedding store")
+    try:
+        values = json.loads(in_str)
+    except ValueError:
+        values = np.fromstring(in_str.strip()[1:-1], sep=" ")
+    embedding = np.asarray(values, dtype=np.float32)
+    if embedding.ndim != 1:
+        raise ValueError("expected 1-D embedding, got shape {}".format(embedding.shape))
+    return embedding
+
+
+def import_embedding_csv(csv_path, store_dir, id_column="id", embedding_column="embedding", chunksize=10000):
+    """
+    Add embeddings from a CSV file (e.g. the LSTM baseline's post embeddings) to a store, creating it if it doesn't
+    exist. The other columns of the CSV are stored as metadata.
+    :return: EmbeddingStore
+    """
+    store = EmbeddingStore(store_dir) if os.path.exists(os.path.join(store_dir, _INFO_FILE)) else None
+    for chunk in pd.read_csv(csv_path, index_col=0, dtype={id_column: str}, chunksize=chunksize):
+        embeddings = np.stack([parse_embedding(x) for x in chunk[embedding_column]])
+        if store is None:
+            store = EmbeddingStore.create(store_dir, embeddings.shape[1])
+        store.append(embeddings, chunk[id_column].tolist(), chunk.drop(columns=[id_column, embedding_column]))
+    return store
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--csv_paths", type=str, nargs="+", help="Paths to CSV files with 'id' and 'embedding' columns.")
+    parser.add_argument("--store_dir", type=str, help="Path to embedding store directory (created if needed).")
+    parser.add_argument("--chunksize", type=int, default=10000, help="Number of CSV rows to read at a time.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """
+    Convert embedding CSV files into (or append them to) an embedding store.
+    """
+    args = _parse_args()
+    for csv_path in args.csv_paths:
+        store = import_embedding_csv(csv_path, args.store_dir, chunksize=args.chunksize)
+        print("imported {}; store now has {} embeddings of size {}".format(csv_path, len(store), store.dim))
+
+
+if __name__ == "__main__":
+    main()
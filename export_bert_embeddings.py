@@ -0,0 +1,218 @@
+"""
+Export DistilBERT post embeddings to an embedding store (see embedding_store.py), on CPU.
+
+Posts are tokenized once into a token store (see bert_tokens.py), and their chunks are run through the encoder in
+length-sorted batches under torch.no_grad, so batches need little padding. Chunk vectors (the masked mean of the last
+hidden states, or the [CLS] vector) are averaged into one embedding per post, and posts are embedded and appended to
+the store in shards, so an interrupted export continues from the last complete shard when it is rerun.
+
+The encoder can be the pre-trained DistilBERT model, a fine-tuned checkpoint from the BERT notebooks (--checkpoint), or
+a tiny randomly initialized model (--tiny_random) for testing without downloading anything. With --quantize, the
+encoder's linear layers are dynamically quantized to int8, which is usually about twice as fast on CPU.
+"""
+import argparse
+import collections
+import os
+
+import numpy as np
+import torch
+
+from bert_tokens import ChunkDataset, load_or_build_token_store, make_loader, post_words, read_processed_posts
+from embedding_store import EmbeddingStore
+from instrumentation import stage
+
+# prefixes of the encoder's weights in the state dicts saved by the notebooks (LSTMClassifier has the encoder as
+# 'bert', the sequence classification model as 'encoder.distilbert')
+_CHECKPOINT_PREFIXES = ["encoder.distilbert.", "distilbert.", "bert."]
+_SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+
+
+def load_encoder(model_name="distilbert-base-uncased", checkpoint=None):
+    """
+    Load DistilBERT encoder.
+    :param model_name: name or path of pre-trained model
+    :param checkpoint: optional path to a state dict saved by the notebooks, to load fine-tuned encoder weights from
+    :return: DistilBertModel in eval mode
+    """
+    from transformers import DistilBertModel
+    model = DistilBertModel.from_pretrained(model_name)
+    if checkpoint:
+        state_dict = torch.load(checkpoint, map_location="cpu")
+        encoder_state = collections.OrderedDict()
+        for name, value in state_dict.items():
+            for prefix in _CHECKPOINT_PREFIXES:
+                if name.startswith(prefix):
+                    encoder_state[name[len(prefix):]] = value
+                    break
+        if not encoder_state:  # saved from the encoder itself
+            encoder_state = state_dict
+        missing, unexpected = model.load_state_dict(encoder_state, strict=False)
+        if missing:
+            raise ValueError("checkpoint {} is missing encoder weights: {}".format(checkpoint, missing[:10]))
+        print("loaded encoder weights from {} ({} unused)".format(checkpoint, len(unexpected)))
+    return model.eval()
+
+
+def tiny_random_encoder(vocab_size, dim=32, n_layers=2, n_heads=2, hidden_dim=64, seed=0):
+    """
+    Small randomly initialized DistilBERT encoder, for testing the export without pre-trained weights.
+    """
+    from transformers import DistilBertConfig, DistilBertModel
+    torch.manual_seed(seed)
+    config = DistilBertConfig(vocab_size=vocab_size, dim=dim, n_layers=n_layers, n_heads=n_heads,
+                              hidden_dim=hidden_dim, max_position_embeddings=512)
+    return DistilBertModel(config).eval()
+
+
+def tiny_random_tokenizer(words, vocab_dir, vocab_size=1000):
+    """
+    WordPiece tokenizer whose vocab is the most frequent words of the posts (plus special tokens), for use with
+    tiny_random_encoder.
+    :param words: list of words of each post (see bert_tokens.post_words)
+    :param vocab_dir: directory to save vocab.txt to
+    """
+    from transformers import DistilBertTokenizerFast
+    counts = collections.Counter(word.lower() for post in words for word in post)
+    vocab = _SPECIAL_TOKENS + [word for word, _ in counts.most_common(vocab_size - len(_SPECIAL_TOKENS))]
+    if not os.path.exists(vocab_dir):
+        os.makedirs(vocab_dir)
+    vocab_path = os.path.join(vocab_dir, "vocab.txt")
+    with open(vocab_path, "w", encoding="utf-8") as f:
+        f.write("".join("{}\n".format(token) for token in vocab))
+    return DistilBertTokenizerFast(vocab_file=vocab_path)
+
+
+def quantize_encoder(model):
+    """
+    Dynamically quantize the linear layers of model to int8 (weights are quantized once, activations on the fly).
+    """
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def pool_chunks(hidden, attention_mask, pooling="mean"):
+    """
+    One vector per chunk from the encoder's last hidden states.
+    :param hidden: tensor of shape (batch size, length, dim)
+    :param attention_mask: tensor of shape (batch size, length), 0 for padding
+    :param pooling: 'mean' (mean over the chunk's tokens, leaving out padding) or 'cls' (vector of the [CLS] token)
+    :return: tensor of shape (batch size, dim)
+    """
+    if pooling == "cls":
+        return hidden[:, 0]
+    mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+    return (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+
+def embed_posts(model, token_store, start, end, batch_size=32, pooling="mean"):
+    """
+    Embed posts start to end - 1 of token_store: their chunks are encoded in length-sorted batches and the chunk
+    vectors of each post are averaged.
+    :return: float32 array of shape (end - start, dim)
+    """
+    first_chunk, last_chunk = token_store.post_indptr[start], token_store.post_indptr[end]
+    dataset = ChunkDataset(token_store, chunks=np.arange(first_chunk, last_chunk))
+    chunk_vectors = None
+    with torch.no_grad():
+        for batch in make_loader(dataset, batch_size=batch_size, shuffle=False):
+            hidden = model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"])[0]
+            vectors = pool_chunks(hidden, batch["attention_mask"], pooling).float().numpy()
+            if chunk_vectors is None:
+                chunk_vectors = np.zeros((last_chunk - first_chunk, vectors.shape[1]), dtype=np.float32)
+            chunk_vectors[batch["chunk"].numpy() - first_chunk] = vectors
+    # every post has at least one chunk
+    post_starts = token_store.post_indptr[start:end] - first_chunk
+    num_chunks = np.diff(token_store.post_indptr[start:end + 1])
+    return np.add.reduceat(chunk_vectors, post_starts, axis=0) / num_chunks[:, None]
+
+
+def export_embeddings(model, token_store, store_dir, metadata_df=None, batch_size=32, shard_posts=2000,
+                      pooling="mean"):
+    """
+    Embed all posts of token_store and append them to the embedding store at store_dir (created if needed), one
+    shard at a time. If the store already has rows, they must be the first posts of token_store, and only the rest
+    are embedded.
+    :param metadata_df: optional pandas DataFrame with metadata of each post of token_store (same order)
+    :param shard_posts: number of posts embedded and appended at a time
+    :return: EmbeddingStore
+    """
+    store = EmbeddingStore(store_dir) if os.path.exists(os.path.join(store_dir, "info.json")) else None
+    start = 0
+    if store is not None:
+        start = len(store)
+        if store.ids != token_store.ids[:start]:
+            raise ValueError("embedding store at {} has posts that are not in this export".format(store_dir))
+        if start:
+            print("embedding store already has {} posts. continuing from there.".format(start))
+    num_posts = len(token_store.ids)
+    for shard_start in range(start, num_posts, shard_posts):
+        shard_end = min(shard_start + shard_posts, num_posts)
+        num_chunks = int(token_store.post_indptr[shard_end] - token_store.post_indptr[shard_start])
+        num_tokens = int(token_store.chunk_indptr[token_store.post_indptr[shard_end]] -
+                         token_store.chunk_indptr[token_store.post_indptr[shard_start]])
+        with stage("embed_posts", docs=shard_end - shard_start, tokens=num_tokens, chunks=num_chunks):
+            embeddings = embed_posts(model, token_store, shard_start, shard_end, batch_size=batch_size,
+                                     pooling=pooling)
+        if store is None:
+            store = EmbeddingStore.create(store_dir, embeddings.shape[1])
+        store.append(embeddings, token_store.ids[shard_start:shard_end],
+                     None if metadata_df is None else metadata_df.iloc[shard_start:shard_end])
+        print("embedded {}/{} posts".format(shard_end, num_posts))
+    return store
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_paths", type=str, nargs="+", help="Paths to processed_posts.csv files.")
+    parser.add_argument("--store_dir", type=str, help="Path to embedding store directory (created if needed).")
+    parser.add_argument("--token_store_dir", type=str, default=None,
+                        help="Path to token store directory (default: <store_dir>_tokens).")
+    parser.add_argument("--model", type=str, default="distilbert-base-uncased",
+                        help="Name or path of pre-trained DistilBERT model and tokenizer.")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="Optional path to fine-tuned model state dict saved by the BERT notebooks.")
+    parser.add_argument("--tiny_random", action="store_true",
+                        help="Use a tiny randomly initialized model and a vocab made from the data (for testing).")
+    parser.add_argument("--pooling", type=str, default="mean", choices=["mean", "cls"],
+                        help="How to get a chunk's vector from its token vectors.")
+    parser.add_argument("--batch_size", type=int, default=32, help="Number of chunks encoded at a time.")
+    parser.add_argument("--shard_posts", type=int, default=2000,
+                        help="Number of posts embedded and saved to the store at a time.")
+    parser.add_argument("--max_length", type=int, default=512, help="Maximum number of tokens per chunk.")
+    parser.add_argument("--num_threads", type=int, default=None,
+                        help="Number of threads torch uses within operations (default: torch's default).")
+    parser.add_argument("--quantize", action="store_true", help="Quantize the model's linear layers to int8.")
+    parser.add_argument("--metadata_columns", type=str, nargs="*",
+                        default=["data_split", "upvote_ratio", "score", "num_comments"],
+                        help="Columns of the data to save as metadata in the embedding store (if present).")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = _parse_args()
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    token_store_dir = args.token_store_dir or "{}_tokens".format(args.store_dir.rstrip("/\\"))
+    data_df = read_processed_posts(args.data_paths)
+    words = post_words(data_df["processed_title"], data_df["processed_text"])
+    if args.tiny_random:
+        tokenizer = tiny_random_tokenizer(words, token_store_dir)
+        tokenizer_name = "tiny-random"
+        model = tiny_random_encoder(len(tokenizer))
+    else:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=True)
+        tokenizer_name = args.model
+        model = load_encoder(args.model, args.checkpoint)
+    if args.quantize:
+        model = quantize_encoder(model)
+    token_store = load_or_build_token_store(token_store_dir, data_df["id"], words, tokenizer, tokenizer_name,
+                                            max_length=args.max_length)
+    metadata_df = data_df[[column for column in args.metadata_columns if column in data_df.columns]]
+    store = export_embeddings(model, token_store, args.store_dir, metadata_df=metadata_df,
+                              batch_size=args.batch_size, shard_posts=args.shard_posts, pooling=args.pooling)
+    print("embedding store at {} has {} embeddings of size {}".format(args.store_dir, len(store), store.dim))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,86 +1,204 @@
 """"
 Script for getting measures of the topic distributions present in the comments of each post.
 """
+import argparse
+import os
+
 import numpy as np
 import pandas as pd
-from statistics import mode
 
-verbose = True
+from instrumentation import stage
 
 
 def converter(in_str):
     return np.fromstring(in_str[1:-1], sep=" ")
 
 
-# read in csv file with per-document topic distributions
-doc_topic_df = pd.read_csv("data/topic_model/10_topics/doc_topic_distributions.csv",
-                           index_col=0, converters={'topic_dist': converter})
-# drop entries with 'dark' as id (seems to be error in data)
-doc_topic_df = doc_topic_df[doc_topic_df['id'] != 'dark']
-# drop duplicates
-doc_topic_df.drop_duplicates(subset="id", inplace=True)
-
-# just get those for the comments
-doc_topic_df = doc_topic_df[doc_topic_df["type"] == "comment"]
-# can drop 'type' column
-doc_topic_df.drop(columns=['type'], inplace=True)
-
-# read in csv files that have all info associated with comments and posts
-ttc_comments = pd.read_csv("data/ttcafterloss/comments.csv", index_col=0)
-infertility_comments = pd.read_csv("data/infertility/comments.csv", index_col=0)
-comments_df = pd.concat([ttc_comments, infertility_comments])
-# drop entries with 'dark' as id (seems to be error in data)
-comments_df = comments_df[comments_df['id'] != 'dark']
-# drop duplicates
-comments_df.drop_duplicates(subset="id", inplace=True)
-# process parent id so it matches post IDs (i.e., drop t1_ abbreviation)
-comments_df["parent_post"] = comments_df.apply(lambda x: x["parent_id"].split("_")[1], axis=1)
-
-ttc_posts = pd.read_csv("data/ttcafterloss/posts.csv", index_col=0)
-infertility_posts = pd.read_csv("data/infertility/posts.csv", index_col=0)
-post_df = pd.concat([ttc_posts, infertility_posts])
-
-# merge comments df with doc topic df to get topics associated with each comment
-comments_df = doc_topic_df.merge(comments_df, on="id")
-
-# for each post, get its comments
-mean_topic_dists = []
-max_mean_topics = []
-mode_max_topics = []
-sample_max_topics = []
-
-for idx, row in post_df.iterrows():
-    post_id = row["id"]
-    num_comments = row["num_comments"]
-    # NOTE: here we are only getting comments that directly replied to the post
-    # i.e., we are excluding comments that were made on other comments on the post
-    comments = comments_df[comments_df["parent_post"] == post_id]
-    if verbose:
-        print("num comments is {} and # of comments found is {}".format(num_comments, len(comments)))
-    mean_dist = np.NaN
-    max_mean = np.NaN
-    mode_max = np.NaN
-    sample_max = np.NaN
-    if not comments.empty:
-        # get the topics for these comments
-        topic_dist_matrix = np.stack(comments['topic_dist'].values)
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--doc_topic_path", type=str, default="data/topic_model/10_topics/doc_topic_distributions.csv",
+                        help="Path to CSV file with per-document topic distributions.")
+    parser.add_argument("--data_dir", type=str, default="data",
+                        help="Path to directory with <subreddit>/posts.csv and <subreddit>/comments.csv files.")
+    parser.add_argument("--subreddits", type=str, nargs="+", default=["ttcafterloss", "infertility"],
+                        help="Subreddits to read posts and comments for.")
+    parser.add_argument("--output_path", type=str, default="data/10_all_posts_with_comment_topics.csv",
+                        help="Path to save posts with comment topic metrics to.")
+    parser.add_argument("--include_replies", action="store_true",
+                        help="If set, use all comments in each post's reply tree rather than only direct replies.")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed used for sampling max topics.")
+    parser.add_argument("--verbose", action="store_true", help="If set, print summary of comments found.")
+    args = parser.parse_args()
+    return args
+
+
+def get_parent_post_ids(comments_df):
+    """
+    Process parent id of each comment so it matches post IDs (i.e., drop t1_/t3_ abbreviation).
+    NOTE: this is only the id of a post for comments that directly replied to the post; for other comments it's the
+    id of the comment they replied to.
+    """
+    return comments_df["parent_id"].str.split("_").str[1].to_numpy()
+
+
+def get_thread_post_ids(comments_df):
+    """
+    Get id of the post at the root of each comment's reply tree by following parent ids up to the post.
+    Comments whose chain of parents is broken (e.g. a parent comment is missing from comments_df) get the id of
+    the last comment in the chain, which won't match any post. Comments whose chain of parents contains a cycle (which
+    can happen with deleted or garbled data) get NaN.
+    """
+    parent_keys = get_parent_post_ids(comments_df)
+    is_reply_to_comment = comments_df["parent_id"].str.startswith("t1_").to_numpy()
+    parent_pos = pd.Index(comments_df["id"]).get_indexer(parent_keys)
+    # each comment points to its parent comment, or to itself if it has no (known) parent comment
+    root = np.arange(len(comments_df))
+    has_parent = is_reply_to_comment & (parent_pos >= 0)
+    root[has_parent] = parent_pos[has_parent]
+    # pointer jumping: after i iterations each comment points 2^i levels up the tree, so chains without cycles are
+    # resolved after ceil(log2(n)) iterations
+    for _ in range(int(np.ceil(np.log2(max(len(root), 1)))) + 1):
+        next_root = root[root]
+        if np.array_equal(next_root, root):
+            break
+        root = next_root
+    thread_post_ids = parent_keys[root].astype(object)
+    # comments that don't end up at a comment without a parent comment are part of (or lead into) a cycle
+    thread_post_ids[has_parent[root]] = np.nan
+    return thread_post_ids
+
+
+def aggregate_comment_topics(post_ids, comment_post_ids, topic_dist_matrix, rng=None):
+    """
+    Compute measures of the topic distributions of the comments of each post in a single grouped pass.
+    :param post_ids: array of post ids (length P)
+    :param comment_post_ids: array with the id of the post each comment belongs to (length C)
+    :param topic_dist_matrix: array of shape (C, # topics) with topic distribution of each comment
+    :param rng: numpy random Generator used for sampling max topics
+    :return: pandas DataFrame with one row per post (in post_ids order) and the following columns
+        * num_comments_found: number of comments of post
+        * mean_topic_dist: mean of the topic distributions across comments
+        * max_mean_topic: topic with the greatest mean value
+        * mode_max_topic: topic that is most frequently the max-value topic of a comment (ties are broken by which
+                          topic comes first, as in statistics.mode)
+        * max_topic_sample: max-value topic of a randomly sampled comment
+        Measures are NaN for posts without comments.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    post_index = pd.Index(post_ids).drop_duplicates()
+    codes = post_index.get_indexer(comment_post_ids)
+    found = codes >= 0
+    # sort comments by post (stable, so comments of each post stay in their original order)
+    order = np.argsort(codes[found], kind="stable")
+    codes = codes[found][order]
+    topic_dists = np.asarray(topic_dist_matrix, dtype=np.float64)[found][order]
+    num_posts, num_topics = len(post_index), topic_dists.shape[1]
+    num_found = np.zeros(num_posts, dtype=np.int64)
+    mean_dists = np.full((num_posts, num_topics), np.nan)
+    max_mean = np.full(num_posts, np.nan)
+    mode_max = np.full(num_posts, np.nan)
+    sample_max = np.full(num_posts, np.nan)
+    if len(codes):
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        counts = np.diff(np.r_[starts, len(codes)])
+        groups = codes[starts]
+        num_found[groups] = counts
+        # get the mean of the topic distributions across comments, and the topic with the greatest mean value
+        group_means = np.add.reduceat(topic_dists, starts, axis=0) / counts[:, None]
+        mean_dists[groups] = group_means
+        max_mean[groups] = np.argmax(group_means, axis=1)
         # get topic that each comment is most associated with
-        comment_max_topics = np.argmax(topic_dist_matrix, axis=1)
-        # get the topic that most posts are most associated with
-        mode_max = mode(comment_max_topics)
-        sample_max = np.random.choice(comment_max_topics)
-        # get the mean of the topic distributions across comments
-        mean_dist = np.mean(topic_dist_matrix, axis=0)
-        # get the topic with the greatest mean value
-        max_mean = np.argmax(mean_dist)
-    mean_topic_dists.append(mean_dist)
-    max_mean_topics.append(max_mean)
-    mode_max_topics.append(mode_max)
-    sample_max_topics.append(sample_max)
-
-# save these with the rest of post data
-post_df["mean_topic_dist"] = mean_topic_dists
-post_df["max_mean_topic"] = max_mean_topics
-post_df["mode_max_topic"] = mode_max_topics
-post_df["max_topic_sample"] = sample_max_topics
-post_df.to_csv("data/10_all_posts_with_comment_topics.csv")
+        comment_max = np.argmax(topic_dists, axis=1)
+        # count how often each topic is the max topic within each group, and where it first occurs
+        keys = np.repeat(np.arange(len(groups)), counts) * num_topics + comment_max
+        topic_counts = np.bincount(keys, minlength=len(groups) * num_topics)
+        first_pos = np.full(len(groups) * num_topics, len(codes))
+        unique_keys, first_idx = np.unique(keys, return_index=True)
+        first_pos[unique_keys] = first_idx
+        # most frequent topic, breaking ties by earliest first occurrence
+        score = (topic_counts * (len(codes) + 1) - first_pos).reshape(len(groups), num_topics)
+        mode_max[groups] = np.argmax(score, axis=1)
+        # randomly sample one comment per group
+        picks = starts + np.floor(rng.random(len(groups)) * counts).astype(np.int64)
+        sample_max[groups] = comment_max[picks]
+    result = pd.DataFrame({
+        "num_comments_found": num_found,
+        "mean_topic_dist": [dist if n else np.nan for dist, n in zip(mean_dists, num_found)],
+        "max_mean_topic": max_mean,
+        "mode_max_topic": mode_max,
+        "max_topic_sample": sample_max,
+    }, index=post_index)
+    return result.loc[post_ids].reset_index(drop=True)
+
+
+def get_post_comment_topics(doc_topic_path, post_paths, comment_paths, output_path, include_replies=False, seed=None,
+                            verbose=False):
+    """
+    Compute measures of the topic distributions of the comments of each post (see aggregate_comment_topics) and save
+    them with the rest of the post data.
+    :param doc_topic_path: path to CSV file with per-document topic distributions
+    :param post_paths: paths to posts.csv files
+    :param comment_paths: paths to comments.csv files
+    :param output_path: path to save posts with comment topic metrics to
+    :param include_replies: if True, use all comments in each post's reply tree rather than only direct replies
+    :param seed: random seed used for sampling max topics
+    :param verbose: if True, print summary of comments found
+    """
+    # read in csv file with per-document topic distributions
+    doc_topic_df = pd.read_csv(doc_topic_path, index_col=0, converters={'topic_dist': converter})
+    # drop entries with 'dark' as id (seems to be error in data)
+    doc_topic_df = doc_topic_df[doc_topic_df['id'] != 'dark']
+    # drop duplicates
+    doc_topic_df = doc_topic_df.drop_duplicates(subset="id")
+    # just get those for the comments
+    doc_topic_df = doc_topic_df[doc_topic_df["type"] == "comment"]
+    # can drop 'type' column
+    doc_topic_df = doc_topic_df.drop(columns=['type'])
+
+    # read in csv files that have all info associated with comments and posts
+    comments_df = pd.concat([pd.read_csv(comment_path, index_col=0) for comment_path in comment_paths])
+    # drop entries with 'dark' as id (seems to be error in data)
+    comments_df = comments_df[comments_df['id'] != 'dark']
+    # drop duplicates
+    comments_df = comments_df.drop_duplicates(subset="id")
+    if include_replies:
+        comments_df["parent_post"] = get_thread_post_ids(comments_df)
+    else:
+        # NOTE: here we are only getting comments that directly replied to the post
+        # i.e., we are excluding comments that were made on other comments on the post
+        comments_df["parent_post"] = get_parent_post_ids(comments_df)
+
+    post_df = pd.concat([pd.read_csv(post_path, index_col=0) for post_path in post_paths])
+
+    # merge comments df with doc topic df to get topics associated with each comment
+    comments_df = doc_topic_df.merge(comments_df, on="id")
+
+    with stage("comment_aggregation", docs=len(comments_df), posts=len(post_df)):
+        metrics_df = aggregate_comment_topics(post_df["id"].to_numpy(), comments_df["parent_post"].to_numpy(),
+                                              np.stack(comments_df["topic_dist"].values),
+                                              rng=np.random.default_rng(seed))
+    if verbose:
+        print("found comments for {} of {} posts ({} comments found; num_comments sums to {})".format(
+            (metrics_df["num_comments_found"] > 0).sum(), len(post_df), metrics_df["num_comments_found"].sum(),
+            post_df["num_comments"].sum()))
+
+    # save these with the rest of post data
+    post_df["mean_topic_dist"] = metrics_df["mean_topic_dist"].values
+    post_df["max_mean_topic"] = metrics_df["max_mean_topic"].values
+    post_df["mode_max_topic"] = metrics_df["mode_max_topic"].values
+    post_df["max_topic_sample"] = metrics_df["max_topic_sample"].values
+    post_df.to_csv(output_path)
+
+
+def main():
+    args = _parse_args()
+    get_post_comment_topics(args.doc_topic_path,
+                            [os.path.join(args.data_dir, subreddit, "posts.csv") for subreddit in args.subreddits],
+                            [os.path.join(args.data_dir, subreddit, "comments.csv") for subreddit in args.subreddits],
+                            args.output_path, include_replies=args.include_replies, seed=args.seed,
+                            verbose=args.verbose)
+
+
+if __name__ == "__main__":
+    main()
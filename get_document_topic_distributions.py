@@ -2,12 +2,14 @@
 Script for applying topic model to corpus of documents to get the distribution of topics within those documents.
 """
 import argparse
-import ast
 import os
 
 import gensim
 import numpy as np
-import pandas as pd
+
+from corpus_store import load_corpus
+from instrumentation import stage
+from lda_inference import MalletInferencer
 
 
 def _parse_args() -> argparse.Namespace:
@@ -16,20 +18,42 @@ def _parse_args() -> argparse.Namespace:
     parser.add_argument("--corpus_dir", type=str, help="Path directory containing corpus of documents to run model on.")
     parser.add_argument("--corpus_name", type=str, help="Prefix used in naming corpus files.")
     parser.add_argument("--output_dir", type=str, help="Path to directory to save computed topic dist features.")
+    parser.add_argument("--inference", type=str, choices=["numpy", "mallet"], default="numpy",
+                        help="Run inference in-process with NumPy, or with Mallet's inferencer (via gensim).")
+    parser.add_argument("--method", type=str, choices=["gibbs", "vb"], default="gibbs",
+                        help="Inference method to use with --inference numpy.")
+    parser.add_argument("--iterations", type=int, default=100, help="Number of inference iterations.")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for Gibbs sampling.")
     args = parser.parse_args()
+    if args.iterations < 1:
+        parser.error("--iterations must be at least 1")
     return args
 
 
-def get_doc_topic_metrics(corpus_df, topic_model, output_dir):
-    # get tf and convert from strings to literal form
-    doc_tf_list = list(corpus_df["tf"])
-    doc_tf_list = [ast.literal_eval(x) for x in doc_tf_list]
+def get_doc_topic_metrics(corpus, topic_model, output_dir, inference="numpy", method="gibbs", iterations=100,
+                          seed=None):
+    """
+    :param corpus: corpus_store.CorpusStore with documents to get topic distributions for
+    :param topic_model: trained gensim LdaMallet model
+    :param output_dir: directory to save topic distributions to
+    :param inference: 'numpy' to infer topics in-process with lda_inference.MalletInferencer, or 'mallet' to use
+                      Mallet's own inferencer
+    :param method: inference method used by MalletInferencer ('gibbs' or 'vb')
+    """
     # get topic distribution for each document
-    doc_topic_list = topic_model[doc_tf_list]
-    doc_topic_matrix = np.array(doc_topic_list)
-    doc_topic_matrix = doc_topic_matrix[:, :, 1]
-    # drop unnecessary columns
-    corpus_df = corpus_df[["id", "subreddit", "type"]]
+    tf_matrix = corpus.tf_matrix()
+    with stage("topic_inference", docs=tf_matrix.shape[0], tokens=int(tf_matrix.sum()), inference=inference,
+               method=method if inference == "numpy" else "mallet"):
+        if inference == "numpy":
+            inferencer = MalletInferencer.from_mallet_model(topic_model)
+            doc_topic_matrix = inferencer.infer(tf_matrix, method=method, iterations=iterations, seed=seed)
+        else:
+            doc_topic_list = topic_model.__getitem__(list(corpus.bow_corpus()), iterations=iterations)
+            doc_topic_matrix = np.array(doc_topic_list)
+            doc_topic_matrix = doc_topic_matrix[:, :, 1].astype(np.float32)
+    np.save(os.path.join(output_dir, "doc_topic_distributions.npy"), doc_topic_matrix)
+    # keep only metadata columns
+    corpus_df = corpus.meta_df.copy()
     corpus_df["topic_dist"] = list(doc_topic_matrix)
     # save
     corpus_df.to_csv(os.path.join(output_dir, "doc_topic_distributions.csv"))
@@ -39,13 +63,14 @@ def main():
     args = _parse_args()
 
     # load data associated with corpus of documents to get topics for
-    corpus_df = pd.read_csv(os.path.join(args.corpus_dir, "{}_corpus.csv".format(args.corpus_name)), index_col=0)
+    corpus = load_corpus(args.corpus_dir, args.corpus_name)
 
     # load topic model
     topic_model = gensim.models.wrappers.ldamallet.LdaMallet.load(args.topic_model_path)
 
     # compute and save metrics
-    get_doc_topic_metrics(corpus_df, topic_model, args.output_dir)
+    get_doc_topic_metrics(corpus, topic_model, args.output_dir, inference=args.inference, method=args.method,
+                          iterations=args.iterations, seed=args.seed)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,331 @@
+"""
+Stage-level instrumentation for the preprocessing and topic model pipeline.
+
+Wrapping a stage in ``with stage("name", docs=...) as stats:`` records its wall time, documents/tokens per second and
+memory use: the peak RSS of the process and its child processes (e.g. multiprocessing workers and the Mallet JVM)
+during the stage, sampled in a background thread (stage_peak_rss_mb, Linux only), as well as the peak RSS of the
+process so far (peak_rss_mb) and of its largest finished child process (children_peak_rss_mb). Records are printed, kept in memory (get_recorder().records) and, if a metrics path is configured, appended
+to a JSON-lines (.jsonl) or CSV (.csv) file. Stages can also be profiled, with cProfile (saved as <stage>.prof, for
+pstats/snakeviz) or with a sampling profiler (saved as <stage>.folded, collapsed stacks for flame graphs).
+
+Configuration is done with configure(), or with environment variables so scripts can be instrumented without code
+changes:
+* PIPELINE_METRICS_PATH: file to append stage records to
+* PIPELINE_PROFILE: comma-separated names of stages to profile ('all' for every stage)
+* PIPELINE_PROFILER: 'cprofile' (default) or 'sampling'
+* PIPELINE_PROFILE_DIR: directory to save profiles to (default: current directory)
+* PIPELINE_QUIET: if set, don't print stage timings
+"""
+import collections
+import contextlib
+import cProfile
+import csv
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+CSV_FIELDS = ["stage", "status", "timestamp", "seconds", "docs", "tokens", "docs_per_sec", "tokens_per_sec",
+              "stage_peak_rss_mb", "peak_rss_mb", "children_peak_rss_mb", "info"]
+
+
+class StageStats:
+    """
+    Counts for a running stage. docs and tokens can be set inside the with block once they are known.
+    """
+    def __init__(self, name, docs=None, tokens=None, info=None):
+        self.name = name
+        self.docs = docs
+        self.tokens = tokens
+        self.info = info or {}
+
+
+class StageRecorder:
+    """
+    Records stage timings, throughput and memory use, and optionally profiles stages.
+    """
+    def __init__(self, metrics_path=None, profile_stages=(), profiler="cprofile", profile_dir=".", verbose=True):
+        """
+        :param metrics_path: path to .jsonl or .csv file to append records to (None to only keep them in memory)
+        :param profile_stages: names of stages to profile ('all' to profile every stage)
+        :param profiler: 'cprofile' or 'sampling'
+        :param profile_dir: directory to save profiles to
+        :param verbose: if True, print start and end of each stage
+        """
+        if profiler not in ("cprofile", "sampling"):
+            raise ValueError("unknown profiler '{}'".format(profiler))
+        self.metrics_path = metrics_path
+        self.profile_stages = set(profile_stages)
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+        self.verbose = verbose
+        self.records = []
+        self._lock = threading.Lock()
+
+    def should_profile(self, name):
+        return "all" in self.profile_stages or name in self.profile_stages
+
+    @contextlib.contextmanager
+    def stage(self, name, docs=None, tokens=None, **info):
+        """
+        Context manager that records a stage.
+        :param name: stage name
+        :param docs: number of documents handled by the stage (can also be set on the yielded StageStats)
+        :param tokens: number of tokens handled by the stage (can also be set on the yielded StageStats)
+        :param info: other values to include in the record (e.g. num_topics)
+        """
+        stats = StageStats(name, docs, tokens, info)
+        profiler = self._start_profiler() if self.should_profile(name) else None
+        if self.verbose:
+            print("starting {}{}".format(name, _format_info(info)))
+        rss_sampler = RssSampler()
+        rss_sampler.start()
+        status = "ok"
+        start = time.perf_counter()
+        try:
+            yield stats
+        except BaseException as e:
+            status = "error: {}".format(type(e).__name__)
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            rss_sampler.stop()
+            if profiler is not None:
+                self._save_profile(profiler, name)
+            self._record(stats, seconds, status, rss_sampler.peak_mb)
+
+    def _record(self, stats, seconds, status, stage_peak_rss_mb=None):
+        record = {
+            "stage": stats.name,
+            "status": status,
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "seconds": round(seconds, 6),
+            "docs": stats.docs,
+            "tokens": stats.tokens,
+            "docs_per_sec": round(stats.docs / seconds, 3) if stats.docs and seconds > 0 else None,
+            "tokens_per_sec": round(stats.tokens / seconds, 3) if stats.tokens and seconds > 0 else None,
+            "stage_peak_rss_mb": stage_peak_rss_mb,
+            "peak_rss_mb": peak_rss_mb(),
+            "children_peak_rss_mb": peak_rss_mb(children=True),
+        }
+        record.update(stats.info)
+        with self._lock:
+            self.records.append(record)
+            if self.metrics_path:
+                _append_record(self.metrics_path, record)
+        if self.verbose:
+            throughput = " ({} docs/s)".format(record["docs_per_sec"]) if record["docs_per_sec"] else ""
+            print("finished {}{} in time {}{}".format(stats.name, _format_info(stats.info), seconds, throughput))
+
+    def _start_profiler(self):
+        if self.profiler == "cprofile":
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # only one cProfile profiler can be active at a time (e.g. stages running in parallel threads)
+                print("not profiling stage: {}".format(e))
+                return None
+        else:
+            profiler = SamplingProfiler(threading.get_ident())
+            profiler.start()
+        return profiler
+
+    def _save_profile(self, profiler, name):
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            path = os.path.join(self.profile_dir, "{}.prof".format(name))
+            profiler.dump_stats(path)
+        else:
+            profiler.stop()
+            path = os.path.join(self.profile_dir, "{}.folded".format(name))
+            profiler.save(path)
+        if self.verbose:
+            print("saved profile of {} to {}".format(name, path))
+
+
+class SamplingProfiler:
+    """
+    Low-overhead profiler that periodically samples the call stack of one thread from a background thread.
+    Samples are saved as collapsed stacks ('outer;...;inner count' lines), which flame graph tools can render.
+    """
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def save(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+
+class RssSampler:
+    """
+    Tracks the peak total RSS of this process and all of its descendant processes while it runs, by reading /proc in a
+    background thread. Unlike ru_maxrss, this gives the peak of a single stage. peak_mb is None where /proc isn't
+    available.
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._sample()
+        if self.peak_mb is not None:
+            self._thread.start()
+
+    def stop(self):
+        if self._thread.is_alive():
+            self._stop.set()
+            self._thread.join()
+        self._sample()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = current_rss_mb(children=True)
+        if rss is not None and (self.peak_mb is None or rss > self.peak_mb):
+            self.peak_mb = rss
+
+
+def current_rss_mb(children=False):
+    """
+    Current resident set size of this process in MB, including all of its descendant processes if children is True
+    (None if /proc isn't available).
+    """
+    pids = [os.getpid()]
+    if children:
+        pids += _descendant_pids(os.getpid())
+    total_pages = 0
+    for pid in pids:
+        try:
+            with open("/proc/{}/statm".format(pid)) as f:
+                total_pages += int(f.read().split()[1])
+        except (OSError, ValueError, IndexError):
+            if pid == pids[0]:
+                return None
+            # child exited in the meantime
+    return round(total_pages * _PAGE_SIZE / (1024 * 1024), 1)
+
+
+def _descendant_pids(pid):
+    descendants = []
+    children = []
+    try:
+        for tid in os.listdir("/proc/{}/task".format(pid)):
+            with open("/proc/{}/task/{}/children".format(pid, tid)) as f:
+                children += [int(child) for child in f.read().split()]
+    except (OSError, ValueError):
+        return descendants
+    for child in children:
+        descendants.append(child)
+        descendants += _descendant_pids(child)
+    return descendants
+
+
+def peak_rss_mb(children=False):
+    """
+    Peak resident set size of this process so far, in MB (None if it can't be measured on this platform).
+    :param children: if True, get the peak RSS of the largest child process that has finished (and been waited for)
+                     instead
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _format_info(info):
+    return " ({})".format(", ".join("{}={}".format(k, v) for k, v in info.items())) if info else ""
+
+
+def _append_record(path, record):
+    if path.endswith(".csv"):
+        # stages have different extra values, so in CSV files they go in a single JSON 'info' column
+        row = {field: record[field] for field in CSV_FIELDS[:-1]}
+        row["info"] = json.dumps({k: v for k, v in record.items() if k not in row})
+        write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            if write_header:
+                writer.writeheader()
+            writer.writerow(row)
+    else:
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def configure(**kwargs):
+    """
+    Replace the default recorder used by stage(). Takes the same arguments as StageRecorder.
+    :return: new recorder
+    """
+    global _RECORDER
+    _RECORDER = StageRecorder(**kwargs)
+    return _RECORDER
+
+
+def configure_from_env():
+    """
+    Configure the default recorder from PIPELINE_* environment variables (see module docstring).
+    """
+    profile = os.environ.get("PIPELINE_PROFILE", "")
+    return configure(metrics_path=os.environ.get("PIPELINE_METRICS_PATH") or None,
+                     profile_stages=[name.strip() for name in profile.split(",") if name.strip()],
+                     profiler=os.environ.get("PIPELINE_PROFILER", "cprofile"),
+                     profile_dir=os.environ.get("PIPELINE_PROFILE_DIR", "."),
+                     verbose=not os.environ.get("PIPELINE_QUIET"))
+
+
+def get_recorder():
+    return _RECORDER
+
+
+def stage(name, docs=None, tokens=None, **info):
+    """
+    Record a stage with the default recorder (see StageRecorder.stage).
+    """
+    return _RECORDER.stage(name, docs=docs, tokens=tokens, **info)
+
+
+try:
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+_RECORDER = None
+configure_from_env()
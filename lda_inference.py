@@ -0,0 +1,194 @@
+"""
+In-process inference of document topic distributions with a trained Mallet LDA model.
+
+Unlike LdaMallet.__getitem__, which writes documents to temporary files, runs Mallet's inferencer in a JVM and parses
+its text output, the topics are loaded once and inference is run with NumPy on batches of documents.
+"""
+import os
+
+import numpy as np
+import scipy.sparse
+from scipy.special import digamma
+
+from mallet_state import read_mallet_params, read_mallet_state
+
+DEFAULT_BETA = 0.01  # Mallet's default topic-word smoothing
+
+
+class MalletInferencer:
+    """
+    Infers topic distributions of documents, keeping the topics of a trained model fixed.
+
+    Two methods are supported:
+    * 'gibbs': fold-in collapsed Gibbs sampling (what Mallet's inferencer does). Every token of a batch is resampled at
+      once given the doc-topic counts of the previous sweep, and distributions are averaged over the sweeps after
+      burn-in.
+    * 'vb': variational inference of each document's topic proportions (as in gensim's LdaModel), which is
+      deterministic and usually converges in fewer iterations.
+    """
+    def __init__(self, topic_word_counts, alpha, beta=DEFAULT_BETA):
+        """
+        :param topic_word_counts: array of shape (# topics, # terms) with number of tokens of each term assigned to each
+                                  topic in training
+        :param alpha: array of per-topic Dirichlet priors on doc-topic distributions
+        :param beta: Dirichlet prior on topic-word distributions
+        """
+        topic_word_counts = np.asarray(topic_word_counts, dtype=np.float64)
+        self.num_topics, self.num_terms = topic_word_counts.shape
+        self.alpha = np.asarray(alpha, dtype=np.float64)
+        assert len(self.alpha) == self.num_topics, "alpha must have one entry per topic"
+        self.beta = beta
+        topic_word = (topic_word_counts + beta) / (topic_word_counts.sum(axis=1) + self.num_terms * beta)[:, None]
+        # stored term-major, so the topic probabilities of a batch of tokens are a row gather
+        self.word_topic = np.ascontiguousarray(topic_word.T)
+
+    @classmethod
+    def from_mallet_model(cls, model, beta=None):
+        """
+        Create inferencer from a (loaded) gensim LdaMallet model.
+        :param beta: topic-word prior. If None, it's read from the model's Mallet state file, falling back to Mallet's
+                     default if the file is missing.
+        """
+        if beta is None:
+            beta = read_mallet_beta(model.fstate())
+        return cls(model.word_topics, model.alpha, beta)
+
+    @classmethod
+    def from_state_file(cls, state_path, vocab_dict):
+        """
+        Create inferencer from a Mallet state file (see mallet_state.py), without loading the gensim model.
+        :param vocab_dict: gensim Dictionary the model was trained with (term ids of inferred documents refer to it)
+        """
+        state = read_mallet_state(state_path)
+        return cls(state.topic_word_counts_for(vocab_dict), state.alpha, state.beta)
+
+    def infer(self, docs, method='gibbs', iterations=100, burn_in=10, batch_tokens=1000000, tol=1e-3, seed=None):
+        """
+        Get topic distribution of each document.
+        :param docs: scipy.sparse matrix of shape (# docs, # terms) with term frequencies (e.g. CorpusStore.tf_matrix),
+                     or list of tf-lists of (term id, tf) tuples
+        :param method: 'gibbs' or 'vb'
+        :param iterations: number of Gibbs sweeps / maximum number of variational updates
+        :param burn_in: number of initial Gibbs sweeps not included in the averaged distributions
+        :param batch_tokens: approximate maximum number of tokens to process at once
+        :param tol: variational updates stop when the mean absolute change in topic proportions is below tol
+        :param seed: random seed for Gibbs sampling
+        :return: float32 array of shape (# docs, # topics)
+        """
+        if method not in ('gibbs', 'vb'):
+            raise ValueError("unknown inference method '{}'".format(method))
+        if iterations < 1:
+            raise ValueError("iterations must be at least 1, got {}".format(iterations))
+        tf_matrix = self._to_csr(docs)
+        rng = np.random.default_rng(seed)
+        doc_topics = np.empty((tf_matrix.shape[0], self.num_topics), dtype=np.float32)
+        for start, end in _token_batches(tf_matrix, batch_tokens):
+            batch = tf_matrix[start:end]
+            if method == 'gibbs':
+                doc_topics[start:end] = self._infer_gibbs(batch, iterations, burn_in, rng)
+            else:
+                doc_topics[start:end] = self._infer_vb(batch, iterations, tol)
+        return doc_topics
+
+    def _to_csr(self, docs):
+        if scipy.sparse.issparse(docs):
+            tf_matrix = scipy.sparse.csr_matrix(docs)
+        else:
+            indptr, ids, counts = [0], [], []
+            for doc_tf in docs:
+                ids.extend(term_id for term_id, _ in doc_tf)
+                counts.extend(count for _, count in doc_tf)
+                indptr.append(len(ids))
+            tf_matrix = scipy.sparse.csr_matrix((np.array(counts, dtype=np.int64), np.array(ids, dtype=np.int64),
+                                                 np.array(indptr, dtype=np.int64)),
+                                                shape=(len(indptr) - 1, max(ids, default=-1) + 1))
+        # terms the model wasn't trained with are ignored (as Mallet does)
+        if tf_matrix.shape[1] > self.num_terms:
+            tf_matrix = tf_matrix[:, :self.num_terms]
+        elif tf_matrix.shape[1] < self.num_terms:
+            tf_matrix = scipy.sparse.csr_matrix(tf_matrix, shape=(tf_matrix.shape[0], self.num_terms))
+        return tf_matrix
+
+    def _infer_gibbs(self, tf_matrix, iterations, burn_in, rng):
+        num_docs, num_topics = tf_matrix.shape[0], self.num_topics
+        # expand term frequencies into one entry per token
+        counts = tf_matrix.data.astype(np.int64)
+        words = np.repeat(tf_matrix.indices, counts)
+        docs = np.repeat(np.repeat(np.arange(num_docs), np.diff(tf_matrix.indptr)), counts)
+        doc_lens = np.bincount(docs, minlength=num_docs)
+        # float32 halves the memory traffic of the (# tokens, # topics) arrays that dominate sampling time
+        token_topic = self.word_topic[words].astype(np.float32)
+        alpha = self.alpha.astype(np.float32)
+        # initialize assignments from topic-word probabilities alone
+        topics = _sample_rows(token_topic, rng)
+        doc_topic_counts = _count_topics(docs, topics, num_docs, num_topics)
+        summed = np.zeros((num_docs, num_topics))
+        num_samples = 0
+        for iteration in range(iterations):
+            # counts of the doc of each token, excluding the token itself
+            weights = doc_topic_counts[docs].astype(np.float32) + alpha
+            weights[np.arange(len(topics)), topics] -= 1
+            topics = _sample_rows(token_topic * weights, rng)
+            doc_topic_counts = _count_topics(docs, topics, num_docs, num_topics)
+            if iteration >= min(burn_in, iterations - 1):
+                summed += doc_topic_counts
+                num_samples += 1
+        return (summed / num_samples + self.alpha) / (doc_lens + self.alpha.sum())[:, None]
+
+    def _infer_vb(self, tf_matrix, iterations, tol):
+        num_docs = tf_matrix.shape[0]
+        docs = np.repeat(np.arange(num_docs), np.diff(tf_matrix.indptr))
+        words, counts = tf_matrix.indices, tf_matrix.data.astype(np.float64)
+        word_topic = self.word_topic[words]
+        doc_lens = np.asarray(tf_matrix.sum(axis=1)).ravel()
+        gamma = self.alpha + (doc_lens / self.num_topics)[:, None]
+        for _ in range(iterations):
+            exp_e_log_theta = np.exp(digamma(gamma) - digamma(gamma.sum(axis=1))[:, None])
+            # normalizer of each (doc, term) pair's topic responsibilities
+            norms = np.einsum('ij,ij->i', exp_e_log_theta[docs], word_topic) + 1e-100
+            weighted = scipy.sparse.csr_matrix((counts / norms, words, tf_matrix.indptr), shape=tf_matrix.shape)
+            new_gamma = self.alpha + exp_e_log_theta * (weighted @ self.word_topic)
+            change = np.mean(np.abs(new_gamma - gamma) / gamma.sum(axis=1)[:, None])
+            gamma = new_gamma
+            if change < tol:
+                break
+        return gamma / gamma.sum(axis=1)[:, None]
+
+
+def read_mallet_beta(state_path, default=DEFAULT_BETA):
+    """
+    Read beta from the header of a Mallet state file (gzipped, with lines '#doc source pos ...', '#alpha : ...' and
+    '#beta : ...' before the token assignments). Returns default if the file doesn't exist.
+    """
+    if not os.path.exists(state_path):
+        return default
+    return read_mallet_params(state_path)[1]
+
+
+def _token_batches(tf_matrix, batch_tokens):
+    """
+    Split rows of tf_matrix into consecutive (start, end) ranges of roughly batch_tokens tokens each.
+    """
+    num_docs = tf_matrix.shape[0]
+    doc_lens = np.asarray(tf_matrix.sum(axis=1)).ravel()
+    cum_lens = np.cumsum(doc_lens)
+    start = 0
+    while start < num_docs:
+        offset = cum_lens[start - 1] if start else 0
+        end = max(start + 1, int(np.searchsorted(cum_lens, offset + batch_tokens, side='right')))
+        yield start, min(end, num_docs)
+        start = end
+
+
+def _sample_rows(weights, rng):
+    """
+    Sample a column index for each row of weights, with probability proportional to the row's weights.
+    """
+    cum_weights = np.cumsum(weights, axis=1)
+    draws = rng.random(len(weights)) * cum_weights[:, -1]
+    samples = (cum_weights < draws[:, None]).sum(axis=1)
+    return np.minimum(samples, weights.shape[1] - 1)
+
+
+def _count_topics(docs, topics, num_docs, num_topics):
+    return np.bincount(docs * num_topics + topics, minlength=num_docs * num_topics).reshape(num_docs, num_topics)
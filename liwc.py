@@ -0,0 +1,176 @@
+"""
+Count LIWC 2015 dictionary categories (e.g. RELIG, NEGEMO) in pre-processed posts/comments.
+The resulting per-document category matrix can be used as features alongside the topic distributions.
+"""
+import argparse
+import ast
+
+import numpy as np
+import pandas as pd
+
+from text_utils import LIWC_2015_PATH, read_file_by_lines
+
+_CATEGORIES_KEY = None  # key of trie node entry holding categories of wildcard entries that end at the node
+
+
+class LIWCDictionary:
+    """
+    LIWC dictionary compiled for fast lookup of the categories a word belongs to.
+
+    Plain entries (e.g. 'amen') are stored in a dict and wildcard entries (e.g. 'bless*', which match any word
+    starting with 'bless') in a prefix trie, so looking up a word costs O(word length) rather than a scan over all
+    wildcard entries. Multi-word entries (e.g. 'kind of' or '(i) like*') are ignored since matching is done one
+    word at a time.
+    """
+    def __init__(self, liwc_path=LIWC_2015_PATH):
+        """
+        :param liwc_path: path to LIWC dictionary file, where each line has the form '<entry> ,<CATEGORY>'
+        """
+        self.categories = []
+        category2id = {}
+        word_categories = {}
+        self.trie = {}
+        for line in read_file_by_lines(liwc_path):
+            if not line.strip():
+                continue
+            entry, category = line.rsplit(' ,', 1)
+            entry = entry.strip().lower()
+            category = category.strip()
+            if ' ' in entry:
+                continue
+            if category not in category2id:
+                category2id[category] = len(self.categories)
+                self.categories.append(category)
+            category_id = category2id[category]
+            if entry.endswith('*'):
+                node = self.trie
+                for char in entry[:-1]:
+                    node = node.setdefault(char, {})
+                node.setdefault(_CATEGORIES_KEY, set()).add(category_id)
+            else:
+                word_categories.setdefault(entry, set()).add(category_id)
+        self.word_categories = word_categories
+        self._cache = {}
+
+    def match(self, word):
+        """
+        Get ids (indices into self.categories) of categories that word belongs to.
+        :param word: str
+        :return: sorted tuple of category ids
+        """
+        categories = self._cache.get(word)
+        if categories is None:
+            key = word.lower()
+            found = set(self.word_categories.get(key, ()))
+            node = self.trie
+            if _CATEGORIES_KEY in node:
+                found.update(node[_CATEGORIES_KEY])
+            for char in key:
+                node = node.get(char)
+                if node is None:
+                    break
+                if _CATEGORIES_KEY in node:
+                    found.update(node[_CATEGORIES_KEY])
+            categories = tuple(sorted(found))
+            self._cache[word] = categories
+        return categories
+
+    def category_matrix(self, docs, normalize=False, split_phrases=True):
+        """
+        Count words from each LIWC category in each doc.
+        :param docs: list of docs, where each doc is either a list of words or a list of sentences (lists of words)
+        :param normalize: if True, return the percentage of words in each doc that belong to each category (as
+                          reported by LIWC) instead of counts
+        :param split_phrases: if True, match each part of bigram phrases (e.g. 'oil_leak') separately
+        :return: matrix: numpy array of shape (# docs, # categories), with columns ordered as self.categories
+        """
+        # map every word occurrence to a (doc index, word type index) pair
+        type2id = {}
+        type_ids = []
+        doc_lens = []
+        for doc in docs:
+            words = _doc_words(doc, split_phrases)
+            type_ids.extend(type2id.setdefault(word, len(type2id)) for word in words)
+            doc_lens.append(len(words))
+        num_docs, num_types, num_categories = len(doc_lens), len(type2id), len(self.categories)
+        doc_lens = np.array(doc_lens, dtype=np.int64)
+        if num_types == 0:
+            return np.zeros((num_docs, num_categories), dtype=np.float32 if normalize else np.int64)
+        # count each word type within each doc
+        keys = np.repeat(np.arange(num_docs, dtype=np.int64), doc_lens) * num_types + np.array(type_ids)
+        keys, pair_counts = np.unique(keys, return_counts=True)
+        pair_docs, pair_types = keys // num_types, keys % num_types
+        # look up categories once per word type (CSR layout: categories of type t are
+        # type_categories[type_indptr[t]:type_indptr[t + 1]])
+        type_matches = [self.match(word) for word in type2id]
+        num_matches = np.array([len(m) for m in type_matches], dtype=np.int64)
+        type_indptr = np.concatenate([[0], np.cumsum(num_matches)])
+        type_categories = np.array([c for m in type_matches for c in m], dtype=np.int64)
+        # expand each (doc, type) pair into one entry per category of the type, and sum counts
+        pair_num_matches = num_matches[pair_types]
+        total = pair_num_matches.sum()
+        offsets = np.arange(total) - np.repeat(np.cumsum(pair_num_matches) - pair_num_matches, pair_num_matches)
+        categories = type_categories[np.repeat(type_indptr[pair_types], pair_num_matches) + offsets]
+        matrix = np.bincount(np.repeat(pair_docs, pair_num_matches) * num_categories + categories,
+                             weights=np.repeat(pair_counts, pair_num_matches),
+                             minlength=num_docs * num_categories).reshape(num_docs, num_categories)
+        if normalize:
+            return (100 * matrix / np.maximum(doc_lens, 1)[:, None]).astype(np.float32)
+        return matrix.astype(np.int64)
+
+    def category_df(self, docs, index=None, normalize=False, split_phrases=True):
+        """
+        Same as category_matrix, but returns a pandas DataFrame with one column per category and a 'WC' (word count)
+        column. WC counts words the same way as the percentages are computed (phrase parts, if split_phrases is True).
+        """
+        docs = list(docs)
+        matrix = self.category_matrix(docs, normalize=normalize, split_phrases=split_phrases)
+        df = pd.DataFrame(matrix, columns=self.categories, index=index)
+        df['WC'] = [len(_doc_words(doc, split_phrases)) for doc in docs]
+        return df
+
+
+def _flatten_doc(doc):
+    if doc and not isinstance(doc[0], str):
+        return [word for sent in doc for word in sent]
+    return list(doc)
+
+
+def _doc_words(doc, split_phrases=True):
+    """
+    Words of doc that are counted, with phrases (e.g. 'oil_leak') split into their parts if split_phrases is True.
+    """
+    words = _flatten_doc(doc)
+    if split_phrases:
+        words = [part for word in words for part in word.split('_') if part]
+    return words
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", type=str, help="Path to processed posts CSV file (output of TextProcessor).")
+    parser.add_argument("--output_path", type=str, help="Path to CSV file to save LIWC features to.")
+    parser.add_argument("--liwc_path", type=str, default=LIWC_2015_PATH, help="Path to LIWC dictionary file.")
+    parser.add_argument("--counts", action="store_true",
+                        help="Save raw counts instead of percentage of words in each category.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """
+    Compute LIWC category features for the title + text of each post.
+    """
+    args = _parse_args()
+    liwc_dict = LIWCDictionary(args.liwc_path)
+    data_df = pd.read_csv(args.data_path, index_col=0)
+    # processed text is stored as string representations of lists of sentences
+    docs = [ast.literal_eval(title) + ast.literal_eval(text)
+            for title, text in zip(data_df["processed_title"], data_df["processed_text"])]
+    liwc_df = liwc_dict.category_df(docs, index=data_df.index, normalize=not args.counts)
+    liwc_df.insert(0, "id", data_df["id"])
+    liwc_df.to_csv(args.output_path)
+
+
+if __name__ == "__main__":
+    main()
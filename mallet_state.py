@@ -0,0 +1,167 @@
+"""
+Read the state file of a trained Mallet LDA model (model.fstate()) into count matrices.
+
+The state file is gzipped text, with a header line, then '#alpha : ...' and '#beta : ...' lines, then one line per
+token of the training corpus with the topic it was assigned to:
+    #doc source pos typeindex type topic
+The file is streamed in chunks and the counts are accumulated with NumPy, so only the count matrices (rather than a
+table with one row per token) are ever held in memory.
+"""
+import csv
+import gzip
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+_STATE_COLUMNS = [0, 3, 4, 5]  # doc, typeindex, type, topic
+
+
+def read_mallet_params(state_path):
+    """
+    Read the alpha and beta values from the header of a Mallet state file.
+    :return: alpha (array with one value for each topic), beta (float)
+    """
+    with gzip.open(state_path, 'rt', encoding='utf-8') as f:
+        f.readline()
+        alpha = np.array([float(x) for x in f.readline().split(":")[1].split()])
+        beta = float(f.readline().split(":")[1])
+    return alpha, beta
+
+
+def read_mallet_state(state_path, num_docs=None, chunksize=1000000):
+    """
+    Read Mallet state file into count matrices.
+    Every type index from 0 to the largest one must appear in the file (as it does for a model trained on a corpus,
+    whose types are only the words of its documents), since the type strings are only recorded there.
+    :param state_path: path to state file (e.g. model.fstate())
+    :param num_docs: number of documents the model was trained on. Documents without tokens have no lines in the file,
+                     so without this, empty documents at the end of the corpus are missing from doc_topic_counts
+    :param chunksize: number of token lines read at a time
+    :return: MalletState
+    """
+    alpha, beta = read_mallet_params(state_path)
+    num_topics = len(alpha)
+    doc_keys, doc_counts = [], []
+    word_topic_counts = np.zeros((0, num_topics), dtype=np.int64)
+    vocab = {}
+    chunks = pd.read_csv(state_path, compression='gzip', sep=' ', header=None, skiprows=3, usecols=_STATE_COLUMNS,
+                         dtype={0: np.int64, 3: np.int64, 4: str, 5: np.int64}, quoting=csv.QUOTE_NONE,
+                         na_filter=False, chunksize=chunksize)
+    for chunk in chunks:
+        docs, type_ids, topics = chunk[0].to_numpy(), chunk[3].to_numpy(), chunk[5].to_numpy()
+        # docs are written in order, so counting (doc, topic) pairs per chunk keeps only ~nnz pairs in memory
+        keys, counts = np.unique(docs * num_topics + topics, return_counts=True)
+        doc_keys.append(keys)
+        doc_counts.append(counts)
+        num_types = int(type_ids.max()) + 1
+        if num_types > len(word_topic_counts):
+            word_topic_counts = np.concatenate(
+                [word_topic_counts, np.zeros((num_types - len(word_topic_counts), num_topics), dtype=np.int64)])
+        word_topic_counts += np.bincount(type_ids * num_topics + topics,
+                                         minlength=len(word_topic_counts) * num_topics).reshape(-1, num_topics)
+        # record the string of each type the first time its index is seen
+        new_type_ids, first_idx = np.unique(type_ids, return_index=True)
+        words = chunk[4].to_numpy()
+        for type_id, idx in zip(new_type_ids.tolist(), first_idx.tolist()):
+            if type_id not in vocab:
+                vocab[type_id] = words[idx]
+    keys = np.concatenate(doc_keys) if doc_keys else np.zeros(0, dtype=np.int64)
+    counts = np.concatenate(doc_counts) if doc_counts else np.zeros(0, dtype=np.int64)
+    last_doc = int(keys.max()) // num_topics if len(keys) else -1
+    if num_docs is None:
+        num_docs = last_doc + 1
+    elif last_doc >= num_docs:
+        raise ValueError("state file {} has tokens of doc {}, but num_docs is {}".format(state_path, last_doc,
+                                                                                         num_docs))
+    # duplicate (doc, topic) pairs (a doc split across chunks) are summed when converting to CSR
+    doc_topic_counts = scipy.sparse.coo_matrix((counts, (keys // num_topics, keys % num_topics)),
+                                               shape=(num_docs, num_topics)).tocsr()
+    if len(vocab) < len(word_topic_counts):
+        missing = sorted(set(range(len(word_topic_counts))) - set(vocab))
+        raise ValueError("state file {} has no tokens of type indices {}".format(state_path, missing[:10]))
+    vocab = [vocab[type_id] for type_id in range(len(word_topic_counts))]
+    return MalletState(alpha, beta, doc_topic_counts, np.ascontiguousarray(word_topic_counts.T), vocab)
+
+
+class MalletState:
+    """
+    Token-topic assignment counts of a trained Mallet model.
+    """
+    def __init__(self, alpha, beta, doc_topic_counts, topic_word_counts, vocab):
+        """
+        :param alpha: array with Dirichlet prior of each topic
+        :param beta: Dirichlet prior on topic-word distributions
+        :param doc_topic_counts: scipy.sparse.csr_matrix of shape (# docs, # topics), with number of tokens of each
+                                 doc assigned to each topic
+        :param topic_word_counts: array of shape (# topics, # types), with number of tokens of each type assigned to
+                                  each topic
+        :param vocab: list of types (words), where vocab[i] is the word of Mallet type index i
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.doc_topic_counts = doc_topic_counts
+        self.topic_word_counts = topic_word_counts
+        self.vocab = vocab
+
+    @property
+    def num_topics(self):
+        return len(self.alpha)
+
+    @property
+    def doc_lengths(self):
+        return np.asarray(self.doc_topic_counts.sum(axis=1)).ravel()
+
+    @property
+    def term_frequency(self):
+        return self.topic_word_counts.sum(axis=0)
+
+    def topic_word_dists(self):
+        """
+        Topic-word distributions, smoothed by beta. Array of shape (# topics, # types).
+        """
+        return _smooth_and_normalize(self.topic_word_counts, self.beta)
+
+    def doc_topic_dists(self):
+        """
+        Doc-topic distributions, smoothed by alpha. Array of shape (# docs, # topics).
+        """
+        return _smooth_and_normalize(self.doc_topic_counts.toarray(), self.alpha)
+
+    def topic_word_counts_for(self, vocab_dict):
+        """
+        Topic-word counts with columns ordered by the ids of vocab_dict (e.g. the gensim Dictionary the model was
+        trained with) rather than Mallet's type indices. Words that aren't in vocab_dict are dropped.
+        :return: array of shape (# topics, len(vocab_dict))
+        """
+        counts = np.zeros((self.num_topics, len(vocab_dict)), dtype=np.int64)
+        type_ids, word_ids = [], []
+        for type_id, word in enumerate(self.vocab):
+            word_id = vocab_dict.token2id.get(word)
+            if word_id is not None:
+                type_ids.append(type_id)
+                word_ids.append(word_id)
+        counts[:, word_ids] = self.topic_word_counts[:, type_ids]
+        return counts
+
+    def pyldavis_data(self):
+        """
+        Inputs for pyLDAvis.prepare. As in the topic-quality notebook, terms are sorted alphabetically and documents
+        without tokens are left out.
+        :return: dict with 'topic_term_dists', 'doc_topic_dists', 'doc_lengths', 'vocab' and 'term_frequency'
+        """
+        order = np.argsort(np.array(self.vocab, dtype=object), kind="stable")
+        doc_lengths = self.doc_lengths
+        non_empty = doc_lengths > 0
+        return {
+            'topic_term_dists': self.topic_word_dists()[:, order],
+            'doc_topic_dists': _smooth_and_normalize(self.doc_topic_counts[non_empty].toarray(), self.alpha),
+            'doc_lengths': doc_lengths[non_empty].tolist(),
+            'vocab': [self.vocab[i] for i in order],
+            'term_frequency': self.term_frequency[order].tolist(),
+        }
+
+
+def _smooth_and_normalize(counts, smooth_value):
+    matrix = counts + np.asarray(smooth_value, dtype=np.float64)
+    return matrix / matrix.sum(axis=1, keepdims=True)
@@ -0,0 +1,444 @@
+"""
+Run the preprocessing and topic model workflow as a pipeline of cached stages:
+
+    filter_<subreddit> --> process_posts_<subreddit>
+            |
+            +--> corpus --> topic_model_<k> --> doc_topics_<k> --> comment_topics_<k>
+
+Each stage declares its input files, the stages it depends on, its parameters and the source files it runs. These
+are hashed into a key, and the stage writes its outputs to <output_dir>/<stage name>/<key>/. A stage is only run if
+there is no complete output directory for its current key, so e.g. changing the number of topics only reruns the
+topic model stages (and the stages after them), while the filtered data and corpus are reused. Changing an input file,
+parameter or the code of a stage reruns that stage and everything downstream of it. Outputs of earlier runs are kept,
+so switching back to an earlier parameter setting doesn't rerun anything.
+
+Stages that don't depend on each other (e.g. filtering of different subreddits, or topic models with different k)
+run in parallel with --workers > 1. The output directory of each stage in the last run is listed in
+<output_dir>/latest.json.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import instrumentation
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGE_INFO_FILE = "stage.json"
+FILE_HASHES_FILE = "file_hashes.json"
+
+
+class Stage:
+    """
+    A step of the pipeline. fn is called as fn(output_dir, deps, **inputs, **params, **options), where deps maps the
+    names of the stages in deps to their output directories, and must write its outputs to output_dir.
+    """
+    def __init__(self, name, fn, deps=(), inputs=None, params=None, options=None, code=()):
+        """
+        :param name: name of stage
+        :param fn: module-level function that runs the stage (so it can be sent to a worker process)
+        :param deps: names of stages whose outputs this stage reads
+        :param inputs: dict of argument name -> path of input file (hashed by content, so moving a file doesn't
+                       change the key)
+        :param params: dict of parameters that affect the outputs (must be JSON-serializable)
+        :param options: dict of arguments that don't affect the outputs (e.g. number of processes, tool paths), so
+                        aren't hashed
+        :param code: source files (relative to this directory) that the stage runs, including the modules they import;
+                     changing them reruns the stage
+        """
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.inputs = dict(inputs or {})
+        self.params = dict(params or {})
+        self.options = dict(options or {})
+        self.code = list(code)
+
+
+class Pipeline:
+    """
+    Runs stages in dependency order, skipping those whose outputs for the current key already exist.
+    """
+    def __init__(self, stages, output_dir):
+        """
+        :param stages: list of Stage
+        :param output_dir: directory that stage outputs are saved under
+        """
+        self.stages = {}
+        for stage in stages:
+            assert stage.name not in self.stages, "duplicate stage name {}".format(stage.name)
+            self.stages[stage.name] = stage
+        for stage in stages:
+            for dep in stage.deps:
+                assert dep in self.stages, "stage {} depends on unknown stage {}".format(stage.name, dep)
+        self.output_dir = output_dir
+        self._file_hashes_path = os.path.join(output_dir, FILE_HASHES_FILE)
+        self._file_hashes = None
+        self._keys = {}
+
+    def order(self):
+        """
+        Names of all stages in dependency order (raises ValueError if there is a cycle).
+        """
+        order, state = [], {}
+
+        def visit(name):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError("dependency cycle at stage {}".format(name))
+            state[name] = "visiting"
+            for dep in self.stages[name].deps:
+                visit(dep)
+            state[name] = "done"
+            order.append(name)
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def key(self, name):
+        """
+        Hash of the stage's parameters, input file contents, code and the keys of the stages it depends on.
+        """
+        if name not in self._keys:
+            stage = self.stages[name]
+            description = {
+                "stage": name,
+                "params": stage.params,
+                "inputs": {arg: self._file_hash(path) for arg, path in stage.inputs.items()},
+                "code": {path: self._file_hash(os.path.join(CODE_DIR, path)) for path in stage.code},
+                "deps": {dep: self.key(dep) for dep in stage.deps},
+            }
+            self._keys[name] = hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        return self._keys[name]
+
+    def stage_dir(self, name):
+        return os.path.join(os.path.abspath(self.output_dir), name, self.key(name))
+
+    def is_complete(self, name):
+        return os.path.exists(os.path.join(self.stage_dir(name), STAGE_INFO_FILE))
+
+    def plan(self, targets=None, force=()):
+        """
+        Stages that need to be run to produce targets.
+        :param targets: names of stages whose outputs are wanted (all stages if None)
+        :param force: names of stages to rerun even if their outputs exist
+        :return: list of stage names, in dependency order
+        """
+        to_run = set()
+
+        def require(name):
+            if name in to_run or (self.is_complete(name) and name not in force):
+                return
+            to_run.add(name)
+            for dep in self.stages[name].deps:
+                require(dep)
+        for name in targets or self.stages:
+            if name not in self.stages:
+                raise KeyError("unknown stage {}".format(name))
+            require(name)
+        return [name for name in self.order() if name in to_run]
+
+    def print_plan(self, to_run):
+        for name in self.order():
+            print("{} {} ({})".format("run " if name in to_run else "skip", name, self.stage_dir(name)))
+
+    def run(self, targets=None, force=(), workers=1):
+        """
+        Run the stages needed to produce targets. Stages whose dependencies are done are started as soon as a worker is
+        free. If a stage fails, the stages that depend on it are skipped, the others still run, and an error is raised
+        at the end.
+        :param workers: number of stages to run at once (in worker processes if > 1)
+        :return: dict of stage name -> output directory, for all stages
+        """
+        to_run = self.plan(targets, force)
+        self.print_plan(to_run)
+        pending = list(to_run)
+        running, failed = {}, {}
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 and len(to_run) > 1 else None
+        try:
+            while pending or running:
+                for name in list(pending):
+                    deps = self.stages[name].deps
+                    if any(dep in failed for dep in deps):
+                        pending.remove(name)
+                        failed[name] = "skipped: dependency failed"
+                    elif len(running) < max(workers, 1) and not any(dep in pending or dep in running.values() for dep in deps):
+                        pending.remove(name)
+                        running[self._submit(executor, name)] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        info = future.result()
+                    except Exception as e:
+                        failed[name] = "{}: {}".format(type(e).__name__, e)
+                        print("stage {} failed: {}".format(name, failed[name]))
+                        continue
+                    with open(os.path.join(self.stage_dir(name), STAGE_INFO_FILE), "w") as f:
+                        json.dump(info, f, indent=2)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        stage_dirs = {name: self.stage_dir(name) for name in self.order()}
+        with open(os.path.join(self.output_dir, "latest.json"), "w") as f:
+            json.dump(stage_dirs, f, indent=2)
+        if failed:
+            raise RuntimeError("stages failed: {}".format(failed))
+        return stage_dirs
+
+    def _submit(self, executor, name):
+        stage = self.stages[name]
+        stage_dir = self.stage_dir(name)
+        # clear out outputs of an earlier run that didn't complete
+        if os.path.exists(stage_dir):
+            shutil.rmtree(stage_dir)
+        os.makedirs(stage_dir)
+        args = (stage.fn, name, stage_dir, {dep: self.stage_dir(dep) for dep in stage.deps}, stage.inputs,
+                stage.params, stage.options)
+        info = {
+            "stage": name,
+            "key": self.key(name),
+            "params": stage.params,
+            "inputs": {arg: {"path": path, "sha1": self._file_hash(path)} for arg, path in stage.inputs.items()},
+            "deps": {dep: self.stage_dir(dep) for dep in stage.deps},
+        }
+        if executor is not None:
+            future = executor.submit(_run_stage, info, *args)
+        else:
+            # run in this process; wrap the result in a future so the scheduling loop is the same
+            future = _completed_future(_run_stage, info, *args)
+        return future
+
+    def _file_hash(self, path):
+        """
+        SHA-1 of the file's contents. Hashes are cached by path, size and modification time, so large input files are
+        only re-read when they change.
+        """
+        if self._file_hashes is None:
+            self._file_hashes = {}
+            if os.path.exists(self._file_hashes_path):
+                with open(self._file_hashes_path) as f:
+                    self._file_hashes = json.load(f)
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        cached = self._file_hashes.get(path)
+        if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+            return cached["sha1"]
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        self._file_hashes[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": sha.hexdigest()}
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        with open(self._file_hashes_path, "w") as f:
+            json.dump(self._file_hashes, f)
+        return sha.hexdigest()
+
+
+def _run_stage(info, fn, name, stage_dir, deps, inputs, params, options):
+    start = time.time()
+    with instrumentation.stage("pipeline_{}".format(name)):
+        fn(stage_dir, deps, **inputs, **params, **options)
+    return dict(info, seconds=time.time() - start, finished=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+def _completed_future(fn, *args):
+    from concurrent.futures import Future
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+# stage functions (module-level, and importing the pipeline code lazily so that planning a run is cheap)
+
+def filter_data(output_dir, deps, posts_path, comments_path, moderators_path, subreddit, seed, chunksize=100000):
+    """
+    Filter raw posts and comments of a subreddit (see data_processor.py) and assign posts to a train/val/test split.
+    Outputs: <subreddit>/posts.csv, <subreddit>/comments.csv
+    """
+    import numpy as np
+    from data_processor import CommentProcessor, PostProcessor
+    subreddit_dir = os.path.join(output_dir, subreddit)
+    os.makedirs(subreddit_dir)
+    # data split assignments are drawn with np.random
+    np.random.seed(seed)
+    PostProcessor(posts_path, moderators_path, stream=True).stream_filter(
+        os.path.join(subreddit_dir, "posts.csv"), chunksize=chunksize, assign_datasplit=True)
+    CommentProcessor(comments_path, moderators_path, stream=True).stream_filter(
+        os.path.join(subreddit_dir, "comments.csv"), chunksize=chunksize)
+
+
+def process_posts(output_dir, deps, subreddit, lemmatize=True, remove_stops=True, n_process=1):
+    """
+    Pre-process the text of filtered posts (see data_processor.TextProcessor).
+    Outputs: <subreddit>/processed_posts.csv
+    """
+    from data_processor import TextProcessor
+    text_processor = TextProcessor(os.path.join(deps["filter_{}".format(subreddit)], subreddit, "posts.csv"),
+                                   lemmatize=lemmatize, remove_stops=remove_stops, n_process=n_process)
+    text_processor.process_text()
+    os.makedirs(os.path.join(output_dir, subreddit))
+    text_processor.data_df.to_csv(os.path.join(output_dir, subreddit, "processed_posts.csv"))
+
+
+def make_corpus(output_dir, deps, subreddits, corpus_name, downsample=True, seed=None, n_process=1):
+    """
+    Build topic model corpus from filtered posts and comments (see topic_model_corpus.Corpus).
+    Outputs: files saved by Corpus.save_corpus
+    """
+    from topic_model_corpus import Corpus
+    csv_files = [os.path.join(deps["filter_{}".format(subreddit)], subreddit, "{}.csv".format(name))
+                 for subreddit in subreddits for name in ["posts", "comments"]]
+    corpus = Corpus(csv_files, downsample=downsample, seed=seed)
+    corpus.make_corpus(n_process=n_process)
+    corpus.save_corpus(output_dir, corpus_name)
+
+
+def train_topic_model(output_dir, deps, corpus_name, num_topics, mallet_path, workers=1):
+    """
+    Train Mallet LDA topic model on corpus (see topic_model.TopicModel).
+    Outputs: <corpus_name>_<num_topics>_topics.mdl and the Mallet files it needs (in mallet/)
+    """
+    import gensim.corpora as corpora
+    from corpus_store import load_corpus
+    from topic_model import TopicModel
+    corpus = load_corpus(deps["corpus"], corpus_name)
+    vocab_dict = corpora.Dictionary.load(os.path.join(deps["corpus"], "{}_vocab.dct".format(corpus_name)))
+    topic_model = TopicModel(corpus.docs(), corpus.bow_corpus(), vocab_dict, num_topics,
+                             os.path.join(output_dir, "mallet"))
+    topic_model.train_lda_mallet_model(mallet_path, workers=workers)
+    topic_model.save_model(output_dir, corpus_name)
+
+
+def infer_doc_topics(output_dir, deps, corpus_name, num_topics, inference="numpy", method="gibbs", iterations=100,
+                     seed=None):
+    """
+    Infer topic distribution of each document in corpus (see get_document_topic_distributions.py).
+    Outputs: doc_topic_distributions.csv, doc_topic_distributions.npy
+    """
+    import gensim
+    from corpus_store import load_corpus
+    from get_document_topic_distributions import get_doc_topic_metrics
+    from topic_model import get_model_path
+    model_path = get_model_path(deps["topic_model_{}".format(num_topics)], corpus_name, num_topics)
+    topic_model = gensim.models.wrappers.ldamallet.LdaMallet.load(model_path)
+    get_doc_topic_metrics(load_corpus(deps["corpus"], corpus_name), topic_model, output_dir, inference=inference,
+                          method=method, iterations=iterations, seed=seed)
+
+
+def comment_topics(output_dir, deps, subreddits, num_topics, include_replies=False, seed=None):
+    """
+    Compute measures of the topics of the comments of each post (see get_comment_topic_dists_for_posts.py).
+    Outputs: all_posts_with_comment_topics.csv
+    """
+    from get_comment_topic_dists_for_posts import get_post_comment_topics
+    filter_dirs = [os.path.join(deps["filter_{}".format(subreddit)], subreddit) for subreddit in subreddits]
+    get_post_comment_topics(os.path.join(deps["doc_topics_{}".format(num_topics)], "doc_topic_distributions.csv"),
+                            [os.path.join(filter_dir, "posts.csv") for filter_dir in filter_dirs],
+                            [os.path.join(filter_dir, "comments.csv") for filter_dir in filter_dirs],
+                            os.path.join(output_dir, "all_posts_with_comment_topics.csv"),
+                            include_replies=include_replies, seed=seed)
+
+
+def build_pipeline(args):
+    """
+    Declare the stages of the workflow from command line arguments.
+    :return: Pipeline
+    """
+    stages = []
+    for subreddit in args.subreddits:
+        stages.append(Stage(
+            "filter_{}".format(subreddit), filter_data,
+            inputs={"posts_path": os.path.join(args.raw_dir, subreddit, "posts.csv"),
+                    "comments_path": os.path.join(args.raw_dir, subreddit, "comments.csv"),
+                    "moderators_path": args.moderators_path},
+            params={"subreddit": subreddit, "seed": args.seed},
+            code=["data_processor.py", "text_utils.py", "instrumentation.py"]))
+        stages.append(Stage(
+            "process_posts_{}".format(subreddit), process_posts, deps=["filter_{}".format(subreddit)],
+            params={"subreddit": subreddit, "lemmatize": True, "remove_stops": True},
+            options={"n_process": args.n_process},
+            code=["data_processor.py", "text_utils.py", "instrumentation.py"]))
+    stages.append(Stage(
+        "corpus", make_corpus, deps=["filter_{}".format(subreddit) for subreddit in args.subreddits],
+        params={"subreddits": args.subreddits, "corpus_name": args.corpus_name, "downsample": not args.no_downsample,
+                "seed": args.seed},
+        options={"n_process": args.n_process},
+        code=["topic_model_corpus.py", "text_utils.py", "corpus_store.py", "instrumentation.py"]))
+    for num_topics in args.num_topics:
+        stages.append(Stage(
+            "topic_model_{}".format(num_topics), train_topic_model, deps=["corpus"],
+            params={"corpus_name": args.corpus_name, "num_topics": num_topics},
+            options={"mallet_path": args.mallet_path, "workers": args.mallet_workers},
+            code=["topic_model.py", "corpus_store.py", "instrumentation.py"]))
+        stages.append(Stage(
+            "doc_topics_{}".format(num_topics), infer_doc_topics,
+            deps=["corpus", "topic_model_{}".format(num_topics)],
+            params={"corpus_name": args.corpus_name, "num_topics": num_topics, "inference": args.inference,
+                    "method": args.method, "iterations": args.iterations, "seed": args.seed},
+            code=["get_document_topic_distributions.py", "lda_inference.py", "mallet_state.py", "corpus_store.py",
+                  "topic_model.py", "instrumentation.py"]))
+        stages.append(Stage(
+            "comment_topics_{}".format(num_topics), comment_topics,
+            deps=["doc_topics_{}".format(num_topics)] + ["filter_{}".format(subreddit) for subreddit in args.subreddits],
+            params={"subreddits": args.subreddits, "num_topics": num_topics, "include_replies": args.include_replies,
+                    "seed": args.seed},
+            code=["get_comment_topic_dists_for_posts.py", "instrumentation.py"]))
+    return Pipeline(stages, args.output_dir)
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--raw_dir", type=str, required=True,
+                        help="Path to directory with raw <subreddit>/posts.csv and <subreddit>/comments.csv files.")
+    parser.add_argument("--moderators_path", type=str, required=True, help="Path to text file with list of moderators.")
+    parser.add_argument("--subreddits", type=str, nargs="+", default=["ttcafterloss", "infertility"],
+                        help="Subreddits to process.")
+    parser.add_argument("--output_dir", type=str, default="pipeline_runs",
+                        help="Path to directory to save stage outputs to.")
+    parser.add_argument("--corpus_name", type=str, default="reddit", help="Name of corpus used in naming files.")
+    parser.add_argument("--no_downsample", action="store_true",
+                        help="If set, use all posts and comments in corpus instead of an equal number from each file.")
+    parser.add_argument("--num_topics", type=int, nargs="+", default=[10],
+                        help="Number(s) of topics of topic models to train.")
+    parser.add_argument("--mallet_path", type=str, help="Path to mallet binary.")
+    parser.add_argument("--mallet_workers", type=int, default=4, help="Number of threads to train each model with.")
+    parser.add_argument("--inference", type=str, choices=["numpy", "mallet"], default="numpy",
+                        help="Inference implementation used to get document topic distributions.")
+    parser.add_argument("--method", type=str, choices=["gibbs", "vb"], default="gibbs",
+                        help="Inference method to use with --inference numpy.")
+    parser.add_argument("--iterations", type=int, default=100, help="Number of inference iterations.")
+    parser.add_argument("--include_replies", action="store_true",
+                        help="If set, use all comments in each post's reply tree rather than only direct replies.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed used by all stages.")
+    parser.add_argument("--n_process", type=int, default=1, help="Number of processes to pre-process text with.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of stages to run at once.")
+    parser.add_argument("--targets", type=str, nargs="+", default=None,
+                        help="Stages to produce outputs for (default: all).")
+    parser.add_argument("--force", type=str, nargs="+", default=[], help="Stages to rerun even if up to date.")
+    parser.add_argument("--dry_run", action="store_true", help="If set, only print which stages would run.")
+    args = parser.parse_args()
+    if args.iterations < 1:
+        parser.error("--iterations must be at least 1")
+    return args
+
+
+def main():
+    args = _parse_args()
+    pipeline = build_pipeline(args)
+    if args.dry_run:
+        pipeline.print_plan(pipeline.plan(args.targets, args.force))
+        return
+    pipeline.run(args.targets, args.force, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Find the most similar posts to each post in an embedding store (or any embedding matrix), by cosine similarity.
+
+Two search modes are supported:
+* exact: query embeddings are compared with every row, a block of rows at a time (one matrix multiply per block), and
+  the top k of each block are selected with argpartition rather than a full sort
+* ivf: rows are partitioned by a k-means coarse quantizer (an "inverted file" index), and each query is only compared
+  with the rows of the n_probe partitions whose centers are closest to it. This is approximate, but much faster for
+  large collections.
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from embedding_store import EmbeddingStore
+
+
+class SimilarityIndex:
+    """
+    Index over embeddings for top-k cosine similarity queries.
+    """
+    def __init__(self, embeddings, subreddits=None, block_size=8192):
+        """
+        :param embeddings: array of shape (# rows, dim), e.g. EmbeddingStore.embeddings (it's read block by block, so it
+                           can be memory-mapped)
+        :param subreddits: optional array with subreddit of each row, for filtering results by subreddit
+        :param block_size: number of rows compared with queries at a time (each block of scores is query batch size x
+                           block_size floats, 8MB with the defaults)
+        """
+        self.embeddings = embeddings
+        self.subreddits = None if subreddits is None else np.asarray(subreddits)
+        self.block_size = block_size
+        # inverse norms are computed once, so rows never need to be renormalized (or copied) at query time
+        norms = np.concatenate([np.linalg.norm(self._block(start), axis=1)
+                                for start in range(0, len(embeddings), block_size)] or [np.zeros(0)])
+        self.inv_norms = np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0).astype(np.float32)
+        self.centers = None
+        self.list_indptr = None
+        self.list_rows = None
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def _block(self, start, end=None):
+        return np.asarray(self.embeddings[start:end or start + self.block_size], dtype=np.float32)
+
+    def build_ivf(self, n_lists=None, n_iter=20, sample_size=None, seed=None):
+        """
+        Build coarse quantizer for ivf search: k-means (on normalized embeddings) with n_lists clusters, and the list of
+        rows assigned to each cluster.
+        :param n_lists: number of partitions (defaults to ~sqrt(# rows))
+        :param n_iter: number of k-means iterations
+        :param sample_size: number of rows k-means is fit on (defaults to 256 per partition)
+        :param seed: random seed for sampling rows and initializing centers
+        """
+        rng = np.random.default_rng(seed)
+        n_lists = n_lists or max(1, int(np.sqrt(len(self))))
+        sample_size = min(len(self), sample_size or 256 * n_lists)
+        sample_idx = np.sort(rng.choice(len(self), size=sample_size, replace=False))
+        sample = np.asarray(self.embeddings[sample_idx], dtype=np.float32) * self.inv_norms[sample_idx, None]
+        self.centers = _spherical_kmeans(sample, n_lists, n_iter, rng)
+        assignments = np.concatenate([
+            np.argmax(self._block(start) @ self.centers.T, axis=1) for start in range(0, len(self), self.block_size)])
+        self.list_rows = np.argsort(assignments, kind="stable")
+        self.list_indptr = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+
+    def search(self, queries, k=10, mode="exact", n_probe=8, subreddit=None, query_batch_size=256):
+        """
+        Find the k most similar rows to each query.
+        :param queries: array of shape (# queries, dim)
+        :param k: number of results per query
+        :param mode: 'exact' or 'ivf' (requires build_ivf to have been called)
+        :param n_probe: number of partitions searched per query in ivf mode
+        :param subreddit: if given, only return rows from this subreddit (or list of subreddits)
+        :param query_batch_size: number of queries handled at once in exact mode
+        :return: indices: array of shape (# queries, k) with row indices ordered from most to least similar (-1 if
+                          fewer than k rows match),
+                 scores: array of shape (# queries, k) with cosine similarities (-inf where index is -1)
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        allowed = None
+        if subreddit is not None:
+            assert self.subreddits is not None, "index was built without subreddits"
+            allowed = np.isin(self.subreddits, np.atleast_1d(subreddit))
+        if mode == "exact":
+            results = [self._search_exact(queries[start:start + query_batch_size], k, allowed)
+                       for start in range(0, len(queries), query_batch_size)]
+        elif mode == "ivf":
+            assert self.centers is not None, "call build_ivf before searching in ivf mode"
+            results = [self._search_ivf(query, k, n_probe, allowed) for query in queries]
+            results = [(indices[None], scores[None]) for indices, scores in results]
+        else:
+            raise ValueError("unknown search mode '{}'".format(mode))
+        if not results:
+            return np.zeros((0, k), dtype=np.int64), np.zeros((0, k), dtype=np.float32)
+        return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+    def query_all(self, k=10, mode="exact", n_probe=8, subreddit=None, batch_size=256):
+        """
+        Find the k most similar rows to every row (excluding the row itself).
+        :param subreddit: if given, only return rows from this subreddit (or list of subreddits)
+        :return: same as search, with one row of results per row of the index
+        """
+        all_indices, all_scores = [], []
+        for start in range(0, len(self), batch_size):
+            end = min(start + batch_size, len(self))
+            indices, scores = self.search(self._block(start, end), k=k + 1, mode=mode, n_probe=n_probe,
+                                          subreddit=subreddit, query_batch_size=batch_size)
+            # drop each row from its own results (or the last result, if the row wasn't found, e.g. in ivf mode)
+            is_self = indices == np.arange(start, end)[:, None]
+            is_self[~is_self.any(axis=1), -1] = True
+            all_indices.append(indices[~is_self].reshape(-1, k))
+            all_scores.append(scores[~is_self].reshape(-1, k))
+        return np.concatenate(all_indices), np.concatenate(all_scores)
+
+    def _search_exact(self, queries, k, allowed):
+        best_indices = np.full((len(queries), 0), -1, dtype=np.int64)
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        for start in range(0, len(self), self.block_size):
+            end = min(start + self.block_size, len(self))
+            scores = (queries @ self._block(start, end).T) * self.inv_norms[start:end]
+            if allowed is not None:
+                scores[:, ~allowed[start:end]] = -np.inf
+            indices, scores = _top_k(scores, k)
+            best_indices = np.concatenate([best_indices, indices + start], axis=1)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_indices, best_scores = _take_top_k(best_indices, best_scores, k)
+        return _pad(best_indices, best_scores, k)
+
+    def _search_ivf(self, query, k, n_probe, allowed):
+        center_scores = self.centers @ query
+        lists = _top_k(center_scores[None], n_probe)[0][0]
+        rows = np.concatenate([self.list_rows[self.list_indptr[i]:self.list_indptr[i + 1]] for i in lists])
+        if allowed is not None:
+            rows = rows[allowed[rows]]
+        rows = np.sort(rows)
+        scores = (np.asarray(self.embeddings[rows], dtype=np.float32) @ query) * self.inv_norms[rows]
+        indices, scores = _top_k(scores[None], k)
+        indices, scores = _pad(rows[indices], scores, k)
+        return indices[0], scores[0]
+
+
+def _top_k(scores, k):
+    """
+    Column indices and values of the k largest values in each row of scores, ordered from largest to smallest.
+    """
+    if scores.shape[1] > k:
+        indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    return _take_top_k(indices, np.take_along_axis(scores, indices, axis=1), k)
+
+
+def _take_top_k(indices, scores, k):
+    """
+    Keep the k highest-scoring (index, score) pairs of each row, ordered from highest to lowest score.
+    """
+    order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    indices, scores = np.take_along_axis(indices, order, axis=1), np.take_along_axis(scores, order, axis=1)
+    # filtered-out rows have score -inf
+    indices = np.where(np.isneginf(scores), -1, indices)
+    return indices, scores
+
+
+def _pad(indices, scores, k):
+    missing = k - indices.shape[1]
+    if missing > 0:
+        indices = np.pad(indices, ((0, 0), (0, missing)), constant_values=-1)
+        scores = np.pad(scores, ((0, 0), (0, missing)), constant_values=-np.inf)
+    return indices, scores.astype(np.float32)
+
+
+def _spherical_kmeans(x, n_clusters, n_iter, rng):
+    """
+    k-means on unit vectors, with centers renormalized to unit length each iteration (so assignment is by cosine
+    similarity).
+    """
+    n_clusters = min(n_clusters, len(x))
+    centers = x[rng.choice(len(x), size=n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = np.argmax(x @ centers.T, axis=1)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, assignments, x)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        # re-seed empty clusters with random points
+        empty = counts == 0
+        sums[empty] = x[rng.choice(len(x), size=empty.sum())]
+        centers = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+    return centers
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store_dir", type=str, help="Path to embedding store (see embedding_store.py).")
+    parser.add_argument("--output_path", type=str, help="Path to CSV file to save nearest neighbours to.")
+    parser.add_argument("--k", type=int, default=5, help="Number of similar posts to find for each post.")
+    parser.add_argument("--mode", type=str, choices=["exact", "ivf"], default="exact", help="Search mode.")
+    parser.add_argument("--n_lists", type=int, default=None, help="Number of partitions of the ivf index.")
+    parser.add_argument("--n_probe", type=int, default=8, help="Number of partitions searched per query (ivf mode).")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for building the ivf index.")
+    parser.add_argument("--subreddit", type=str, nargs="+", default=None,
+                        help="Only find similar posts from these subreddits (needs a 'subreddit' metadata column).")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """
+    Find the most similar posts to every post in an embedding store.
+    """
+    args = _parse_args()
+    store = EmbeddingStore(args.store_dir)
+    subreddits = store.metadata["subreddit"].to_numpy() if "subreddit" in store.metadata.columns else None
+    index = SimilarityIndex(store.embeddings, subreddits=subreddits)
+    if args.mode == "ivf":
+        index.build_ivf(n_lists=args.n_lists, seed=args.seed)
+    indices, scores = index.query_all(k=args.k, mode=args.mode, n_probe=args.n_probe, subreddit=args.subreddit)
+    ids = np.array(store.ids + [None], dtype=object)  # index -1 (no result) maps to None
+    neighbors_df = pd.DataFrame({
+        "id": np.repeat(store.ids, args.k),
+        "rank": np.tile(np.arange(1, args.k + 1), len(store)),
+        "neighbor_id": ids[indices.ravel()],
+        "similarity": scores.ravel(),
+    })
+    neighbors_df.to_csv(args.output_path, index=False)
+
+
+if __name__ == "__main__":
+    main()
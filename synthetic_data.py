@@ -0,0 +1,209 @@
+"""
+Generate synthetic Reddit posts and comments for benchmarking, in the same format as the data/<subreddit>/posts.csv and
+data/<subreddit>/comments.csv files.
+
+Text is drawn from a small set of synthetic "topics" (distributions over a shared vocabulary), so that the topic model
+stages have structure to find, and is decorated with the kinds of Reddit markup that remove_special_chars handles.
+Post lengths are log-normal and comments form reply trees (each comment replies to the post or to an earlier comment
+of the same post).
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+WORDS = ("we have been trying to conceive for two years after our loss and my doctor finally ordered more tests "
+         "the transfer went well but the beta was low so we are waiting again i feel so tired of hoping "
+         "thank you all for the support it means a lot to me right now").split()
+MARKUP = [
+    "**{}**", "*{}*", "~~{}~~", "`{}`", "&gt;{}", "&gt; {}", ">!{}!<", "&lt;{}", "^({})", "# {}", "## {}",
+    "[{}](https://www.reddit.com/r/infertility/)", "[{}](https://example.com/a_(b))", "{} | {} | {}", "|:-|:-|",
+    "{}\n\n{}", "{}\r\n{}", "{}  \t {}", "&amp;#x200B;", "{} me@example.com {}", "{} https://imgur.com/abc {}",
+    "\"{}\"", "{}!", "{}!!", "{} :-)", "#{}", "{} & {}", "{}\\&gt;", "{}...", "IVF #2 {}",
+]
+SUBREDDITS = ["ttcafterloss", "infertility"]
+MODERATORS = ["AutoModerator", "synthetic_mod"]
+_SYLLABLES = ["ba", "ko", "ri", "te", "mu", "sa", "lo", "ne", "vi", "da", "pe", "zu", "fo", "gi", "ha", "ju"]
+
+
+class SyntheticTextGenerator:
+    """
+    Generates Reddit-style text from a mixture of synthetic topics.
+    """
+    def __init__(self, num_topics=10, vocab_size=5000, markup_rate=0.1, seed=0):
+        """
+        :param num_topics: number of topics
+        :param vocab_size: number of distinct words (WORDS plus generated pseudo-words)
+        :param markup_rate: probability that a phrase is decorated with markup
+        """
+        self.rng = np.random.default_rng(seed)
+        self.markup_rate = markup_rate
+        # pseudo-words built from syllables (e.g. 'bakori'), so they look like words to the tokenizer
+        vocab = list(WORDS)
+        seen = set(vocab)
+        while len(vocab) < vocab_size:
+            word = "".join(self.rng.choice(_SYLLABLES, size=self.rng.integers(2, 5)))
+            if word not in seen:
+                seen.add(word)
+                vocab.append(word)
+        self.vocab = np.array(vocab, dtype=object)
+        # each topic has a Zipf-like distribution over a random ordering of the vocab
+        ranks = np.arange(1, vocab_size + 1)
+        zipf = 1 / ranks ** 1.1
+        self.topic_word = np.stack([zipf[self.rng.permutation(vocab_size)] for _ in range(num_topics)])
+        self.topic_word /= self.topic_word.sum(axis=1, keepdims=True)
+        self._topic_word_cdf = np.cumsum(self.topic_word, axis=1)
+        self.num_topics = num_topics
+
+    def text(self, num_words, topic_mix=None):
+        """
+        Generate text with num_words words (before markup is added).
+        :param topic_mix: topic proportions of the text (drawn from a sparse Dirichlet if None)
+        """
+        if topic_mix is None:
+            topic_mix = self.rng.dirichlet(np.full(self.num_topics, 0.2))
+        topics = np.searchsorted(np.cumsum(topic_mix), self.rng.random(num_words) * np.sum(topic_mix))
+        topics = np.minimum(topics, self.num_topics - 1)
+        # inverse-CDF sampling of each word from its topic's distribution
+        draws = self.rng.random(num_words)
+        word_ids = np.empty(num_words, dtype=np.int64)
+        for topic in np.unique(topics):
+            mask = topics == topic
+            word_ids[mask] = np.searchsorted(self._topic_word_cdf[topic], draws[mask] * self._topic_word_cdf[topic, -1])
+        word_ids = np.minimum(word_ids, len(self.vocab) - 1)
+        words = self.vocab[word_ids]
+        # break into phrases of 3-15 words, some of which are decorated with markup
+        pieces = []
+        start = 0
+        while start < num_words:
+            end = start + int(self.rng.integers(3, 16))
+            phrase = " ".join(words[start:end])
+            if self.rng.random() < self.markup_rate:
+                template = MARKUP[self.rng.integers(len(MARKUP))]
+                phrase = template.format(*([phrase] * template.count("{}")))
+            pieces.append(phrase)
+            start = end
+        separators = self.rng.choice([" ", ". ", ". ", "\n", "\n\n", "? "], size=len(pieces))
+        return "".join(sep + piece for sep, piece in zip(separators, pieces)).strip()
+
+    def lengths(self, size, median, sigma=1.0, max_len=2000):
+        """
+        Log-normal text lengths (in words).
+        """
+        return np.clip(self.rng.lognormal(np.log(median), sigma, size=size).astype(np.int64), 1, max_len)
+
+
+def make_posts(generator, num_posts, subreddit, start_id=0, deleted_rate=0.05, moderator_rate=0.01):
+    """
+    Generate posts with the columns of the raw posts.csv files.
+    :return: pandas DataFrame
+    """
+    rng = generator.rng
+    title_lens = generator.lengths(num_posts, median=8, sigma=0.5, max_len=60)
+    text_lens = generator.lengths(num_posts, median=120)
+    ids = ["{}p{:x}".format(subreddit[:2], start_id + i) for i in range(num_posts)]
+    selftext = [generator.text(n) for n in text_lens]
+    # some posts are removed/deleted, as in the raw data
+    for i in np.flatnonzero(rng.random(num_posts) < deleted_rate):
+        selftext[i] = rng.choice(["[removed]", "[deleted]"])
+    authors = np.array(["user{}".format(x) for x in rng.integers(0, max(10, num_posts // 3), size=num_posts)],
+                       dtype=object)
+    authors[rng.random(num_posts) < moderator_rate] = MODERATORS[0]
+    return pd.DataFrame({
+        "id": ids,
+        "created_utc": 1420070400 + np.sort(rng.integers(0, 180000000, size=num_posts)),
+        "author": authors,
+        "author_fullname": ["t2_{}".format(author) for author in authors],
+        "author_flair_text": np.where(rng.random(num_posts) < 0.3, "TTC #1", None),
+        "url": ["https://www.reddit.com/r/{}/comments/{}/".format(subreddit, post_id) for post_id in ids],
+        "title": [generator.text(n) for n in title_lens],
+        "selftext": selftext,
+        "upvote_ratio": np.round(rng.beta(8, 1, size=num_posts), 2),
+        "score": rng.negative_binomial(1, 0.1, size=num_posts),
+        "num_comments": 0,
+    })
+
+
+def make_comments(generator, posts_df, mean_comments=8, reply_rate=0.4, deleted_rate=0.03):
+    """
+    Generate comments on posts, with the columns of the raw comments.csv files. Each comment replies to the post
+    (parent_id 't3_<post id>') or, with probability reply_rate, to an earlier comment on the same post
+    (parent_id 't1_<comment id>'). Sets posts_df["num_comments"] to the number of comments of each post.
+    :return: pandas DataFrame
+    """
+    rng = generator.rng
+    num_comments = rng.negative_binomial(1, 1 / (1 + mean_comments), size=len(posts_df))
+    posts_df["num_comments"] = num_comments
+    total = int(num_comments.sum())
+    post_ids = np.repeat(posts_df["id"].to_numpy(), num_comments)
+    ids = np.array(["{}c{:x}".format(post_id[:2], i) for i, post_id in enumerate(post_ids)], dtype=object)
+    # position of each comment within its post, and index of the post's first comment
+    thread_starts = np.repeat(np.cumsum(num_comments) - num_comments, num_comments)
+    position = np.arange(total) - thread_starts
+    is_reply = (position > 0) & (rng.random(total) < reply_rate)
+    parent_idx = thread_starts + np.floor(rng.random(total) * np.maximum(position, 1)).astype(np.int64)
+    parent_ids = np.where(is_reply, "t1_" + ids[parent_idx].astype(str), "t3_" + post_ids.astype(str))
+    body = [generator.text(n) for n in generator.lengths(total, median=30)]
+    for i in np.flatnonzero(rng.random(total) < deleted_rate):
+        body[i] = rng.choice(["[removed]", "[deleted]"])
+    authors = np.array(["user{}".format(x) for x in rng.integers(0, max(10, total // 3), size=total)], dtype=object)
+    ups = rng.negative_binomial(1, 0.3, size=total)
+    return pd.DataFrame({
+        "id": ids,
+        "parent_id": parent_ids,
+        "created_utc": np.repeat(posts_df["created_utc"].to_numpy(), num_comments) + rng.integers(60, 86400, total),
+        "author": authors,
+        "author_fullname": ["t2_{}".format(author) for author in authors],
+        "author_flair_text": np.where(rng.random(total) < 0.3, "TTC #1", None),
+        "permalink": ["/r/comments/{}/".format(comment_id) for comment_id in ids],
+        "body": body,
+        "score": ups,
+        "ups": ups,
+        "downs": 0,
+        "controversiality": (rng.random(total) < 0.02).astype(np.int64),
+    })
+
+
+def write_dataset(output_dir, num_posts=1000, mean_comments=8, subreddits=SUBREDDITS, num_topics=10,
+                  vocab_size=5000, seed=0):
+    """
+    Write synthetic posts and comments to <output_dir>/<subreddit>/posts.csv and comments.csv, and moderators to
+    <output_dir>/moderators.txt.
+    :param num_posts: number of posts per subreddit
+    :return: generator used to create text (holds the true topic-word distributions)
+    """
+    generator = SyntheticTextGenerator(num_topics=num_topics, vocab_size=vocab_size, seed=seed)
+    for i, subreddit in enumerate(subreddits):
+        subreddit_dir = os.path.join(output_dir, subreddit)
+        if not os.path.exists(subreddit_dir):
+            os.makedirs(subreddit_dir)
+        posts_df = make_posts(generator, num_posts, subreddit, start_id=i * num_posts)
+        comments_df = make_comments(generator, posts_df, mean_comments=mean_comments)
+        posts_df.to_csv(os.path.join(subreddit_dir, "posts.csv"))
+        comments_df.to_csv(os.path.join(subreddit_dir, "comments.csv"))
+    with open(os.path.join(output_dir, "moderators.txt"), "w") as f:
+        f.write("\n".join(MODERATORS))
+    return generator
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_dir", type=str, help="Path to directory to write synthetic dataset to.")
+    parser.add_argument("--num_posts", type=int, default=1000, help="Number of posts per subreddit.")
+    parser.add_argument("--mean_comments", type=float, default=8, help="Mean number of comments per post.")
+    parser.add_argument("--num_topics", type=int, default=10, help="Number of synthetic topics.")
+    parser.add_argument("--vocab_size", type=int, default=5000, help="Number of distinct words.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = _parse_args()
+    write_dataset(args.output_dir, num_posts=args.num_posts, mean_comments=args.mean_comments,
+                  num_topics=args.num_topics, vocab_size=args.vocab_size, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
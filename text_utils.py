@@ -1,13 +1,41 @@
+"""
+Text pre-processing utilities for Reddit posts and comments.
+
+Stopwords, the sentence tokenizer and the spaCy model are loaded lazily on first use (through get_stop_words,
+get_sent_tokenizer and get_nlp), so importing this module is cheap. NLTK data is only downloaded if it isn't
+installed already; in offline mode (set_offline(True) or the TEXT_UTILS_OFFLINE=1 environment variable), a missing
+resource raises a LookupError instead of attempting a download.
+"""
+import collections
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
 import re
+from functools import partial
 
 import gensim
 from gensim.utils import simple_preprocess
-import spacy
-import nltk
 import numpy as np
+import pandas as pd
 
 
 LIWC_2015_PATH = './LIWC.2015.all'
+LEMMA_TABLE_FORMAT_VERSION = 1
+# stopword list (with LIWC words removed) is cached here, keyed by a hash of the LIWC dictionary
+STOP_WORDS_CACHE_PATH = './stop_words.cache.json'
+
+_OFFLINE = os.environ.get('TEXT_UTILS_OFFLINE', '0') not in ('', '0')
+_RESOURCES = {}
+
+
+def set_offline(offline=True):
+    """
+    Turn offline mode on or off. In offline mode, missing NLTK data raises an error instead of being downloaded.
+    """
+    global _OFFLINE
+    _OFFLINE = offline
 
 
 def read_file_by_lines(filename):
@@ -18,24 +46,93 @@ def read_file_by_lines(filename):
         return f.read().splitlines()
 
 
-# prepare stopwords
-nltk.download('stopwords')
-from nltk.corpus import stopwords
-sw = stopwords.words('english')
-# remove words in LIWC from stopwords list
-liwc_lines = read_file_by_lines(LIWC_2015_PATH)
-liwc_words = set([line.split(' ')[0] for line in liwc_lines])
-liwc_star_words = set([lw for lw in liwc_words if lw[-1] == '*'])
-sw = [word for word in sw if word not in liwc_words]
-sw = [word for word in sw if not np.any([word.startswith(lw[:-1]) for lw in liwc_star_words])]
-STOP_WORDS = sw
+def get_stop_words():
+    """
+    Get list of stopwords: NLTK's English stopwords, except for those that are in the LIWC 2015 dictionary.
+    """
+    if 'stop_words' not in _RESOURCES:
+        _RESOURCES['stop_words'] = _load_stop_words()
+    return _RESOURCES['stop_words']
+
+
+def _get_stop_word_set():
+    if 'stop_word_set' not in _RESOURCES:
+        _RESOURCES['stop_word_set'] = frozenset(get_stop_words())
+    return _RESOURCES['stop_word_set']
+
+
+def get_sent_tokenizer():
+    """
+    Get NLTK punkt sentence tokenizer.
+    """
+    if 'sent_tokenizer' not in _RESOURCES:
+        import nltk
+        _ensure_nltk_resource('tokenizers/punkt', 'punkt')
+        _RESOURCES['sent_tokenizer'] = nltk.data.load('tokenizers/punkt/english.pickle')
+    return _RESOURCES['sent_tokenizer']
+
+
+def get_nlp():
+    """
+    Get spaCy NLP lemmatizer.
+    """
+    if 'nlp' not in _RESOURCES:
+        import spacy
+        # only keep tagger component for efficiency
+        _RESOURCES['nlp'] = spacy.load('en_core_web_sm', disable=['parser', 'ner'])
+    return _RESOURCES['nlp']
 
-# prepare sentence tokenizer
-nltk.download('punkt')
-SENT_TOKENIZER = nltk.data.load('tokenizers/punkt/english.pickle')
 
-# prepare spacy NLP lemmatizer
-NLP = spacy.load('en_core_web_sm', disable=['parser', 'ner'])  # only keep tagger component for efficiency
+def __getattr__(name):
+    # keep module-level access (e.g. text_utils.NLP) working now that resources are loaded lazily
+    getters = {'STOP_WORDS': get_stop_words, 'SENT_TOKENIZER': get_sent_tokenizer, 'NLP': get_nlp}
+    if name in getters:
+        return getters[name]()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def _ensure_nltk_resource(resource_path, package):
+    """
+    Download NLTK package if resource_path isn't installed yet (unless in offline mode).
+    """
+    import nltk
+    try:
+        nltk.data.find(resource_path)
+    except LookupError:
+        if _OFFLINE:
+            raise LookupError("NLTK resource '{}' is not installed and offline mode is on. Install it with "
+                              "nltk.download('{}') first.".format(resource_path, package))
+        nltk.download(package)
+
+
+def _load_stop_words():
+    with open(LIWC_2015_PATH, "rb") as f:
+        liwc_hash = hashlib.sha1(f.read()).hexdigest()
+    try:
+        with open(STOP_WORDS_CACHE_PATH, "r") as f:
+            cache = json.load(f)
+        if cache['liwc_hash'] == liwc_hash:
+            return cache['stop_words']
+    except (OSError, ValueError, KeyError):
+        pass
+    _ensure_nltk_resource('corpora/stopwords', 'stopwords')
+    from nltk.corpus import stopwords
+    sw = stopwords.words('english')
+    # remove words in LIWC from stopwords list
+    liwc_lines = read_file_by_lines(LIWC_2015_PATH)
+    liwc_words = set([line.split(' ')[0] for line in liwc_lines])
+    liwc_star_prefixes = tuple(set([lw[:-1] for lw in liwc_words if lw.endswith('*')]))
+    sw = [word for word in sw if word not in liwc_words]
+    sw = [word for word in sw if not word.startswith(liwc_star_prefixes)]
+    try:
+        tmp_path = "{}.{}.tmp".format(STOP_WORDS_CACHE_PATH, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({'liwc_hash': liwc_hash, 'stop_words': sw}, f)
+        os.replace(tmp_path, STOP_WORDS_CACHE_PATH)
+    except OSError:
+        # caching is only an optimization (e.g. the directory may be read-only)
+        pass
+    return sw
 
 
 def process_single_post_text(text, do_lemmatize=True, remove_stops=True):
@@ -46,10 +143,7 @@ def process_single_post_text(text, do_lemmatize=True, remove_stops=True):
     :param remove_stops: if True, remove stopwords
     :return: sents: cleaned text broken up into sentences
     """
-    text = remove_special_chars(text)
-    sents = split_into_sentences(text)
-    # remove punctuation, stopwords, and convert to lowercase
-    sents = clean_and_tokenize(sents, remove_stops)
+    sents = _clean_and_split(text, remove_stops)
     if do_lemmatize:
         # lemmatize words in each sentence
         for idx, sent in enumerate(sents):
@@ -57,33 +151,241 @@ def process_single_post_text(text, do_lemmatize=True, remove_stops=True):
     return sents
 
 
+def process_texts(texts, do_lemmatize=True, remove_stops=True, n_process=1, batch_size=1000, lemma_table=None):
+    """
+    Process text from many posts/comments at once. Gives the same output as calling process_single_post_text on
+    each text, but spreads cleaning and tokenization over a pool of worker processes and lemmatizes by streaming
+    sentences through spaCy in batches rather than calling NLP once per sentence.
+    :param texts: iterable of strings of text from posts/comments
+    :param do_lemmatize: if True, apply lemmatization
+    :param remove_stops: if True, remove stopwords
+    :param n_process: number of worker processes to use
+    :param batch_size: number of texts sent to a worker at a time (and number of sentences per spaCy batch)
+    :param lemma_table: optional LemmaTable to look lemmas up in (see lemmatize_docs)
+    :return: docs: list with one entry per text (in input order), where each entry is a list of sentences
+    """
+    texts = list(texts)
+    batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+    clean_fn = partial(_clean_and_split_batch, remove_stops=remove_stops)
+    if n_process > 1 and len(batches) > 1:
+        # load resources before starting workers so that they are inherited rather than loaded by each worker
+        get_stop_words()
+        get_sent_tokenizer()
+        with multiprocessing.Pool(n_process) as pool:
+            # map (unlike imap_unordered) returns results in the same order as the input
+            batch_docs = pool.map(clean_fn, batches)
+    else:
+        batch_docs = [clean_fn(batch) for batch in batches]
+    docs = [doc for batch in batch_docs for doc in batch]
+    if do_lemmatize:
+        # lemmatize all sentences in one stream, then regroup them by document
+        sents = lemmatize_docs([sent for doc in docs for sent in doc], n_process=n_process, batch_size=batch_size,
+                               lemma_table=lemma_table)
+        start = 0
+        for idx, doc in enumerate(docs):
+            docs[idx] = sents[start:start + len(doc)]
+            start += len(doc)
+    return docs
+
+
+def _clean_and_split(text, remove_stops=True):
+    """
+    Remove special characters from text, break it into sentences and tokenize each sentence.
+    """
+    text = remove_special_chars(text)
+    sents = split_into_sentences(text)
+    # remove punctuation, stopwords, and convert to lowercase
+    return clean_and_tokenize(sents, remove_stops)
+
+
+def _clean_and_split_batch(texts, remove_stops=True):
+    """
+    Same as _clean_and_split, but for a list of texts (special characters are removed from all of them at once).
+    """
+    texts = remove_special_chars_batch(texts, batch_size=len(texts) or 1)
+    return [clean_and_tokenize(split_into_sentences(text), remove_stops) for text in texts]
+
+
 def lemmatize(doc):
     """
     Lemmatize words in doc.
     Note: lemmatization makes 'i' capital I. 
     :param: doc: list of words (strs).
     """
-    doc = NLP(" ".join(doc))
+    doc = get_nlp()(" ".join(doc))
     doc = [word.lemma_ for word in doc]
     return doc
 
 
-def lemmatize_docs(docs):
+def lemmatize_docs(docs, n_process=1, batch_size=1000, lemma_table=None):
     """
     Lemmatize words in each doc. Each doc is a list of words.
+    Docs are streamed through spaCy in batches, so this is much faster than calling lemmatize on each doc.
+    :param n_process: number of processes spaCy uses to tag docs
+    :param batch_size: number of docs in each spaCy batch
+    :param lemma_table: optional LemmaTable. If given, lemmas are looked up in it and only words that aren't in it
+                        are lemmatized with spaCy (see LemmaTable.lemmatize_docs)
     """
-    docs = [lemmatize(doc) for doc in docs]
+    if lemma_table is not None:
+        return lemma_table.lemmatize_docs(docs, n_process=n_process, batch_size=batch_size)
+    texts = (" ".join(doc) for doc in docs)
+    docs = [[word.lemma_ for word in doc] for doc in get_nlp().pipe(texts, batch_size=batch_size, n_process=n_process)]
     return docs
 
 
+class LemmaTable:
+    """
+    Table of the lemmas spaCy gives each word, so that words don't have to be tagged again every time they are seen.
+
+    The first time an empty table is used, the docs are lemmatized with spaCy as usual (with context) and the lemmas of
+    each word are recorded. After that, words in the table are looked up and only words that aren't in it yet are
+    lemmatized with spaCy, in batches and without context, and added to the table. spaCy can give a word different
+    lemmas in different contexts (e.g. 'left' -> 'leave' or 'left'); the table uses the lemma the word got most often.
+    A word can have more than one lemma if spaCy splits it into several tokens (e.g. 'cannot' -> 'can', 'not').
+    """
+    def __init__(self, by_tag=False):
+        """
+        :param by_tag: if True, also record the lemma of each word for each of its part-of-speech tags (see lookup)
+        """
+        self.by_tag = by_tag
+        # word -> {lemmas: number of times the word got those lemmas}
+        self.counts = {}
+        # word -> most frequent lemmas
+        self.lemmas = {}
+        # (word, tag) -> lemmas
+        self.tagged = {}
+        # numbers of words that were looked up in the table and that were lemmatized with spaCy
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.lemmas)
+
+    def __contains__(self, word):
+        return word in self.lemmas
+
+    @property
+    def hit_rate(self):
+        """
+        Fraction of words that were looked up in the table rather than lemmatized with spaCy.
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def lookup(self, word, tag=None):
+        """
+        Lemmas of word (a list, usually of one lemma), or None if word isn't in the table.
+        :param tag: optional part-of-speech tag of word; if the table was built with by_tag=True and has seen word with
+                    this tag, the lemmas for the tag are returned
+        """
+        if tag is not None and (word, tag) in self.tagged:
+            return list(self.tagged[(word, tag)])
+        lemmas = self.lemmas.get(word)
+        return list(lemmas) if lemmas is not None else None
+
+    def lemmatize_docs(self, docs, n_process=1, batch_size=1000):
+        """
+        Lemmatize words in each doc (a list of words), adding words that aren't in the table yet.
+        :param n_process: number of processes spaCy uses to tag docs
+        :param batch_size: number of docs or words in each spaCy batch
+        """
+        docs = docs if isinstance(docs, list) else list(docs)
+        if not self.lemmas:
+            # build the table from this pass over the docs
+            texts = (" ".join(doc) for doc in docs)
+            lemmatized = []
+            for doc, spacy_doc in zip(docs, get_nlp().pipe(texts, batch_size=batch_size, n_process=n_process)):
+                self._add_doc(doc, spacy_doc)
+                lemmatized.append([token.lemma_ for token in spacy_doc])
+                self.misses += len(doc)
+            return lemmatized
+        unseen = list(dict.fromkeys(word for doc in docs for word in doc if word not in self.lemmas))
+        if unseen:
+            # only load spaCy (and start its worker processes) if there are new words
+            for word, spacy_doc in zip(unseen, get_nlp().pipe(unseen, batch_size=batch_size, n_process=n_process)):
+                self._add_doc([word], spacy_doc)
+        unseen = set(unseen)
+        lemmas = self.lemmas
+        lemmatized = []
+        for doc in docs:
+            lemmatized.append([lemma for word in doc for lemma in lemmas[word]])
+            num_unseen = sum(word in unseen for word in doc) if unseen else 0
+            self.misses += num_unseen
+            self.hits += len(doc) - num_unseen
+        return lemmatized
+
+    def _add_doc(self, words, spacy_doc):
+        """
+        Record the lemmas of words from the spaCy doc of " ".join(words). spaCy tokens are matched to words by their
+        character offset.
+        """
+        starts = np.cumsum([0] + [len(word) + 1 for word in words[:-1]])
+        word_lemmas = [[] for _ in words]
+        word_tags = [[] for _ in words]
+        for token in spacy_doc:
+            idx = int(np.searchsorted(starts, token.idx, side="right")) - 1
+            word_lemmas[idx].append(token.lemma_)
+            word_tags[idx].append(token.tag_)
+        for word, lemmas, tags in zip(words, word_lemmas, word_tags):
+            lemmas = tuple(lemmas)
+            self._add(word, lemmas, 1)
+            if self.by_tag:
+                self.tagged[(word, "+".join(tags))] = lemmas
+
+    def _add(self, word, lemmas, count):
+        word_counts = self.counts.setdefault(word, {})
+        word_counts[lemmas] = word_counts.get(lemmas, 0) + count
+        best = self.lemmas.get(word)
+        if best is None or word_counts[lemmas] > word_counts[best]:
+            self.lemmas[word] = lemmas
+
+    def save(self, path):
+        """
+        Save table to a JSON file.
+        """
+        data = {
+            'format_version': LEMMA_TABLE_FORMAT_VERSION,
+            'by_tag': self.by_tag,
+            'counts': [[word, [[list(lemmas), count] for lemmas, count in word_counts.items()]]
+                       for word, word_counts in self.counts.items()],
+            'tagged': [[word, tag, list(lemmas)] for (word, tag), lemmas in self.tagged.items()],
+        }
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        assert data['format_version'] == LEMMA_TABLE_FORMAT_VERSION, "unsupported lemma table format version"
+        table = cls(by_tag=data['by_tag'])
+        for word, word_counts in data['counts']:
+            for lemmas, count in word_counts:
+                table._add(word, tuple(lemmas), count)
+        table.tagged = {(word, tag): tuple(lemmas) for word, tag, lemmas in data['tagged']}
+        return table
+
+    @classmethod
+    def load_or_create(cls, path, by_tag=False):
+        """
+        Load table from path if it exists, and otherwise create an empty one.
+        :param by_tag: if True, record lemmas by tag (for a loaded table that didn't, only for words added from now on)
+        """
+        if not os.path.exists(path):
+            return cls(by_tag=by_tag)
+        table = cls.load(path)
+        table.by_tag = table.by_tag or by_tag
+        return table
+
+
 def clean_and_tokenize(sentences, remove_stops=True):
     """
     Converts each sentence (str) in sentences (list of strs) into a list of words.
     Also cleans text by removing punctuation, removing stopwords, and converting to lowercase.
     """
-    stops = STOP_WORDS
-    if not remove_stops:
-        stops = []
+    stops = _get_stop_word_set() if remove_stops else frozenset()
     # deacc=True to remove punctuation
     sentences = [[word for word in simple_preprocess(sent, deacc=True, min_len=1) if word not in stops] for sent in sentences]
     return sentences
@@ -93,81 +395,337 @@ def split_into_sentences(text):
     """
     Split text (str) into list of sentences
     """
-    return SENT_TOKENIZER.tokenize(text)
+    return get_sent_tokenizer().tokenize(text)
 
 
-def remove_special_chars(text):
+_WHITESPACE_RE = re.compile(r'\s\s+')
+_EMAIL_END_RE = re.compile(r'\S*[^\S\n]?')
+
+
+def _remove_emails(text):
+    r"""
+    Same as re.sub(r'\S*@\S*[^\S\n]?', '', text), i.e. remove each word containing '@' (and one following space),
+    but only looks at the text around each '@' instead of trying the pattern at every position.
     """
-    Remove special characters from text common in Reddit Posts as well as emails, URLS, and IP addresses.
-    Adapted from https://github.com/LoLei/redditcleaner/blob/master/redditcleaner/__init__.py
+    pieces = []
+    pos = 0
+    at = text.find('@')
+    while at != -1:
+        start = at
+        while start > pos and not text[start - 1].isspace():
+            start -= 1
+        pieces.append(text[pos:start])
+        pos = _EMAIL_END_RE.match(text, at + 1).end()
+        at = text.find('@', pos)
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+
+def _remove_quote_markers(text):
+    r"""
+    Same as re.sub(r'\"?\\?&?gt;?', '', text), i.e. remove '&gt;' (escaped '>' used for quotes) as well as any other
+    'gt', but only looks at the text around each 'gt' instead of trying the pattern at every position.
     """
-    # Newlines (replaced with space to preserve cases like word1\nword2)
-    text = re.sub(r'\n+', ' ', text)
-    # Remove resulting ' '
-    text = text.strip()
-    text = re.sub(r'\s\s+', ' ', text)
-
+    pieces = []
+    pos = 0
+    gt = text.find('gt')
+    while gt != -1:
+        # extend match backwards over the optional '"', '\\' and '&' (in reverse order)
+        start = gt
+        for char in '&\\"':
+            if start > pos and text[start - 1] == char:
+                start -= 1
+        pieces.append(text[pos:start])
+        pos = gt + 3 if text.startswith(';', gt + 2) else gt + 2
+        gt = text.find('gt', pos)
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+
+# Steps of remove_special_chars. They are applied in this order, since earlier steps can create or break matches for
+# later ones (e.g. removing '*' can complete a markdown link). Plain strings are literal substitutions (done with
+# str.replace, which is much faster than re.sub), and functions are hand-written versions of patterns that are slow
+# as regular expressions.
+# Texts never contain newlines once whitespace has been normalized, so no step matches across a newline (e.g.
+# '[^\S\n]' is used rather than '\s'). This lets remove_special_chars_batch clean many newline-joined texts with one
+# call per step and still give the same output as cleaning them one at a time.
+_CLEANING_STEPS = [
     # emails
-    text = re.sub('\S*@\S*\s?', '', text)
-
+    (_remove_emails, None),
     # > Quotes
-    text = re.sub(r'\"?\\?&?gt;?', '', text)
-
+    (_remove_quote_markers, None),
     # Bullet points/asterisk (bold/italic)
-    text = re.sub(r'\*', '', text)
-    text = re.sub('&amp;#x200B;', '', text)
-
+    ('*', ''),
+    ('&amp;#x200B;', ''),
     # things in parantheses or brackets
-    text = re.sub(r'\[.*?\]\(.*?\)', '', text)
-
-    # remove URLS
-    text = re.sub(r'https?:\/\/.*[\r\n]*', '', text)
-
+    (re.compile(r'\[.*?\]\(.*?\)'), ''),
+    # remove URLS (rest of the text after the URL is removed too)
+    (re.compile(r'https?:\/\/[^\n]*'), ''),
     # Strikethrough
-    text = re.sub('~', '', text)
-
+    ('~', ''),
     # Spoiler, which is used with < less-than (Preserves the text)
-    text = re.sub('&lt;', '', text)
-    text = re.sub(r'!(.*?)!', r'\1', text)
-
+    ('&lt;', ''),
+    (re.compile(r'!(.*?)!'), r'\1'),
     # Code, inline and block
-    text = re.sub('`', '', text)
-
+    ('`', ''),
     # Superscript (Preserves the text)
-    text = re.sub(r'\^\((.*?)\)', r'\1', text)
-
+    (re.compile(r'\^\((.*?)\)'), r'\1'),
     # Table
-    text = re.sub(r'\|', ' ', text)
-    text = re.sub(':-', '', text)
-
+    ('|', ' '),
+    (':-', ''),
     # Heading
-    text = re.sub('#', '', text)
+    ('#', ''),
+]
+
 
+def remove_special_chars(text):
+    """
+    Remove special characters from text common in Reddit Posts as well as emails, URLS, and IP addresses.
+    Adapted from https://github.com/LoLei/redditcleaner/blob/master/redditcleaner/__init__.py
+    """
+    return _apply_cleaning_steps(_normalize_whitespace(text))
+
+
+def remove_special_chars_batch(texts, batch_size=10000):
+    """
+    Apply remove_special_chars to many texts at once.
+    Texts are joined into newline-separated batches so that each cleaning step runs once per batch instead of once
+    per text.
+    :param texts: pandas Series or list of strings
+    :param batch_size: number of texts cleaned per batch
+    :return: cleaned texts (pandas Series with the same index if texts is a Series, otherwise a list)
+    """
+    if isinstance(texts, pd.Series):
+        return pd.Series(remove_special_chars_batch(list(texts), batch_size), index=texts.index, name=texts.name)
+    cleaned = []
+    texts = list(texts)
+    for start in range(0, len(texts), batch_size):
+        batch = [_normalize_whitespace(text) for text in texts[start:start + batch_size]]
+        cleaned.extend(_apply_cleaning_steps("\n".join(batch)).split("\n"))
+    return cleaned
+
+
+def _normalize_whitespace(text):
+    # Newlines (replaced with space to preserve cases like word1\nword2), then collapse runs of whitespace
+    return _WHITESPACE_RE.sub(' ', text.replace('\n', ' ')).strip()
+
+
+def _apply_cleaning_steps(text):
+    for pattern, replacement in _CLEANING_STEPS:
+        if isinstance(pattern, str):
+            text = text.replace(pattern, replacement)
+        elif callable(pattern):
+            text = pattern(text)
+        else:
+            text = pattern.sub(replacement, text)
     return text
 
 
-def build_bigram_model(sentences, min_count=5, threshold=100):
+def iter_sentences(docs):
+    """
+    Stream the sentences of docs one at a time (without building a list of all of them).
+    :param: docs: iterable of docs, where each doc is a list of sentences
+    """
+    for doc in docs:
+        yield from doc
+
+
+def build_bigram_model(sentences, min_count=5, threshold=100, max_vocab_size=40000000, n_process=1,
+                       shard_size=100000):
     """
     Build bigram model.
-    :param: sentences: List[List[str]] List of sentences, where each sentence is a list of words.
+    Word and word pair counts are collected from shards of shard_size sentences (by a pool of n_process workers if
+    n_process > 1) and merged in order. Whenever the merged counts have more than max_vocab_size entries the rarest ones
+    are pruned, as gensim Phrases does within a single pass, so the phrase counts take memory bounded by max_vocab_size
+    rather than growing with the number of sentences. Each of the n_process workers also holds up to max_vocab_size
+    counts for the shard it is counting, so peak memory is about (n_process + 1) * max_vocab_size entries.
+    :param: sentences: Iterable of sentences, where each sentence is a list of words. Only iterated over once, so it can
+    be a generator (e.g. iter_sentences(docs)).
     :param: min_count: ignore all words and bigrams with total collected count lower than this value
     :param: threshold: Threshold score for forming bigrams. Pairs of words are converted to bigrams if they have a score
     greater than the threshold. A higher score means fewer bigrams.
+    :param: max_vocab_size: maximum number of words and word pairs to keep counts for (gensim Phrases' default)
+    :param: n_process: number of worker processes to count shards with
+    :param: shard_size: number of sentences per shard
     """
-    bigram = gensim.models.Phrases(sentences, min_count=min_count, threshold=threshold)
+    bigram = gensim.models.Phrases(min_count=min_count, threshold=threshold, max_vocab_size=max_vocab_size)
+    learn_fn = partial(gensim.models.Phrases.learn_vocab, max_vocab_size=max_vocab_size, delimiter=bigram.delimiter,
+                       progress_per=shard_size + 1, common_terms=bigram.common_terms)
+    for min_reduce, vocab, total_words in _imap_bounded(learn_fn, _iter_batches(sentences, shard_size), n_process):
+        _merge_phrase_vocab(bigram, min_reduce, vocab, total_words)
     # convert to faster implementation of Phrases (reduced functionality, but is all we need since we aren't going to
     # add more words to the models)
     bigram_model = gensim.models.phrases.Phraser(bigram)
     return bigram_model
 
 
-def make_bigrams_docs(docs, bigram_model):
+def _merge_phrase_vocab(bigram, min_reduce, vocab, total_words):
+    """
+    Add counts collected by Phrases.learn_vocab to bigram (same as Phrases.add_vocab, but with counts collected
+    elsewhere).
+    """
+    bigram.corpus_word_count += total_words
+    if len(bigram.vocab) > 0:
+        bigram.min_reduce = max(bigram.min_reduce, min_reduce)
+        for word, count in vocab.items():
+            bigram.vocab[word] += count
+        if len(bigram.vocab) > bigram.max_vocab_size:
+            gensim.utils.prune_vocab(bigram.vocab, bigram.min_reduce)
+            bigram.min_reduce += 1
+    else:
+        bigram.vocab = vocab
+
+
+def make_bigrams_docs(docs, bigram_model, n_process=1, batch_size=1000, flatten=False):
     """
     Convert pairs of words that are bigram phrases (as identified by bigram model) into bigrams.
     :param: docs: list of  of docs, where each doc is list of sentences and each sentence is a list of words and each word is a str
     :param: bigram_model: gensim Phrases bigram model
+    :param: n_process: number of worker processes to use
+    :param: batch_size: number of docs sent to a worker at a time
+    :param: flatten: if True, remove sentence boundaries (i.e. return each doc as a single list of words)
+    """
+    if n_process <= 1:
+        return [_make_bigrams_doc(doc, bigram_model, flatten) for doc in docs]
+    batch_fn = partial(_make_bigrams_batch, flatten=flatten)
+    batches = _imap_bounded(batch_fn, _iter_batches(docs, batch_size), n_process,
+                            initializer=_set_resource, initargs=('bigram_model', bigram_model))
+    return [doc for batch in batches for doc in batch]
+
+
+def _make_bigrams_doc(doc, bigram_model, flatten=False):
+    sents = make_bigrams(doc, bigram_model)
+    return [word for sent in sents for word in sent] if flatten else sents
+
+
+def _make_bigrams_batch(docs, flatten=False):
+    # bigram model is set once per worker (see make_bigrams_docs), rather than sent with every batch
+    bigram_model = _RESOURCES['bigram_model']
+    return [_make_bigrams_doc(doc, bigram_model, flatten) for doc in docs]
+
+
+def build_vocab_dict(docs, no_below=25, no_above=.5, n_process=1, shard_size=100000):
+    """
+    Create vocab dictionary (word id -> word) from docs and filter out rare and common words.
+    Document/collection frequencies are counted in shards of shard_size docs (by a pool of n_process workers if
+    n_process > 1) and merged in order, so the result (including word ids) is the same as that of
+    gensim.corpora.Dictionary(docs) followed by filter_extremes(no_below, no_above).
+    :param: docs: iterable of docs, where each doc is a list of words
+    :param: no_below: remove words that have less than this many occurrences across all documents
+    :param: no_above: remove words that appear in more than this % of documents
+    :param: n_process: number of worker processes to count shards with
+    :param: shard_size: number of docs per shard
+    :return: gensim Dictionary
+    """
+    vocab_dict = gensim.corpora.Dictionary()
+    dfs, cfs = collections.Counter(), collections.Counter()
+    for new_words, shard_dfs, shard_cfs, num_docs, num_pos in _imap_bounded(_count_vocab_shard,
+                                                                           _iter_batches(docs, shard_size), n_process):
+        # words get ids in order of first occurrence, as in Dictionary.add_documents
+        for word in new_words:
+            vocab_dict.token2id.setdefault(word, len(vocab_dict.token2id))
+        dfs.update(shard_dfs)
+        cfs.update(shard_cfs)
+        vocab_dict.num_docs += num_docs
+        vocab_dict.num_pos += num_pos
+    token2id = vocab_dict.token2id
+    vocab_dict.dfs = {token2id[word]: count for word, count in dfs.items()}
+    vocab_dict.cfs = {token2id[word]: count for word, count in cfs.items()}
+    vocab_dict.num_nnz = sum(dfs.values())
+    vocab_dict.filter_extremes(no_below=no_below, no_above=no_above)
+    return vocab_dict
+
+
+def _count_vocab_shard(docs):
+    """
+    Count words in a shard of docs.
+    :return: new_words: words in order of first occurrence (sorted within each doc, as Dictionary.doc2bow assigns ids),
+    dfs: document frequency of each word, cfs: collection frequency of each word, # docs, # words
+    """
+    new_words, seen = [], set()
+    dfs, cfs = collections.Counter(), collections.Counter()
+    num_pos = 0
+    for doc in docs:
+        counts = collections.Counter(doc)
+        unseen = sorted(word for word in counts if word not in seen)
+        new_words.extend(unseen)
+        seen.update(unseen)
+        dfs.update(counts.keys())
+        cfs.update(counts)
+        num_pos += len(doc)
+    return new_words, dfs, cfs, len(docs), num_pos
+
+
+def doc2bow_matrix(docs, vocab_dict):
+    """
+    Convert docs to term frequencies all at once (rather than calling vocab_dict.doc2bow on each doc).
+    Words that aren't in vocab_dict are ignored.
+    :param: docs: sequence of docs, where each doc is a list of words
+    :param: vocab_dict: gensim Dictionary
+    :return: scipy.sparse.csr_matrix of shape (# docs, len(vocab_dict)), whose rows have the same (term id, tf) entries
+    as vocab_dict.doc2bow(doc)
+    """
+    import scipy.sparse
+    lens = np.fromiter((len(doc) for doc in docs), dtype=np.int64, count=len(docs))
+    words = np.array(list(itertools.chain.from_iterable(docs)), dtype=object)
+    # look up the ids of all words with one hash table lookup (pandas Index) instead of a dict lookup per word
+    positions = pd.Index(list(vocab_dict.token2id)).get_indexer(words) if len(words) else np.zeros(0, dtype=np.int64)
+    term_ids = np.fromiter(vocab_dict.token2id.values(), dtype=np.int64, count=len(vocab_dict.token2id))
+    found = positions >= 0
+    rows = np.repeat(np.arange(len(lens)), lens)[found]
+    cols = term_ids[positions[found]]
+    tf_matrix = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                                        shape=(len(lens), len(vocab_dict)))
+    tf_matrix.sum_duplicates()
+    tf_matrix.sort_indices()
+    return tf_matrix
+
+
+def tf_lists(tf_matrix):
+    """
+    Convert term-frequency matrix (e.g. from doc2bow_matrix) to a list of tf-lists of (term id, tf) tuples, the format
+    returned by Dictionary.doc2bow.
+    """
+    indptr, ids, counts = tf_matrix.indptr, tf_matrix.indices.tolist(), tf_matrix.data.tolist()
+    return [list(zip(ids[indptr[i]:indptr[i + 1]], counts[indptr[i]:indptr[i + 1]]))
+            for i in range(tf_matrix.shape[0])]
+
+
+def _set_resource(name, value):
+    _RESOURCES[name] = value
+
+
+def _iter_batches(items, batch_size):
+    """
+    Split iterable into lists of batch_size items (the last one may be shorter).
+    """
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _imap_bounded(fn, items, n_process=1, initializer=None, initargs=()):
+    """
+    Apply fn to each of items, yielding results in input order. Like Pool.imap, but at most 2 * n_process items are
+    read ahead of the results that have been yielded (Pool.imap reads all of its input up front), so items can be a
+    long stream.
     """
-    return [make_bigrams(doc, bigram_model) for doc in docs]
+    if n_process <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(fn, items)
+        return
+    with multiprocessing.Pool(n_process, initializer=initializer, initargs=initargs) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(fn, (item,)))
+            if len(pending) >= 2 * n_process:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
 
 
 def make_bigrams(sentences, bigram_model):
@@ -2,15 +2,25 @@
 Train topic models for analyzing Reddit post and comments content.
 """
 import argparse
-import ast
+import hashlib
 import os
-import time
+import pickle
+import threading
+import warnings
 import pandas as pd
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
 
 import gensim
 import gensim.corpora as corpora
 from gensim.models import CoherenceModel
+from gensim.topic_coherence import text_analysis
+
+from corpus_store import BowCorpus, load_corpus
+from instrumentation import stage
+
+# coherence measures estimated from sliding-window co-occurrence counts (and gensim's default window size for each)
+SLIDING_WINDOW_SIZES = {'c_v': 110, 'c_uci': 10, 'c_npmi': 10}
 
 
 class TopicModel:
@@ -18,9 +28,13 @@ class TopicModel:
     Class to create LDA topic model.
     """
     def __init__(self, doc_list: List[str], doc_tf_list: List[List[Tuple[int, int]]], vocab_dict: corpora.Dictionary,
-                 num_topics: int, mallet_tmp_dir: str, verbose: bool = False):
+                 num_topics: int, mallet_tmp_dir: str, verbose: bool = False, num_tokens: Optional[int] = None):
+        """
+        :param num_tokens: total number of tokens in doc_tf_list, if already known (see count_tokens)
+        """
         self.doc_list = doc_list
         self.doc_tf_list = doc_tf_list
+        self.num_tokens = count_tokens(doc_tf_list) if num_tokens is None else num_tokens
         self.vocab_dict = vocab_dict
         self.num_topics = num_topics
         self.mallet_tmp_dir = mallet_tmp_dir
@@ -38,26 +52,27 @@ class TopicModel:
         """
         if self.model is not None:
             print("Existing model found. Deleting and retraining.")
-        start_time = time.time()
-        self.model = gensim.models.wrappers.LdaMallet(mallet_path, corpus=self.doc_tf_list, num_topics=self.num_topics,
-                                                      id2word=self.vocab_dict, workers=workers,
-                                                      prefix=os.path.join(self.mallet_tmp_dir,
-                                                                          '{}_'.format(self.num_topics)))
-        train_time = time.time() - start_time
-        if self.verbose:
-            print("Finished training {} topic LDA mallet model in time {}".format(self.num_topics, train_time))
+        with stage("train_lda_mallet", docs=len(self.doc_tf_list), tokens=self.num_tokens,
+                   num_topics=self.num_topics):
+            self.model = gensim.models.wrappers.LdaMallet(mallet_path, corpus=self.doc_tf_list,
+                                                          num_topics=self.num_topics, id2word=self.vocab_dict,
+                                                          workers=workers,
+                                                          prefix=os.path.join(self.mallet_tmp_dir,
+                                                                              '{}_'.format(self.num_topics)))
 
-    def compute_model_coherence(self, coherence_type: str = 'c_v'):
+    def compute_model_coherence(self, coherence_type: str = 'c_v', evaluator: Optional['CoherenceEvaluator'] = None):
         """
         Compute coherence score for topics produced by model.
         Scores are based on similiarity of top words within each topic.
         See https://radimrehurek.com/gensim/models/coherencemodel.html
         and http://svn.aksw.org/papers/2015/WSDM_Topic_Evaluation/public.pdf
         for more info on the difference types of coherence scores.
+        :param evaluator: CoherenceEvaluator to score model with (so co-occurrence counts are shared with other
+                          models). If given, coherence_type is ignored in favour of the evaluator's.
         """
-        coherence_model = CoherenceModel(model=self.model, texts=self.doc_list, dictionary=self.vocab_dict,
-                                         coherence=coherence_type)
-        coherence = coherence_model.get_coherence()
+        if evaluator is None:
+            evaluator = CoherenceEvaluator(self.doc_list, self.vocab_dict, coherence_type=coherence_type)
+        coherence = evaluator.score(self.model)
         if self.verbose:
             print("Coherence score for {} topic model was {}".format(self.num_topics, coherence))
         return coherence
@@ -66,14 +81,161 @@ class TopicModel:
         """
         Save topic model to file in output_dir.
         """
-        self.model.save(os.path.join(output_dir, "{}_{}_topics.mdl".format(model_name, self.num_topics)))
+        self.model.save(get_model_path(output_dir, model_name, self.num_topics))
+
+    def load_model(self, model_path: str):
+        """
+        Load previously trained topic model (e.g. one saved with save_model).
+        """
+        self.model = gensim.models.wrappers.LdaMallet.load(model_path)
+
+
+class CoherenceEvaluator:
+    """
+    Computes coherence scores of topic models trained on the same texts and vocab.
+
+    Sliding-window measures (c_v, c_uci, c_npmi) are estimated from word (co-)occurrence counts over sliding windows
+    of the texts. A fresh gensim CoherenceModel counts these for the top words of the model it scores, rescanning all
+    texts every time. The counts only depend on the texts, so here they are collected once for every word in the vocab
+    and reused for each model, and can be saved to disk to be reused by later sweeps on the same corpus.
+    Other measures (e.g. u_mass) are computed with a plain CoherenceModel.
+    """
+    def __init__(self, doc_list: List[List[str]], vocab_dict: corpora.Dictionary, coherence_type: str = 'c_v',
+                 window_size: Optional[int] = None, processes: int = 1, cache_path: Optional[str] = None,
+                 verbose: bool = False):
+        """
+        :param doc_list: list of documents, where each document is a list of words
+        :param vocab_dict: dictionary mapping word ids to words
+        :param coherence_type: coherence measure (see CoherenceModel)
+        :param window_size: size of sliding window (defaults to gensim's default for coherence_type)
+        :param processes: number of processes to use in counting co-occurrences
+        :param cache_path: path to pickle file to load counts from (if they were saved for the same texts, vocab and
+                           window size) or save them to once computed
+        """
+        self.doc_list = doc_list
+        self.vocab_dict = vocab_dict
+        self.coherence_type = coherence_type
+        self.window_size = window_size or SLIDING_WINDOW_SIZES.get(coherence_type)
+        self.processes = processes
+        self.cache_path = cache_path
+        self.verbose = verbose
+        self._accumulator = None
+        self._lock = threading.Lock()
+
+    @property
+    def uses_sliding_window(self) -> bool:
+        return self.coherence_type in SLIDING_WINDOW_SIZES
+
+    def score(self, model) -> float:
+        """
+        Compute coherence score for topics produced by model.
+        """
+        coherence_model = CoherenceModel(model=model, texts=self.doc_list, dictionary=self.vocab_dict,
+                                         coherence=self.coherence_type, window_size=self.window_size)
+        if not self.uses_sliding_window:
+            return coherence_model.get_coherence()
+        # CoherenceModel only counts co-occurrences when no accumulator is set; the shared one covers every word in the
+        # vocab, so it includes the top words of any model. This relies on a private attribute, so check that this
+        # gensim version has it and actually used the shared counts (otherwise the score is from its own counts)
+        if not hasattr(coherence_model, '_accumulator'):
+            warnings.warn("CoherenceModel has no _accumulator attribute; counting co-occurrences for every model")
+            return coherence_model.get_coherence()
+        accumulator = self.get_accumulator()
+        coherence_model._accumulator = accumulator
+        coherence = coherence_model.get_coherence()
+        if coherence_model._accumulator is not accumulator:
+            warnings.warn("CoherenceModel didn't use the shared co-occurrence counts; they were counted again")
+        return coherence
+
+    def get_accumulator(self) -> text_analysis.WordOccurrenceAccumulator:
+        """
+        Get sliding-window occurrence counts of all words in the vocab, loading or computing them on first use.
+        Safe to call from several threads at once (counts are only computed once).
+        """
+        with self._lock:
+            if self._accumulator is None:
+                fingerprint = self._fingerprint()
+                if self.cache_path and os.path.exists(self.cache_path):
+                    self._accumulator = self._load_cache(fingerprint)
+                if self._accumulator is None:
+                    self._accumulator = self._accumulate()
+                    if self.cache_path:
+                        self._save_cache(fingerprint)
+            return self._accumulator
+
+    def _accumulate(self) -> text_analysis.WordOccurrenceAccumulator:
+        relevant_ids = set(self.vocab_dict.keys())
+        if self.processes > 1:
+            accumulator = text_analysis.ParallelWordOccurrenceAccumulator(self.processes, relevant_ids,
+                                                                          self.vocab_dict)
+        else:
+            accumulator = text_analysis.WordOccurrenceAccumulator(relevant_ids, self.vocab_dict)
+        with stage("coherence_counts", docs=len(self.doc_list), tokens=sum(len(doc) for doc in self.doc_list),
+                   processes=self.processes):
+            accumulator = accumulator.accumulate(self.doc_list, self.window_size)
+        return accumulator
+
+    def _fingerprint(self) -> str:
+        """
+        Hash of the texts, vocab and window size that the counts depend on.
+        """
+        sha = hashlib.sha1()
+        sha.update("{}\n".format(self.window_size).encode("utf-8"))
+        sha.update(repr(sorted(self.vocab_dict.token2id.items())).encode("utf-8"))
+        for doc in self.doc_list:
+            sha.update(" ".join(doc).encode("utf-8"))
+            sha.update(b"\n")
+        return sha.hexdigest()
+
+    def _load_cache(self, fingerprint: str) -> Optional[text_analysis.WordOccurrenceAccumulator]:
+        try:
+            with open(self.cache_path, "rb") as f:
+                cached = pickle.load(f)
+        except Exception as e:
+            print("Failed to load co-occurrence counts from {} ({}). Recomputing.".format(self.cache_path, e))
+            return None
+        if cached.get("fingerprint") != fingerprint:
+            if self.verbose:
+                print("Co-occurrence counts in {} are for a different corpus. Recomputing.".format(self.cache_path))
+            return None
+        if self.verbose:
+            print("Loaded co-occurrence counts from {}".format(self.cache_path))
+        return cached["accumulator"]
+
+    def _save_cache(self, fingerprint: str):
+        tmp_path = "{}.tmp".format(self.cache_path)
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"fingerprint": fingerprint, "accumulator": self._accumulator}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.cache_path)
+
+
+def count_tokens(doc_tf_list: List[List[Tuple[int, int]]]) -> int:
+    """
+    Total number of tokens in a list of tf-lists (read from the term frequency array of a corpus_store.BowCorpus).
+    """
+    if isinstance(doc_tf_list, BowCorpus):
+        return int(doc_tf_list.store.tf_counts.sum())
+    return sum(count for doc_tf in doc_tf_list for _, count in doc_tf)
+
+
+def get_model_path(output_dir: str, model_name: str, num_topics: int) -> str:
+    """
+    Path that TopicModel.save_model saves topic model with num_topics topics to.
+    """
+    return os.path.join(output_dir, "{}_{}_topics.mdl".format(model_name, num_topics))
 
 
 def sweep_num_topics(doc_list: List[str], doc_tf_list: List[List[Tuple[int, int]]], vocab_dict: corpora.Dictionary,
                      output_dir: str, model_base_name: str, mallet_path: str, mallet_tmp_dir: str, start: int = 10,
-                     step: int = 5, limit: int = 41, workers: int = 1, verbose: bool = False) -> List[Tuple[int, float]]:
+                     step: int = 5, limit: int = 41, workers: int = 1, verbose: bool = False,
+                     total_cores: Optional[int] = None, coherence_path: Optional[str] = None,
+                     coherence_cache_path: Optional[str] = None) -> List[Tuple[int, float]]:
     """
     Train models with different ks and compute coherence scores.
+    Several ks are trained at once when total_cores allows it. If coherence_path is given, scores are written to it as
+    each model finishes, and ks that already have a saved model and a score there are skipped, so an interrupted sweep
+    can be resumed by running it again.
     :param doc_list: list of document strings
     :param doc_tf_list: list of document term-frequency lists, where each tf-list is a list of (term id, tf) tuples
     :param vocab_dict: dictionary mapping word ids to words
@@ -86,16 +248,84 @@ def sweep_num_topics(doc_list: List[str], doc_tf_list: List[List[Tuple[int, int]
     :param limit: limit on k values
     :param workers: number of threads to use in training each model
     :param verbose: If true, print training progress.
+    :param total_cores: total number of threads to use across all models being trained at once
+                        (defaults to workers, i.e. one model at a time)
+    :param coherence_path: path to CSV file to save coherence scores to
+    :param coherence_cache_path: path to save the co-occurrence counts used for coherence scoring to (or load them
+                                 from, if they were saved by an earlier sweep on the same corpus)
     :return coherence_scores: List of tuples: (k, coherence) for each model trained
     """
-    coherence_scores = []
+    coherence_scores = read_coherence_scores(coherence_path) if coherence_path else {}
+    pending = []
     for num_topics in range(start, limit, step):
-        topic_model = TopicModel(doc_list, doc_tf_list, vocab_dict, num_topics, mallet_tmp_dir, verbose)
+        if num_topics in coherence_scores and os.path.exists(get_model_path(output_dir, model_base_name, num_topics)):
+            if verbose:
+                print("Found existing {} topic model and coherence score. Skipping.".format(num_topics))
+        else:
+            pending.append(num_topics)
+    num_parallel = max(1, (total_cores or workers) // workers)
+    # co-occurrence counts are shared by all models, so compute them once before training starts
+    evaluator = CoherenceEvaluator(doc_list, vocab_dict, processes=total_cores or workers,
+                                   cache_path=coherence_cache_path, verbose=verbose)
+    if pending:
+        evaluator.get_accumulator()
+    num_tokens = count_tokens(doc_tf_list)
+    # models are trained by Mallet in a separate (JVM) process, so threads are enough to run several at once
+    with ThreadPoolExecutor(max_workers=num_parallel) as executor:
+        futures = [executor.submit(_train_and_score_model, doc_list, doc_tf_list, vocab_dict, num_topics, output_dir,
+                                   model_base_name, mallet_path, mallet_tmp_dir, workers, evaluator, verbose,
+                                   num_tokens)
+                   for num_topics in pending]
+        for future in as_completed(futures):
+            num_topics, coherence = future.result()
+            coherence_scores[num_topics] = coherence
+            if coherence_path:
+                save_coherence_scores(coherence_scores, coherence_path)
+    return [(num_topics, coherence_scores[num_topics]) for num_topics in range(start, limit, step)]
+
+
+def _train_and_score_model(doc_list: List[str], doc_tf_list: List[List[Tuple[int, int]]],
+                           vocab_dict: corpora.Dictionary, num_topics: int, output_dir: str, model_base_name: str,
+                           mallet_path: str, mallet_tmp_dir: str, workers: int, evaluator: CoherenceEvaluator,
+                           verbose: bool, num_tokens: Optional[int] = None) -> Tuple[int, float]:
+    """
+    Train (or load, if it was already saved) model with num_topics topics and compute its coherence score.
+    """
+    topic_model = TopicModel(doc_list, doc_tf_list, vocab_dict, num_topics, mallet_tmp_dir, verbose,
+                             num_tokens=num_tokens)
+    model_path = get_model_path(output_dir, model_base_name, num_topics)
+    if os.path.exists(model_path):
+        try:
+            topic_model.load_model(model_path)
+        except Exception as e:
+            # e.g. file was only partially written before a crash
+            print("Failed to load existing {} topic model ({}). Retraining.".format(num_topics, e))
+    if topic_model.model is None:
         topic_model.train_lda_mallet_model(mallet_path, workers=workers)
         topic_model.save_model(output_dir, model_base_name)
-        coherence = topic_model.compute_model_coherence()
-        coherence_scores.append((num_topics, coherence))
-    return coherence_scores
+    coherence = topic_model.compute_model_coherence(evaluator=evaluator)
+    return num_topics, coherence
+
+
+def read_coherence_scores(coherence_path: str) -> Dict[int, float]:
+    """
+    Read coherence scores saved with save_coherence_scores (returns empty dict if file doesn't exist).
+    """
+    if not os.path.exists(coherence_path):
+        return {}
+    coherence_df = pd.read_csv(coherence_path, index_col=0)
+    return dict(zip(coherence_df["num topics"].astype(int), coherence_df["coherence score"]))
+
+
+def save_coherence_scores(coherence_scores: Dict[int, float], coherence_path: str):
+    """
+    Save coherence scores (dict of k -> coherence) to csv file. The file is replaced atomically, so it is never left
+    partially written.
+    """
+    coherence_df = pd.DataFrame(sorted(coherence_scores.items()), columns=["num topics", "coherence score"])
+    tmp_path = "{}.tmp".format(coherence_path)
+    coherence_df.to_csv(tmp_path)
+    os.replace(tmp_path, coherence_path)
 
 
 def _parse_args() -> argparse.Namespace:
@@ -106,6 +336,8 @@ def _parse_args() -> argparse.Namespace:
     parser.add_argument("--mallet_path", type=str, help="Path to mallet model binary.")
     parser.add_argument("--max_num_topics", type=int, default=40, help="Maximum number of topics to use when training model.")
     parser.add_argument('--num_workers', type=int, default=4, help="Number of threads ot use in training topic model.")
+    parser.add_argument('--total_cores', type=int, default=os.cpu_count(),
+                        help="Total number of threads to use across topic models trained at the same time.")
     parser.add_argument("--output_dir", type=str, help="Path to directory to save data.")
     parser.add_argument('--base_model_name', type=str, help="Base name of topic models to use when saving files.")
     parser.add_argument('--mallet_tmp_dir', type=str, help="Path to directory to save mallet 'temporary' files to"
@@ -122,23 +354,19 @@ def main() -> None:
     args = _parse_args()
 
     # load data
-    corpus_df = pd.read_csv(os.path.join(args.corpus_dir, "{}_corpus.csv".format(args.corpus_name)), index_col=0)
-    doc_list = list(corpus_df["text"])
-    # convert from strings to literal form
-    doc_list = [ast.literal_eval(x) for x in doc_list]
-    doc_tf_list = list(corpus_df["tf"])
-    doc_tf_list = [ast.literal_eval(x) for x in doc_tf_list]
+    corpus = load_corpus(args.corpus_dir, args.corpus_name)
+    doc_list = corpus.docs()
+    doc_tf_list = corpus.bow_corpus()
     vocab_dict = corpora.dictionary.Dictionary.load(os.path.join(args.corpus_dir,
                                                                  "{}_vocab.dct".format(args.corpus_name)))
 
-    # train models
-    coherence_scores = sweep_num_topics(doc_list, doc_tf_list, vocab_dict, args.output_dir, args.base_model_name,
-                                        args.mallet_path, args.mallet_tmp_dir, limit=args.max_num_topics + 1,
-                                        workers=args.num_workers, verbose=True)
-
-    # save coherence scores in csv file
-    coherence_df = pd.DataFrame(coherence_scores, columns=["num topics", "coherence score"])
-    coherence_df.to_csv(os.path.join(args.output_dir, "{}_coherence_scores.csv".format(args.base_model_name)))
+    # train models (coherence scores are saved in csv file as each model finishes)
+    coherence_path = os.path.join(args.output_dir, "{}_coherence_scores.csv".format(args.base_model_name))
+    coherence_cache_path = os.path.join(args.output_dir, "{}_coherence_counts.pkl".format(args.corpus_name))
+    sweep_num_topics(doc_list, doc_tf_list, vocab_dict, args.output_dir, args.base_model_name, args.mallet_path,
+                     args.mallet_tmp_dir, limit=args.max_num_topics + 1, workers=args.num_workers, verbose=True,
+                     total_cores=args.total_cores, coherence_path=coherence_path,
+                     coherence_cache_path=coherence_cache_path)
 
 
 if __name__ == "__main__":
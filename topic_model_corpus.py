@@ -3,115 +3,175 @@ Create Corpus of Documents and Vocabulary from Reddit data.
 Used as input for topic model training and inference.
 """
 import os
-import time
 
 import gensim.corpora as corpora
 import numpy as np
 import pandas as pd
 
-from text_utils import build_bigram_model, make_bigrams_docs, lemmatize_docs, process_single_post_text
+from corpus_store import corpus_store_path, save_corpus_store
+from instrumentation import stage
+from text_utils import (LemmaTable, build_bigram_model, build_vocab_dict, doc2bow_matrix, iter_sentences,
+                        make_bigrams_docs, lemmatize_docs, process_texts, tf_lists)
+
+
+def bigram_model_path(corpus_dir, corpus_name):
+    """
+    Path that Corpus.save_corpus saves the bigram model of the corpus to.
+    """
+    return os.path.join(corpus_dir, "{}_bigrams.pkl".format(corpus_name))
+
+
+def count_rows(data_path, chunksize=1000000):
+    """
+    Count the rows of a CSV file (only the index column is parsed, so this is much cheaper than reading the file).
+    """
+    return sum(len(chunk) for chunk in pd.read_csv(data_path, usecols=[0], dtype=str, chunksize=chunksize))
+
+
+def read_documents(data_path, rows=None):
+    """
+    Read documents from a post or comment CSV file, parsing only the columns (and rows) that are needed.
+    Posts are represented by their title + text and comments by their body. The subreddit is taken from the name of
+    the directory the file is in (data/<subreddit>/posts.csv).
+    :param data_path: path to CSV file with post/comment data
+    :param rows: sorted positions of the rows to read (None to read all rows)
+    :return: pandas DataFrame with 'id', 'subreddit', 'type' and 'text' columns
+    """
+    columns = pd.read_csv(data_path, nrows=0).columns
+    is_post = 'selftext' in columns
+    if not is_post:  # should be comment
+        assert 'body' in columns, "found file without selftext or body column: {}".format(data_path)
+    text_columns = ['title', 'selftext'] if is_post else ['body']
+    skiprows = None
+    if rows is not None:
+        # line 0 is the header, so row i is line i + 1. Skipped lines are scanned but not parsed into values.
+        keep_lines = set((np.asarray(rows) + 1).tolist())
+
+        def _skip_line(line):
+            return line > 0 and line not in keep_lines
+        skiprows = _skip_line
+    df = pd.read_csv(data_path, index_col=0, usecols=[columns[0], 'id'] + text_columns, skiprows=skiprows,
+                     dtype={column: str for column in ['id'] + text_columns})
+    return pd.DataFrame({
+        'id': df['id'],
+        'subreddit': os.path.basename(os.path.dirname(os.path.abspath(data_path))),
+        'type': "post" if is_post else "comment",
+        'text': df['title'] + ' ' + df['selftext'] if is_post else df['body'],
+    }, index=df.index)
 
 
 class Corpus:
     """
     Class to read Reddit post/comment data and form corpus of document text, document ids, and vocabulary.
     """
-    def __init__(self, csv_files, downsample=True):
+    def __init__(self, csv_files, downsample=True, seed=None):
         """
-        :param csv_files: list of CSV files with post/comment data
+        :param csv_files: list of CSV files with post/comment data, in data/<subreddit>/ directories
         :param downsample: if True, downsample so that an equal number of entries are used from each file
                            (e.g., equal number for ttcafterloss vs infertility and comments vs posts)
+        :param seed: random seed for downsampling (the same seed gives the same sample)
         """
-        subreddits = ["ttcafterloss", "infertility"]
-
-        print("starting to read data")
-        init_time = time.time()
-
-        # read in data
-        dfs = []
-        min_len = float('inf')
-        for data_path in csv_files:
-            df = pd.read_csv(data_path, index_col=0)
-            # check if post
-            if 'selftext' in df.columns:
-                df['text'] = df.apply(lambda x: x['title'] + ' ' + x['selftext'], axis=1)
-                df['type'] = "post"
-            else:  # should be comment
-                assert 'body' in df.columns, "found df without selftext or body column"
-                df['text'] = df['body']
-                df['type'] = "comment"
-            df['subreddit'] = subreddits[0] if subreddits[0] in data_path else subreddits[1]
-            # keep only needed columns
-            df = df[['id', 'subreddit', 'type', 'text']]
-            if len(df) < min_len:
-                min_len = len(df)
-            dfs.append(df)
-
-        # if downsample, take 'min_len' examples from each df
-        dfs_sampled = []
-        if downsample:
-            print("minimum length df was {}. downsampling others to match.".format(min_len))
-            for df in dfs:
-                idx = np.random.choice(np.arange(len(df)), size=min_len, replace=False)
-                dfs_sampled.append(df.iloc[idx])
-
-        final_dfs = dfs if not downsample else dfs_sampled
-        self.data_df = pd.concat(final_dfs)
-        print("finished reading data in time {}".format(time.time() - init_time))
+        with stage("read_corpus", files=len(csv_files)) as stats:
+            if downsample:
+                # count rows first and then only parse the sampled rows of each file
+                lens = [count_rows(data_path) for data_path in csv_files]
+                min_len = min(lens)
+                print("minimum length df was {}. downsampling others to match.".format(min_len))
+                rng = np.random.default_rng(seed)
+                dfs = [read_documents(data_path, np.sort(rng.choice(data_len, size=min_len, replace=False))
+                                      if data_len > min_len else None)
+                       for data_path, data_len in zip(csv_files, lens)]
+            else:
+                dfs = [read_documents(data_path) for data_path in csv_files]
+            self.data_df = pd.concat(dfs)
+            stats.docs = len(self.data_df)
         self.vocab_dict = None
+        self.tf_matrix = None
+        self.bigram_model = None
 
-    def make_corpus(self, vocab_path=None):
+    def make_corpus(self, vocab_path=None, n_process=1, lemma_table_path=None, lemma_table_by_tag=False):
         """
         :param vocab_path: path to file with vocab to use. If None, will create a vocab from the preprocessed post text
+        :param n_process: number of worker processes to use when pre-processing text and counting vocab
+        :param lemma_table_path: optional path to lemma table (see process_text)
+        :param lemma_table_by_tag: if True, the lemma table also records lemmas by part-of-speech tag
         """
         # (1) pre-process text
-        self.process_text()
+        self.process_text(n_process=n_process, lemma_table_path=lemma_table_path, lemma_table_by_tag=lemma_table_by_tag)
         # (2) remove empty posts
         self.data_df = self.data_df[self.data_df["text"].notnull()]
         # (3) create vocab or load existing one
-        if vocab_path:
-            self.vocab_dict = corpora.dictionary.Dictionary.load(vocab_path)
-        else:
-            self.vocab_dict = self.create_vocab_dict()
-        # (4) create tf representation of text
-        self.data_df["tf"] = self.data_df.apply(lambda x: self.vocab_dict.doc2bow(x["text"]), axis=1)
+        num_tokens = int(self.data_df["text"].str.len().sum())
+        with stage("build_vocab", docs=len(self.data_df), tokens=num_tokens):
+            if vocab_path:
+                self.vocab_dict = corpora.dictionary.Dictionary.load(vocab_path)
+            else:
+                self.vocab_dict = self.create_vocab_dict(n_process=n_process)
+        # (4) create tf representation of text (row i holds the term frequencies of the i-th row of data_df)
+        with stage("doc2bow", docs=len(self.data_df), tokens=num_tokens):
+            self.tf_matrix = doc2bow_matrix(self.data_df["text"], self.vocab_dict)
 
-    def save_corpus(self, output_dir, corpus_name):
+    def save_corpus(self, output_dir, corpus_name, save_csv=True):
         """
+        Save corpus in binary format (see corpus_store.py) along with vocab and bigram model (so that new text can be
+        pre-processed the same way, e.g. by topic_server.py).
         :param output_dir: path to directory to save corpus + vocab to
         :param corpus_name: name of corpus to use in naming saved files
+        :param save_csv: if True, also save the corpus as a CSV file
         """
-        self.data_df.to_csv(os.path.join(output_dir, "{}_corpus.csv".format(corpus_name)))
+        save_corpus_store(corpus_store_path(output_dir, corpus_name), self.data_df, self.data_df["text"],
+                          self.tf_matrix, num_terms=len(self.vocab_dict))
+        if save_csv:
+            self.data_df.assign(tf=tf_lists(self.tf_matrix)).to_csv(
+                os.path.join(output_dir, "{}_corpus.csv".format(corpus_name)))
         self.vocab_dict.save(os.path.join(output_dir, "{}_vocab.dct".format(corpus_name)))
+        if self.bigram_model is not None:
+            self.bigram_model.save(bigram_model_path(output_dir, corpus_name))
 
-    def process_text(self):
-        print("starting to process text")
-        init_time = time.time()
-        text_list = []
+    def process_text(self, n_process=1, batch_size=1000, phrase_vocab_size=40000000, lemma_table_path=None,
+                     lemma_table_by_tag=False):
+        """
+        :param n_process: number of worker processes to use
+        :param batch_size: number of documents/sentences handled per batch
+        :param phrase_vocab_size: maximum number of word/word pair counts kept when learning bigram phrases (each
+                                  worker keeps up to this many as well, see text_utils.build_bigram_model). This only
+                                  bounds the phrase counts: the tokenized text of all documents is still held in memory,
+                                  as it is turned into bigrams and lemmatized after the phrases are learned
+        :param lemma_table_path: optional path to text_utils.LemmaTable file. If given, lemmas are looked up in the
+                                 table (which is created if it doesn't exist, and saved with any new words)
+        :param lemma_table_by_tag: if True, the lemma table also records lemmas by part-of-speech tag
+        """
+        num_docs = len(self.data_df)
         # clean and tokenize text for each post/comment
-        for idx, row in self.data_df.iterrows():
-            text_list.append(process_single_post_text(row['text'], do_lemmatize=False, remove_stops=True))
+        with stage("tokenize", docs=num_docs, n_process=n_process) as stats:
+            text_list = process_texts(self.data_df['text'], do_lemmatize=False, remove_stops=True,
+                                      n_process=n_process, batch_size=batch_size)
+            stats.tokens = sum(len(sent) for doc in text_list for sent in doc)
         # find and add bigrams
-        # first collect all sentences
-        sentence_list = [sent for doc in text_list for sent in doc]
-        # train bigram model
-        bigram_model = build_bigram_model(sentence_list)
-        # identify bigram phrases within text and convert them to this
-        text_list = make_bigrams_docs(text_list, bigram_model)
-        # remove sentence boundaries --> just have each document as list of words
-        text_list = [[word for sent in doc for word in sent] for doc in text_list]
+        # train bigram model on a stream of all sentences (of the tokenized docs, which are kept for the steps below)
+        with stage("bigrams", docs=num_docs, tokens=stats.tokens, n_process=n_process) as stats:
+            self.bigram_model = build_bigram_model(iter_sentences(text_list), max_vocab_size=phrase_vocab_size,
+                                                   n_process=n_process)
+            # identify bigram phrases within text and convert them to this, and remove sentence boundaries --> just
+            # have each document as list of words
+            text_list = make_bigrams_docs(text_list, self.bigram_model, n_process=n_process, batch_size=batch_size,
+                                          flatten=True)
         # lemmatize!
-        text_list = lemmatize_docs(text_list)
+        with stage("lemmatize", docs=num_docs, tokens=sum(len(doc) for doc in text_list), n_process=n_process) as stats:
+            lemma_table = LemmaTable.load_or_create(lemma_table_path, by_tag=lemma_table_by_tag) \
+                if lemma_table_path else None
+            text_list = lemmatize_docs(text_list, n_process=n_process, batch_size=batch_size, lemma_table=lemma_table)
+            if lemma_table is not None:
+                lemma_table.save(lemma_table_path)
+                stats.info["lemma_hit_rate"] = round(lemma_table.hit_rate, 4)
         # store as updated text
         self.data_df['text'] = text_list
-        print("finished processing text in time {}".format(time.time() - init_time))
 
-    def create_vocab_dict(self, no_below=25, no_above=.5):
+    def create_vocab_dict(self, no_below=25, no_above=.5, n_process=1):
         """
         Create vocab dictionary (word id -> word) from all documents.
         :param no_below: remove words that have less than this many occurrences across all documents
         :param no_above: remove words that appear in more than this % of documents
+        :param n_process: number of worker processes to count words with
         """
-        vocab_dict = corpora.Dictionary(list(self.data_df["text"]))
-        vocab_dict.filter_extremes(no_below=no_below, no_above=no_above)
-        return vocab_dict
+        return build_vocab_dict(self.data_df["text"], no_below=no_below, no_above=no_above, n_process=n_process)
@@ -0,0 +1,337 @@
+"""
+Long-running service that tags new posts with topic distributions.
+
+The text cleaner, tokenizer, bigram model, vocab and topic model are loaded once at startup. Requests are JSON objects,
+one per line, with either a 'text' field or 'title' and 'selftext' fields (and optionally an 'id' that is echoed back):
+    {"id": "abc123", "title": "...", "selftext": "..."}
+and each gets a response line:
+    {"id": "abc123", "topic_dist": [...], "latency_ms": 12.3}
+Requests are read from stdin (responses go to stdout, in request order) or from clients of a local socket. Requests
+that arrive close together (e.g. from several clients) are pre-processed and inferred together in micro-batches.
+A {"command": "stats"} request returns the p50/p99 latency of recent requests.
+"""
+import argparse
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import gensim
+import gensim.corpora as corpora
+import numpy as np
+
+from lda_inference import MalletInferencer
+from text_utils import get_nlp, get_sent_tokenizer, get_stop_words, lemmatize_docs, make_bigrams_docs, process_texts
+from topic_model_corpus import bigram_model_path
+
+
+class TopicTagger:
+    """
+    Pre-processes new posts the same way as topic_model_corpus.Corpus and infers their topic distributions.
+    """
+    def __init__(self, vocab_dict, inferencer, bigram_model=None, method='gibbs', iterations=100):
+        """
+        :param vocab_dict: gensim Dictionary the topic model was trained with
+        :param inferencer: lda_inference.MalletInferencer
+        :param bigram_model: gensim Phraser used when building the corpus (None to skip bigrams)
+        :param method: inference method ('gibbs', as in get_document_topic_distributions.py, or 'vb', which is
+                       deterministic, so the same post always gets the same topics)
+        :param iterations: number of inference iterations
+        """
+        self.vocab_dict = vocab_dict
+        self.inferencer = inferencer
+        self.bigram_model = bigram_model
+        self.method = method
+        if iterations < 1:
+            raise ValueError("iterations must be at least 1, got {}".format(iterations))
+        self.iterations = iterations
+        # load text processing resources now rather than on the first request
+        get_stop_words()
+        get_sent_tokenizer()
+        get_nlp()
+
+    @classmethod
+    def from_files(cls, corpus_dir, corpus_name, topic_model_path=None, state_path=None, **kwargs):
+        """
+        Load tagger from files saved by Corpus.save_corpus and TopicModel.save_model.
+        :param topic_model_path: path to saved LdaMallet model
+        :param state_path: path to Mallet state file; if given, the topics are read from it and the LdaMallet model
+                           isn't loaded
+        """
+        vocab_dict = corpora.Dictionary.load(os.path.join(corpus_dir, "{}_vocab.dct".format(corpus_name)))
+        if state_path:
+            inferencer = MalletInferencer.from_state_file(state_path, vocab_dict)
+        else:
+            inferencer = MalletInferencer.from_mallet_model(gensim.models.wrappers.LdaMallet.load(topic_model_path))
+        bigram_path = bigram_model_path(corpus_dir, corpus_name)
+        bigram_model = gensim.models.phrases.Phraser.load(bigram_path) if os.path.exists(bigram_path) else None
+        return cls(vocab_dict, inferencer, bigram_model, **kwargs)
+
+    def preprocess(self, texts):
+        """
+        Clean, tokenize, add bigrams and lemmatize texts (as in Corpus.process_text).
+        :return: list of docs, where each doc is a list of words
+        """
+        docs = process_texts(texts, do_lemmatize=False, remove_stops=True)
+        if self.bigram_model is not None:
+            docs = make_bigrams_docs(docs, self.bigram_model, flatten=True)
+        else:
+            docs = [[word for sent in doc for word in sent] for doc in docs]
+        return lemmatize_docs(docs)
+
+    def infer(self, texts):
+        """
+        Get topic distribution of each text.
+        :return: float32 array of shape (# texts, # topics)
+        """
+        docs = self.preprocess(texts)
+        return self.inferencer.infer([self.vocab_dict.doc2bow(doc) for doc in docs], method=self.method,
+                                     iterations=self.iterations)
+
+
+class LatencyTracker:
+    """
+    Keeps latencies of the most recent requests and reports percentiles.
+    """
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+            self.count += 1
+
+    def summary(self):
+        with self._lock:
+            latencies = np.array(self.latencies)
+            count = self.count
+        if not len(latencies):
+            return {"count": count, "p50_ms": None, "p99_ms": None}
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        return {"count": count, "p50_ms": round(float(p50), 3), "p99_ms": round(float(p99), 3)}
+
+
+class MicroBatcher:
+    """
+    Collects requests from any number of threads and runs them through the tagger in batches.
+    A batch is started as soon as a request arrives, and takes any other requests that arrive within max_wait seconds
+    (up to max_batch_size).
+    """
+    def __init__(self, tagger, max_batch_size=64, max_wait=0.005, report_every=0):
+        """
+        :param report_every: if > 0, print latency summary to stderr after every report_every requests
+        """
+        self.tagger = tagger
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.report_every = report_every
+        self.latency = LatencyTracker()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, text):
+        """
+        Queue text for tagging.
+        :return: concurrent.futures.Future whose result is (topic distribution, latency in seconds)
+        """
+        future = Future()
+        self._queue.put((text, future, time.perf_counter()))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.perf_counter())))
+                except queue.Empty:
+                    break
+            try:
+                topic_dists = self.tagger.infer([text for text, _, _ in batch])
+            except Exception:
+                # retry requests one at a time, so that only the request that caused the error fails
+                topic_dists = []
+                for text, future, _ in batch:
+                    try:
+                        topic_dists.append(self.tagger.infer([text])[0])
+                    except Exception as e:
+                        future.set_exception(e)
+                        topic_dists.append(None)
+            for (_, future, start), topic_dist in zip(batch, topic_dists):
+                if topic_dist is None:
+                    continue
+                latency = time.perf_counter() - start
+                self.latency.record(latency)
+                future.set_result((topic_dist, latency))
+                if self.report_every and self.latency.count % self.report_every == 0:
+                    print("latency: {}".format(self.latency.summary()), file=sys.stderr)
+
+
+def _request_text(request):
+    """
+    Text of a request: its 'text', or its 'title' and 'selftext' (missing or null title/selftext count as empty).
+    Raises ValueError if the text isn't a string.
+    """
+    if "text" in request:
+        if not isinstance(request["text"], str):
+            raise ValueError("'text' must be a string")
+        return request["text"]
+    parts = [request.get("title") or "", request.get("selftext") or ""]
+    if not all(isinstance(part, str) for part in parts):
+        raise ValueError("'title' and 'selftext' must be strings")
+    # posts are represented by title + text, as in Corpus
+    return "{} {}".format(*parts)
+
+
+def _response(request, result):
+    topic_dist, latency = result
+    return {"id": request.get("id"), "topic_dist": topic_dist.tolist(), "latency_ms": round(latency * 1000, 3)}
+
+
+def handle_line(batcher, line):
+    """
+    Handle one request line.
+    :return: Future whose result is the response dict (or None for blank lines)
+    """
+    response = Future()
+    if not line.strip():
+        response.set_result(None)
+        return response
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        response.set_result({"error": "invalid JSON: {}".format(e)})
+        return response
+    if not isinstance(request, dict):
+        response.set_result({"error": "request must be a JSON object"})
+        return response
+    if request.get("command") == "stats":
+        response.set_result(batcher.latency.summary())
+        return response
+    try:
+        text = _request_text(request)
+    except ValueError as e:
+        response.set_result({"id": request.get("id"), "error": str(e)})
+        return response
+
+    def on_done(future):
+        try:
+            response.set_result(_response(request, future.result()))
+        except Exception as e:
+            response.set_result({"id": request.get("id"), "error": str(e)})
+    batcher.submit(text).add_done_callback(on_done)
+    return response
+
+
+def serve_stdin(batcher, in_file=sys.stdin, out_file=sys.stdout):
+    """
+    Read requests from in_file and write responses to out_file in the same order. Requests are submitted as they are
+    read, so lines that are piped in together are batched.
+    """
+    pending = queue.Queue()
+
+    def write_responses():
+        while True:
+            response = pending.get()
+            if response is None:
+                return
+            result = response.result()
+            if result is not None:
+                out_file.write(json.dumps(result) + "\n")
+                out_file.flush()
+    writer = threading.Thread(target=write_responses)
+    writer.start()
+    for line in in_file:
+        pending.put(handle_line(batcher, line))
+    pending.put(None)
+    writer.join()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            result = handle_line(self.server.batcher, line.decode("utf-8")).result()
+            if result is not None:
+                self.wfile.write((json.dumps(result) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve_socket(batcher, socket_path=None, port=None):
+    """
+    Serve requests from clients of a unix socket at socket_path, or of a TCP socket on localhost:port. Each client
+    connection is handled in its own thread, so requests from concurrent clients are batched together.
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _ThreadingUnixServer(socket_path, _RequestHandler)
+    else:
+        server = _ThreadingTCPServer(("127.0.0.1", port), _RequestHandler)
+    server.batcher = batcher
+    print("serving on {}".format(socket_path or "127.0.0.1:{}".format(port)), file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus_dir", type=str, help="Path to directory of corpus the topic model was trained on.")
+    parser.add_argument("--corpus_name", type=str, help="Prefix used in naming corpus files.")
+    parser.add_argument("--topic_model_path", type=str, default=None, help="Path to topic model.")
+    parser.add_argument("--state_path", type=str, default=None,
+                        help="Path to Mallet state file of topic model (used instead of --topic_model_path).")
+    parser.add_argument("--method", type=str, choices=["gibbs", "vb"], default="gibbs", help="Inference method.")
+    parser.add_argument("--iterations", type=int, default=100, help="Number of inference iterations.")
+    parser.add_argument("--socket_path", type=str, default=None, help="Serve on this unix socket instead of stdin.")
+    parser.add_argument("--port", type=int, default=None, help="Serve on this localhost TCP port instead of stdin.")
+    parser.add_argument("--max_batch_size", type=int, default=64, help="Maximum number of requests per batch.")
+    parser.add_argument("--max_wait_ms", type=float, default=5,
+                        help="Time to wait for more requests before running a batch.")
+    parser.add_argument("--report_every", type=int, default=1000,
+                        help="Print p50/p99 latency to stderr after this many requests (0 to disable).")
+    args = parser.parse_args()
+    if args.iterations < 1:
+        parser.error("--iterations must be at least 1")
+    return args
+
+
+def main():
+    args = _parse_args()
+    start_time = time.time()
+    tagger = TopicTagger.from_files(args.corpus_dir, args.corpus_name, args.topic_model_path, args.state_path,
+                                    method=args.method, iterations=args.iterations)
+    print("loaded models in time {}".format(time.time() - start_time), file=sys.stderr)
+    print("inferring topics with method {} ({} iterations)".format(tagger.method, tagger.iterations), file=sys.stderr)
+    batcher = MicroBatcher(tagger, max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000,
+                           report_every=args.report_every)
+    if args.socket_path or args.port:
+        serve_socket(batcher, socket_path=args.socket_path, port=args.port)
+    else:
+        serve_stdin(batcher)
+        print("latency: {}".format(batcher.latency.summary()), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Train CBOW Word2Vec word embeddings on pre-processed posts, on CPU and with bounded memory.
+
+The words of all posts are mapped to ids and concatenated into a single array (with the offsets of each post), and
+minibatches of (context, center word) pairs are cut from it lazily: for a batch of center positions, the context ids
+are gathered with one vectorized indexing operation, and positions outside the center word's post are padded. So the
+memory used grows with the number of words (one id and one position per word), not with the number of windows times
+the window size, and no list of (context, word) pairs is ever built.
+
+Instead of a softmax over the whole vocab, the model is trained with negative sampling (--loss neg) or hierarchical
+softmax over a Huffman tree of the vocab (--loss hs), and the embeddings are sparse, so each step only touches the
+rows of the words in the batch.
+"""
+import argparse
+import collections
+import heapq
+import os
+
+import numpy as np
+import torch
+
+from bert_tokens import post_words, read_processed_posts
+from instrumentation import stage
+
+
+def build_vocab(docs, max_words=10000, min_count=1):
+    """
+    Most frequent words of docs.
+    :param docs: list of lists of words
+    :param max_words: maximum vocab size
+    :param min_count: leave out words that occur less often than this
+    :return: list of words (most frequent first) and numpy array with the count of each word
+    """
+    counts = collections.Counter(word for doc in docs for word in doc)
+    vocab = [(word, count) for word, count in counts.most_common(max_words) if count >= min_count]
+    return [word for word, _ in vocab], np.array([count for _, count in vocab], dtype=np.int64)
+
+
+def encode_docs(docs, vocab):
+    """
+    Map words of docs to vocab ids and concatenate them. Words that aren't in vocab are left out.
+    :return: int32 array of word ids and int64 array doc_indptr (ids of doc i are
+             token_ids[doc_indptr[i]:doc_indptr[i + 1]])
+    """
+    word_ids = {word: i for i, word in enumerate(vocab)}
+    token_ids, doc_lens = [], []
+    for doc in docs:
+        doc_ids = [word_ids[word] for word in doc if word in word_ids]
+        token_ids.extend(doc_ids)
+        doc_lens.append(len(doc_ids))
+    doc_indptr = np.zeros(len(docs) + 1, dtype=np.int64)
+    np.cumsum(doc_lens, out=doc_indptr[1:])
+    return np.array(token_ids, dtype=np.int32), doc_indptr
+
+
+def context_windows(token_ids, doc_indptr, positions, window, pad_id):
+    """
+    Context of the words at positions: the window words before and after each, from the same doc.
+    :param token_ids: word ids of all docs (see encode_docs)
+    :param doc_indptr: doc offsets into token_ids
+    :param positions: int64 array of positions in token_ids
+    :param pad_id: id used for context positions that are outside the word's doc
+    :return: int64 array of shape (len(positions), 2 * window)
+    """
+    offsets = np.concatenate([np.arange(-window, 0), np.arange(1, window + 1)])
+    docs = np.searchsorted(doc_indptr, positions, side="right") - 1
+    context_positions = positions[:, None] + offsets
+    valid = (context_positions >= doc_indptr[docs, None]) & (context_positions < doc_indptr[docs + 1, None])
+    context = token_ids[np.clip(context_positions, 0, len(token_ids) - 1)].astype(np.int64)
+    context[~valid] = pad_id
+    return context
+
+
+def iter_batches(token_ids, doc_indptr, window, batch_size, pad_id, shuffle=True, rng=None):
+    """
+    Yield (context, center word) LongTensor batches over all words that have at least one context word.
+    """
+    doc_lens = np.diff(doc_indptr)
+    # words of single-word docs have no context
+    positions = np.flatnonzero(np.repeat(doc_lens > 1, doc_lens))
+    if shuffle:
+        positions = (rng or np.random.default_rng()).permutation(positions)
+    for start in range(0, len(positions), batch_size):
+        batch_positions = positions[start:start + batch_size]
+        context = context_windows(token_ids, doc_indptr, batch_positions, window, pad_id)
+        yield torch.from_numpy(context), torch.from_numpy(token_ids[batch_positions].astype(np.int64))
+
+
+def huffman_tree(counts):
+    """
+    Huffman tree of the vocab for hierarchical softmax (frequent words get short paths).
+    :param counts: count of each word
+    :return: (points, codes, mask) arrays of shape (vocab size, max path length): the inner nodes on the path from the
+    root to each word, the branch taken at each (0/1) and which entries are part of the path
+    """
+    vocab_size = len(counts)
+    heap = [(count, i) for i, count in enumerate(counts)]
+    heapq.heapify(heap)
+    parent = np.zeros(2 * vocab_size - 1, dtype=np.int64)
+    branch = np.zeros(2 * vocab_size - 1, dtype=np.int64)
+    for node in range(vocab_size, 2 * vocab_size - 1):
+        count1, node1 = heapq.heappop(heap)
+        count2, node2 = heapq.heappop(heap)
+        parent[node1], parent[node2] = node, node
+        branch[node2] = 1
+        heapq.heappush(heap, (count1 + count2, node))
+    root = 2 * vocab_size - 2
+    paths = []
+    for word in range(vocab_size):
+        path, node = [], word
+        while node != root:
+            path.append((parent[node] - vocab_size, branch[node]))
+            node = parent[node]
+        paths.append(path[::-1])
+    max_len = max(len(path) for path in paths)
+    points = np.zeros((vocab_size, max_len), dtype=np.int64)
+    codes = np.zeros((vocab_size, max_len), dtype=np.float32)
+    mask = np.zeros((vocab_size, max_len), dtype=np.float32)
+    for word, path in enumerate(paths):
+        if path:
+            points[word, :len(path)], codes[word, :len(path)] = zip(*path)
+            mask[word, :len(path)] = 1
+    return points, codes, mask
+
+
+class CBOW(torch.nn.Module):
+    """
+    CBOW Word2Vec model: the mean of the context word embeddings predicts the center word, with negative sampling or
+    hierarchical softmax.
+    """
+    def __init__(self, counts, dim=100, loss="neg", negative=5, seed=None):
+        """
+        :param counts: count of each vocab word (used for the noise distribution or the Huffman tree)
+        :param dim: embedding size
+        :param loss: 'neg' for negative sampling or 'hs' for hierarchical softmax
+        :param negative: number of noise words per center word for negative sampling
+        """
+        super(CBOW, self).__init__()
+        if loss not in ("neg", "hs"):
+            raise ValueError("unknown loss '{}'".format(loss))
+        self.vocab_size = len(counts)
+        self.pad_id = self.vocab_size
+        self.loss_type = loss
+        self.negative = negative
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        self.embed = torch.nn.Embedding(self.vocab_size + 1, dim, padding_idx=self.pad_id, sparse=True)
+        with torch.no_grad():
+            self.embed.weight.uniform_(-0.5 / dim, 0.5 / dim, generator=self.generator)
+            self.embed.weight[self.pad_id] = 0
+        if loss == "neg":
+            self.out = torch.nn.Embedding(self.vocab_size, dim, sparse=True)
+            # unigram distribution raised to the 3/4 power, as in the original word2vec
+            noise = torch.as_tensor(np.asarray(counts, dtype=np.float64) ** 0.75)
+            self.register_buffer("noise_cdf", torch.cumsum(noise / noise.sum(), 0).float())
+        else:
+            self.out = torch.nn.Embedding(max(self.vocab_size - 1, 1), dim, sparse=True)
+            points, codes, mask = huffman_tree(counts)
+            self.register_buffer("points", torch.from_numpy(points))
+            self.register_buffer("codes", torch.from_numpy(codes))
+            self.register_buffer("mask", torch.from_numpy(mask))
+        torch.nn.init.zeros_(self.out.weight)
+
+    def forward(self, context, center):
+        """
+        :param context: LongTensor of shape (batch size, 2 * window), padded with pad_id
+        :param center: LongTensor of center word ids
+        :return: mean loss of the batch
+        """
+        num_context = (context != self.pad_id).sum(dim=1, keepdim=True).clamp(min=1)
+        hidden = self.embed(context).sum(dim=1) / num_context
+        if self.loss_type == "neg":
+            noise = torch.searchsorted(self.noise_cdf, torch.rand(len(center), self.negative,
+                                                                  generator=self.generator))
+            noise = noise.clamp(max=self.vocab_size - 1)
+            targets = torch.cat([center[:, None], noise], dim=1)
+            labels = torch.zeros(targets.shape)
+            labels[:, 0] = 1
+            weights = None
+        else:
+            targets = self.points[center]
+            # the probability of branch 0 is sigmoid(score) (as in the original word2vec)
+            labels = 1 - self.codes[center]
+            weights = self.mask[center]
+        scores = (self.out(targets) * hidden[:, None, :]).sum(dim=-1)
+        losses = torch.nn.functional.binary_cross_entropy_with_logits(scores, labels, weight=weights,
+                                                                      reduction="none")
+        return losses.sum(dim=1).mean()
+
+    @property
+    def vectors(self):
+        """
+        Word embeddings as a numpy array of shape (vocab size, dim).
+        """
+        return self.embed.weight[:self.vocab_size].detach().numpy().copy()
+
+
+def train_word2vec(docs, max_words=10000, dim=100, window=2, epochs=5, batch_size=1024, loss="neg", negative=5,
+                   lr=0.01, seed=None):
+    """
+    Train CBOW word embeddings on docs.
+    :param docs: list of lists of words
+    :param max_words: maximum vocab size (most frequent words)
+    :param window: number of context words on each side of the center word
+    :return: vocab (list of words) and numpy array of word embeddings (row i is the embedding of vocab[i])
+    """
+    vocab, counts = build_vocab(docs, max_words=max_words)
+    token_ids, doc_indptr = encode_docs(docs, vocab)
+    model = CBOW(counts, dim=dim, loss=loss, negative=negative, seed=seed)
+    optimizer = torch.optim.SparseAdam(list(model.parameters()), lr=lr)
+    rng = np.random.default_rng(seed)
+    for epoch in range(epochs):
+        with stage("word2vec_epoch", docs=len(docs), tokens=len(token_ids), epoch=epoch) as stats:
+            total_loss, num_batches = 0., 0
+            for context, center in iter_batches(token_ids, doc_indptr, window, batch_size, model.pad_id, rng=rng):
+                optimizer.zero_grad()
+                batch_loss = model(context, center)
+                batch_loss.backward()
+                optimizer.step()
+                total_loss += batch_loss.item()
+                num_batches += 1
+            stats.info["loss"] = round(total_loss / max(num_batches, 1), 4)
+    return vocab, model.vectors
+
+
+def save_vectors(output_dir, name, vocab, vectors):
+    """
+    Save word embeddings to <name>_vectors.npy and their words to <name>_vocab.txt (one per line, same order).
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    np.save(os.path.join(output_dir, "{}_vectors.npy".format(name)), vectors.astype(np.float32))
+    with open(os.path.join(output_dir, "{}_vocab.txt".format(name)), "w", encoding="utf-8") as f:
+        f.write("".join("{}\n".format(word) for word in vocab))
+
+
+def load_vectors(output_dir, name):
+    """
+    Load word embeddings saved with save_vectors.
+    :return: list of words and numpy array of embeddings
+    """
+    with open(os.path.join(output_dir, "{}_vocab.txt".format(name)), encoding="utf-8") as f:
+        vocab = f.read().splitlines()
+    return vocab, np.load(os.path.join(output_dir, "{}_vectors.npy".format(name)))
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_paths", type=str, nargs="+",
+                        help="Paths to processed_posts.csv files to train on (e.g. of one subreddit).")
+    parser.add_argument("--output_dir", type=str, help="Path to directory to save embeddings to.")
+    parser.add_argument("--name", type=str, default="word2vec", help="Name to use in naming saved files.")
+    parser.add_argument("--data_split", type=str, default="train",
+                        help="Only train on posts from this data split ('all' for all posts).")
+    parser.add_argument("--max_words", type=int, default=10000, help="Maximum vocab size.")
+    parser.add_argument("--dim", type=int, default=100, help="Embedding size.")
+    parser.add_argument("--window", type=int, default=2, help="Number of context words on each side.")
+    parser.add_argument("--epochs", type=int, default=5, help="Number of passes over the data.")
+    parser.add_argument("--batch_size", type=int, default=1024, help="Number of center words per batch.")
+    parser.add_argument("--loss", type=str, default="neg", choices=["neg", "hs"],
+                        help="Negative sampling (neg) or hierarchical softmax (hs).")
+    parser.add_argument("--negative", type=int, default=5, help="Number of noise words for negative sampling.")
+    parser.add_argument("--lr", type=float, default=0.01, help="Learning rate.")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed.")
+    parser.add_argument("--num_threads", type=int, default=None, help="Number of threads torch uses.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = _parse_args()
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+    data_df = read_processed_posts(args.data_paths)
+    if args.data_split != "all":
+        data_df = data_df[data_df["data_split"] == args.data_split]
+    docs = post_words(data_df["processed_title"], data_df["processed_text"])
+    vocab, vectors = train_word2vec(docs, max_words=args.max_words, dim=args.dim, window=args.window,
+                                    epochs=args.epochs, batch_size=args.batch_size, loss=args.loss,
+                                    negative=args.negative, lr=args.lr, seed=args.seed)
+    save_vectors(args.output_dir, args.name, vocab, vectors)
+    print("saved {} word embeddings of size {} to {}".format(len(vocab), vectors.shape[1], args.output_dir))
+
+
+if __name__ == "__main__":
+    main()